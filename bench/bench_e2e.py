@@ -0,0 +1,291 @@
+"""Benchmark de extremo a extremo de los grabadores contra la api-yolo simulada.
+
+Arranca `fake_api.py` en un proceso aparte y ejecuta `VideoRecorder` (main.py) y/o
+`OptimizedVideoRecorder` (main_stream.py), cada uno en su propio proceso para que el
+RSS y la CPU no se mezclen. Por cámara mide los FPS sostenidos, los frames perdidos
+(enviados por el servidor menos escritos en el encoder), la CPU y la latencia desde la
+llegada del frame hasta su escritura. Por grabador mide además el pico de RSS. Los
+resultados se guardan en JSON para comparar ejecuciones (`--baseline`).
+
+Uso:
+    python bench/bench_e2e.py --cameras 4 --width 1920 --height 1080 --fps 25 --seconds 30
+    python bench/bench_e2e.py --recorder stream --encoder passthrough --output after.json --baseline before.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import requests
+
+BENCH_DIR = Path(__file__).resolve().parent
+SRC_DIR = BENCH_DIR.parents[0] / "src"
+
+RECORDERS = {
+    "main": ("main", "VideoRecorder", "record"),
+    "stream": ("main_stream", "OptimizedVideoRecorder", "record_all"),
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+class LatencyProbe:
+    """Envuelve un encoder y anota cuándo se escribe cada frame."""
+
+    def __init__(self, encoder, camera_name, samples):
+        self._encoder = encoder
+        self.camera_name = camera_name
+        self.samples = samples
+
+    def __getattr__(self, name):
+        return getattr(self._encoder, name)
+
+    def _record(self, timestamp):
+        now = time.time()
+        self.samples.setdefault(self.camera_name, []).append((now, now - timestamp if timestamp else None))
+
+    def write(self, frame, timestamp=None):
+        self._encoder.write(frame, timestamp)
+        self._record(timestamp)
+
+    def write_jpeg(self, data, timestamp=None):
+        self._encoder.write_jpeg(data, timestamp)
+        self._record(timestamp)
+
+    def release(self):
+        self._encoder.release()
+
+
+def install_probes(samples):
+    """Sustituye `create_encoder` en los módulos que lo importan por una versión con sonda."""
+    import encoder
+    import main
+    import main_stream
+    import process_engine
+
+    original = encoder.create_encoder
+
+    def probed_create_encoder(output_path, frame_size, fps, encoder_cfg=None):
+        return LatencyProbe(original(output_path, frame_size, fps, encoder_cfg), Path(output_path).stem, samples)
+
+    for module in (main, main_stream, process_engine):
+        module.create_encoder = probed_create_encoder
+
+
+def server_sent(uri):
+    return requests.get(f"{uri}/bench_stats", timeout=5).json()["sent"]
+
+
+def run_recorder(spec):
+    """Ejecuta un grabador en este proceso y devuelve sus métricas (modo `--worker`)."""
+    sys.path.insert(0, str(SRC_DIR))
+    workdir = Path(spec["workdir"])
+    # Los grabadores escriben en `../files` relativo al directorio de trabajo
+    run_dir = workdir / spec["recorder"] / "run"
+    run_dir.mkdir(parents=True, exist_ok=True)
+    os.chdir(run_dir)
+
+    cfg = {
+        "cameras": [{"name": f"cam{i}"} for i in range(spec["cameras"])],
+        "encoder": {"backend": spec["encoder"]},
+        "pipeline": spec["pipeline"],
+        "engine": {"mode": spec["engine"], "resolution": [spec["width"], spec["height"]], "fps": spec["fps"]},
+        "postprocess": {"tasks": [], "state_path": str(run_dir / "postprocess_jobs.json")},
+        "metrics": {"port": 0},
+    }
+    cfg_path = run_dir / "cfg.json"
+    cfg_path.write_text(json.dumps(cfg, indent=4))
+
+    samples = {}
+    install_probes(samples)
+    module_name, class_name, method = RECORDERS[spec["recorder"]]
+    module = __import__(module_name)
+    recorder = getattr(module, class_name)(cfg_path=str(cfg_path), video_duration_minutes=spec["seconds"] / 60,
+                                           fixed_fps=spec["fps"])
+    recorder.model.uri = spec["uri"]
+
+    sent_before = server_sent(spec["uri"])
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    getattr(recorder, method)()
+    wall = time.time() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    sent_after = server_sent(spec["uri"])
+
+    cpu_seconds = (usage.ru_utime - usage_before.ru_utime + usage.ru_stime - usage_before.ru_stime
+                   + children.ru_utime - children_before.ru_utime + children.ru_stime - children_before.ru_stime)
+    cameras = {}
+    for camera in cfg["cameras"]:
+        name = camera["name"]
+        writes = samples.get(name, [])
+        latencies = [latency for _, latency in writes if latency is not None]
+        sent = sent_after.get(name, 0) - sent_before.get(name, 0)
+        span = writes[-1][0] - writes[0][0] if len(writes) > 1 else 0.0
+        cameras[name] = {
+            "frames_sent": sent,
+            "frames_written": len(writes),
+            "frames_lost": max(0, sent - len(writes)),
+            "sustained_fps": (len(writes) - 1) / span if span else 0.0,
+            "latency_ms_p50": (percentile(latencies, 50) or 0.0) * 1000,
+            "latency_ms_p95": (percentile(latencies, 95) or 0.0) * 1000,
+            "latency_ms_max": max(latencies, default=0.0) * 1000,
+        }
+    return {
+        "wall_seconds": wall,
+        "cpu_seconds": cpu_seconds,
+        "cpu_percent_per_camera": 100 * cpu_seconds / wall / spec["cameras"] if wall else 0.0,
+        # En Linux `ru_maxrss` viene en KiB
+        "peak_rss_mb": usage.ru_maxrss / 1024,
+        "peak_child_rss_mb": children.ru_maxrss / 1024,
+        "cameras": cameras,
+    }
+
+
+def start_server(args, port):
+    command = [sys.executable, str(BENCH_DIR / "fake_api.py"), "--port", str(port), "--width", str(args.width),
+               "--height", str(args.height), "--fps", str(args.fps)]
+    if args.replay:
+        command += ["--replay", args.replay]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    uri = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("El servidor simulado no arrancó")
+        try:
+            requests.get(f"{uri}/check_status", timeout=1)
+            return server, uri
+        except requests.RequestException:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("El servidor simulado no respondió a tiempo")
+
+
+def summarize(name, result):
+    cameras = result["cameras"].values()
+    print(f"\n{name}: {result['wall_seconds']:.1f}s, CPU/cámara {result['cpu_percent_per_camera']:.1f}%, "
+          f"RSS pico {result['peak_rss_mb']:.0f} MB (hijos {result['peak_child_rss_mb']:.0f} MB)")
+    print(f"  {'cámara':<8} {'enviados':>9} {'escritos':>9} {'perdidos':>9} {'FPS':>7} {'p50 ms':>8} {'p95 ms':>8}")
+    for camera_name, stats in result["cameras"].items():
+        print(f"  {camera_name:<8} {stats['frames_sent']:>9} {stats['frames_written']:>9} {stats['frames_lost']:>9} "
+              f"{stats['sustained_fps']:>7.2f} {stats['latency_ms_p50']:>8.1f} {stats['latency_ms_p95']:>8.1f}")
+    if cameras:
+        fps = [stats["sustained_fps"] for stats in cameras]
+        print(f"  FPS sostenidos: mín {min(fps):.2f}, medio {sum(fps) / len(fps):.2f}")
+
+
+def compare(results, baseline_path):
+    baseline = json.loads(Path(baseline_path).read_text())["results"]
+    print(f"\nComparación con {baseline_path}:")
+    for name, result in results.items():
+        if name not in baseline or "error" in result or "error" in baseline[name]:
+            continue
+        before = baseline[name]
+        fps_now = [c["sustained_fps"] for c in result["cameras"].values()]
+        fps_before = [c["sustained_fps"] for c in before["cameras"].values()]
+        print(f"  {name}: FPS medio {sum(fps_before) / len(fps_before):.2f} -> {sum(fps_now) / len(fps_now):.2f}, "
+              f"CPU/cámara {before['cpu_percent_per_camera']:.1f}% -> {result['cpu_percent_per_camera']:.1f}%, "
+              f"RSS pico {before['peak_rss_mb']:.0f} -> {result['peak_rss_mb']:.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recorder", choices=["main", "stream", "both"], default="both")
+    parser.add_argument("--cameras", type=int, default=4)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--fps", type=int, default=25)
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--encoder", choices=["ffmpeg", "passthrough", "opencv"], default="ffmpeg")
+    parser.add_argument("--engine", choices=["threads", "processes"], default="threads")
+    parser.add_argument("--decoders", type=int, default=2, help="Hilos de decodificación por cámara.")
+    parser.add_argument("--replay", help="Directorio de JPEG a reproducir en lugar de frames sintéticos.")
+    parser.add_argument("--output", default="bench_e2e.json", help="Fichero JSON de resultados.")
+    parser.add_argument("--baseline", help="JSON de una ejecución anterior con la que comparar.")
+    parser.add_argument("--keep", action="store_true", help="Conservar los vídeos y logs generados.")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        spec = json.loads(Path(args.worker).read_text())
+        result = run_recorder(spec)
+        Path(spec["result_path"]).write_text(json.dumps(result))
+        return
+
+    workdir = Path(tempfile.mkdtemp(prefix="bench_e2e_"))
+    server, uri = start_server(args, free_port())
+    recorders = ["main", "stream"] if args.recorder == "both" else [args.recorder]
+    results = {}
+    try:
+        for name in recorders:
+            spec = {
+                "recorder": name,
+                "uri": uri,
+                "workdir": str(workdir),
+                "result_path": str(workdir / f"{name}.json"),
+                "cameras": args.cameras,
+                "width": args.width,
+                "height": args.height,
+                "fps": args.fps,
+                "seconds": args.seconds,
+                "encoder": args.encoder,
+                "engine": args.engine,
+                "pipeline": {"decoders": args.decoders},
+            }
+            spec_path = workdir / f"{name}_spec.json"
+            spec_path.write_text(json.dumps(spec))
+            print(f"Ejecutando {name} ({args.cameras} cámaras {args.width}x{args.height}@{args.fps}, "
+                  f"{args.seconds:.0f}s, encoder {args.encoder}, motor {args.engine})...", flush=True)
+            with open(workdir / f"{name}.log", "w") as log:
+                subprocess.run([sys.executable, __file__, "--worker", str(spec_path)], stdout=log,
+                               stderr=subprocess.STDOUT, timeout=args.seconds * 4 + 120)
+            result_path = Path(spec["result_path"])
+            if result_path.exists():
+                results[name] = json.loads(result_path.read_text())
+                summarize(name, results[name])
+            else:
+                results[name] = {"error": f"sin resultados, ver {workdir / f'{name}.log'}"}
+                print(f"{name}: {results[name]['error']}")
+    finally:
+        server.terminate()
+        server.wait()
+
+    report = {
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "host": {"platform": platform.platform(), "cpus": os.cpu_count(), "python": platform.python_version()},
+        "config": {key: value for key, value in vars(args).items() if key not in ("worker", "output", "baseline")},
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=4))
+    print(f"\nResultados guardados en {args.output}")
+    if args.baseline:
+        compare(results, args.baseline)
+    if args.keep:
+        print(f"Vídeos y logs en {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
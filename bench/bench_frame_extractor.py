@@ -0,0 +1,133 @@
+"""Micro-benchmark del extractor de frames MJPEG.
+
+Compara el coste por frame del parser original (`buffer += chunk` + `find` desde el
+inicio) con `MJPEGFrameExtractor` para distintos tamaños de chunk y de frame. El coste
+por byte del extractor debe mantenerse plano al crecer ambos tamaños (el coste por frame
+solo crece con la copia única del frame), mientras que el del parser original crece de
+forma cuadrática con la relación frame/chunk.
+
+Antes de medir se comprueba que ningún corte de chunk pierde frames, también justo
+tras las cabeceras de una parte sin Content-Length.
+
+Uso:
+    python bench/bench_frame_extractor.py [--seconds 1.0] [--no-legacy]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "src"))
+
+from frame_extractor import MJPEGFrameExtractor  # noqa: E402
+
+CHUNK_SIZES = [16384, 262144, 1048576]
+FRAME_SIZES = [50_000, 500_000, 2_000_000]
+
+
+def synthetic_frame(size):
+    """Genera un JPEG sintético (SOI + payload sin 0xFF + EOI) del tamaño indicado."""
+    payload = os.urandom(size - 4).replace(b"\xff", b"\x00")
+    return b"\xff\xd8" + payload + b"\xff\xd9"
+
+
+def synthetic_stream(frame_size, n_frames, content_length=True, frame=None):
+    frame = frame or synthetic_frame(frame_size)
+    headers = b"--frame\r\nContent-Type: image/jpeg\r\n"
+    if content_length:
+        headers += b"Content-Length: %d\r\n" % len(frame)
+    part = headers + b"\r\n" + frame + b"\r\n"
+    return part * n_frames
+
+
+def chunked(stream, chunk_size):
+    view = memoryview(stream)
+    return [view[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+
+
+def legacy_parse(chunks):
+    """Parser original de `record_camera`, reproducido para comparar."""
+    buffer = b""
+    count = 0
+    for chunk in chunks:
+        buffer += chunk
+        while b"\xff\xd9" in buffer:
+            start = buffer.find(b"\xff\xd8")
+            end = buffer.find(b"\xff\xd9") + 2
+            if start != -1:
+                frame_data = buffer[start:end]  # noqa: F841
+                buffer = buffer[end:]
+                count += 1
+    return count
+
+
+def extractor_parse(chunks, content_length=True):
+    extractor = MJPEGFrameExtractor(boundary=b"frame" if content_length else None)
+    count = 0
+    for chunk in chunks:
+        count += len(extractor.feed(chunk))
+    return count
+
+
+def check_chunk_splits(frame_size=256, n_frames=3, fuzz_runs=2000):
+    """Comprueba que el extractor devuelve todos los frames se corte donde se corte el stream.
+
+    Se prueban todos los cortes en dos chunks (incluido el que cae entre la línea en
+    blanco de las cabeceras y el SOI) y re-troceados aleatorios, con y sin Content-Length.
+    """
+    frame = synthetic_frame(frame_size)
+    rng = random.Random(0)
+    for content_length in (True, False):
+        stream = synthetic_stream(frame_size, n_frames, content_length, frame)
+        cases = [[stream[:i], stream[i:]] for i in range(1, len(stream))]
+        for _ in range(fuzz_runs):
+            cuts = sorted(rng.sample(range(1, len(stream)), rng.randint(1, 40)))
+            cases.append([stream[a:b] for a, b in zip([0] + cuts, cuts + [len(stream)])])
+        for chunks in cases:
+            extractor = MJPEGFrameExtractor(boundary=b"frame")
+            frames = [bytes(f) for chunk in chunks for f in extractor.feed(chunk)]
+            assert frames == [frame] * n_frames, (
+                f"Content-Length={content_length}: {len(frames)} de {n_frames} frames con cortes en "
+                f"{[len(c) for c in chunks]}")
+
+
+def measure(fn, chunks, n_frames, seconds):
+    runs = 0
+    total = 0.0
+    while total < seconds or runs == 0:
+        start = time.perf_counter()
+        count = fn(chunks)
+        total += time.perf_counter() - start
+        runs += 1
+        assert count == n_frames, f"Se esperaban {n_frames} frames y se obtuvieron {count}"
+    return total / (runs * n_frames) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=1.0, help="Tiempo mínimo de medida por caso.")
+    parser.add_argument("--stream-mb", type=float, default=32.0, help="Tamaño del stream sintético en MiB.")
+    parser.add_argument("--no-legacy", action="store_true", help="No medir el parser original.")
+    args = parser.parse_args()
+
+    check_chunk_splits()
+    print(f"{'frame':>10} {'chunk':>10} {'legacy us/f':>12} {'cl us/f':>10} {'cl ns/B':>8} "
+          f"{'markers us/f':>13} {'markers ns/B':>13}")
+    for frame_size in FRAME_SIZES:
+        n_frames = max(4, int(args.stream_mb * 1048576 // frame_size))
+        with_cl = synthetic_stream(frame_size, n_frames, content_length=True)
+        without_cl = synthetic_stream(frame_size, n_frames, content_length=False)
+        for chunk_size in CHUNK_SIZES:
+            chunks_cl = chunked(with_cl, chunk_size)
+            chunks_raw = chunked(without_cl, chunk_size)
+            legacy = "-" if args.no_legacy else f"{measure(legacy_parse, chunks_raw, n_frames, args.seconds):.1f}"
+            cl = measure(lambda c: extractor_parse(c, True), chunks_cl, n_frames, args.seconds)
+            markers = measure(lambda c: extractor_parse(c, False), chunks_raw, n_frames, args.seconds)
+            print(f"{frame_size:>10} {chunk_size:>10} {legacy:>12} {cl:>10.1f} {cl * 1e3 / frame_size:>8.3f} "
+                  f"{markers:>13.1f} {markers * 1e3 / frame_size:>13.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""Servidor local que imita a api-yolo para medir los grabadores sin GPU ni cámaras.
+
+Implementa los endpoints que usa `Model` (`/load_cameras_and_models`, `/start_process`,
+`/stop_process`, `/check_status`, `/get_results`, `/get_image`,
+`/get_image_n_detections`, `/get_camera_properties` y `/stream`). El stream es un
+multipart MJPEG con `Content-Length`, igual que el de api-yolo, con frames sintéticos
+o reproducidos desde un directorio de JPEG, a la resolución y FPS indicados. Cualquier
+nombre de cámara es válido.
+
+Las detecciones siguen al rectángulo de los frames sintéticos. Con `--activity-period`
+solo hay una persona en escena durante la primera mitad de cada periodo, para probar la
+grabación por eventos. Con `--drop-after` cada conexión a `/stream` se corta tras esos
+segundos, para probar las reconexiones. Con `--stall-period` el stream repite el mismo
+JPEG durante la segunda mitad de cada periodo, como api-yolo con una cámara bloqueada.
+
+`/bench_stats` devuelve los frames enviados por cámara para calcular pérdidas.
+
+Uso:
+    python bench/fake_api.py --port 3002 --width 1920 --height 1080 --fps 25
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+import numpy as np
+
+
+def synthetic_frames(width, height, count, quality=80):
+    """Genera `count` JPEG con un gradiente y un rectángulo en movimiento."""
+    x = np.linspace(0, 255, width, dtype=np.uint8)
+    y = np.linspace(0, 255, height, dtype=np.uint8)
+    base = np.dstack([np.tile(x, (height, 1)), np.tile(y[:, None], (1, width)),
+                      np.full((height, width), 96, np.uint8)])
+    frames = []
+    size = max(16, min(width, height) // 6)
+    for i in range(count):
+        image = base.copy()
+        left = int((width - size) * i / max(1, count - 1))
+        top = (height - size) // 2
+        cv2.rectangle(image, (left, top), (left + size, top + size), (255, 255, 255), -1)
+        cv2.putText(image, f"{i:04d}", (10, max(30, height // 12)), cv2.FONT_HERSHEY_SIMPLEX,
+                    max(1.0, height / 540), (0, 0, 255), 2)
+        ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        frames.append(encoded.tobytes())
+    return frames
+
+
+def replay_frames(directory):
+    """Carga los JPEG de un directorio en orden alfabético."""
+    frames = [path.read_bytes() for path in sorted(Path(directory).glob("*.jpg"))]
+    if not frames:
+        raise ValueError(f"No hay ficheros .jpg en {directory}")
+    return frames
+
+
+class FakeApiState:
+    def __init__(self, frames, fps, width, height, activity_period=0, drop_after=0, stall_period=0):
+        self.frames = frames
+        self.activity_period = activity_period
+        self.drop_after = drop_after
+        self.stall_period = stall_period
+        self.fps = fps
+        self.width = width
+        self.height = height
+        self.running = False
+        self.sent = {}
+        self.lock = threading.Lock()
+
+    def count(self, camera_name):
+        with self.lock:
+            self.sent[camera_name] = self.sent.get(camera_name, 0) + 1
+
+    def detections(self, camera_name, index):
+        """Una persona sintética que sigue al rectángulo de los frames generados."""
+        if self.activity_period and time.time() % self.activity_period >= self.activity_period / 2:
+            return []
+        x = (self.width * 0.8) * (index % len(self.frames)) / max(1, len(self.frames) - 1)
+        y = self.height * 0.3
+        return [{
+            "class_name": "person",
+            "confidence": 0.9,
+            "track_id": 1,
+            "bbox": [x, y, x + self.width * 0.1, y + self.height * 0.5],
+            "keypoints": [[x + 40, y + 20, 0.9], [x + 30, y + 10, 0.9], [x + 50, y + 10, 0.9],
+                          [x + 20, y + 15, 0.8], [x + 60, y + 15, 0.8]],
+        }]
+
+
+def make_handler(state):
+    class FakeApiHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, body, content_type="application/json", status=200):
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            path = urlparse(self.path).path
+            if path == "/start_process":
+                state.running = True
+            elif path == "/stop_process":
+                state.running = False
+            elif path != "/load_cameras_and_models" and not path.startswith("/update_camera_calibration"):
+                return self._send({"detail": "Not Found"}, status=404)
+            self._send({"message": "ok"})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            camera_name = query.get("camera_name", "cam")
+            index = int(time.time() * state.fps) % len(state.frames)
+            if url.path == "/stream":
+                return self._stream(camera_name)
+            if url.path == "/get_image":
+                return self._send(state.frames[index], "image/jpeg")
+            if url.path == "/get_image_n_detections":
+                return self._send({"detections": state.detections(camera_name, index), "timestamp": time.time()})
+            if url.path == "/check_status":
+                return self._send({"status": "running" if state.running else "stopped", "ready": True})
+            if url.path == "/get_results":
+                with state.lock:
+                    cameras = list(state.sent) or [camera_name]
+                return self._send({name: state.detections(name, index) for name in cameras})
+            if url.path == "/get_camera_properties":
+                return self._send({"width": state.width, "height": state.height, "fps": state.fps})
+            if url.path == "/bench_stats":
+                with state.lock:
+                    return self._send({"sent": dict(state.sent)})
+            self._send({"detail": "Not Found"}, status=404)
+
+        def _stream(self, camera_name):
+            self.send_response(200)
+            self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            interval = 1.0 / state.fps
+            next_time = time.monotonic()
+            end_time = next_time + state.drop_after if state.drop_after else float("inf")
+            index = 0
+            try:
+                while time.monotonic() < end_time:
+                    frame = state.frames[index % len(state.frames)]
+                    self.wfile.write(b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n"
+                                     % len(frame) + frame + b"\r\n")
+                    state.count(camera_name)
+                    # Durante la segunda mitad de cada `stall_period` se repite el mismo JPEG
+                    if not state.stall_period or time.time() % state.stall_period < state.stall_period / 2:
+                        index += 1
+                    next_time += interval
+                    delay = next_time - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+            except (BrokenPipeError, ConnectionResetError):
+                return
+
+    return FakeApiHandler
+
+
+def run_server(host="127.0.0.1", port=3002, width=1920, height=1080, fps=25, replay=None, quality=80,
+               activity_period=0, drop_after=0, stall_period=0):
+    """Arranca el servidor y bloquea hasta que se interrumpe."""
+    frames = replay_frames(replay) if replay else synthetic_frames(width, height, max(1, int(fps)), quality)
+    if replay:
+        width, height = cv2.imdecode(np.frombuffer(frames[0], np.uint8), cv2.IMREAD_COLOR).shape[1::-1]
+    state = FakeApiState(frames, fps, width, height, activity_period, drop_after, stall_period)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    print(f"fake api-yolo escuchando en http://{host}:{port} ({width}x{height} @ {fps} FPS)", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3002)
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--fps", type=float, default=25)
+    parser.add_argument("--quality", type=int, default=80, help="Calidad JPEG de los frames sintéticos.")
+    parser.add_argument("--replay", help="Directorio de JPEG a reproducir en bucle.")
+    parser.add_argument("--activity-period", type=float, default=0,
+                        help="Segundos de cada ciclo con/sin persona (0 = siempre hay una persona).")
+    parser.add_argument("--drop-after", type=float, default=0,
+                        help="Segundos tras los que se corta cada conexión a /stream (0 = nunca).")
+    parser.add_argument("--stall-period", type=float, default=0,
+                        help="Segundos de cada ciclo con/sin bloqueo: en la segunda mitad se repite el mismo "
+                             "frame (0 = nunca).")
+    args = parser.parse_args()
+    run_server(args.host, args.port, args.width, args.height, args.fps, args.replay, args.quality,
+               args.activity_period, args.drop_after, args.stall_period)
+
+
+if __name__ == "__main__":
+    main()
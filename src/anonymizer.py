@@ -0,0 +1,319 @@
+import time
+import logging
+import threading
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ANONYMIZE_CFG = {
+    "enabled": False,
+    "method": "pixelate",
+    "detect_every": 5,
+    "min_confidence": 0.3,
+    "margin": 0.4,
+    "min_size": 24,
+    "grow_per_second": 0.5,
+    "max_age_seconds": 1.0,
+    "bbox_fallback": True,
+    "fail_closed": True,
+    "pixel_size": 12,
+    "jpeg_quality": 90,
+}
+
+# Índices COCO de los keypoints de pose: nariz, ojos y orejas; hombros
+FACE_KEYPOINTS = slice(0, 5)
+SHOULDERS = (5, 6)
+
+
+def _as_keypoints(raw):
+    """Convierte los keypoints de una detección en un array (K, 3) con x, y, confianza."""
+    if isinstance(raw, dict):
+        xy = raw.get("xy") or raw.get("points") or []
+        conf = raw.get("conf") or raw.get("confidence") or [1.0] * len(xy)
+        raw = [[p[0], p[1], c] for p, c in zip(xy, conf)]
+    points = np.asarray(raw, dtype=np.float32)
+    if points.ndim != 2 or points.shape[0] == 0:
+        return None
+    if points.shape[1] == 2:
+        points = np.hstack([points, np.ones((len(points), 1), np.float32)])
+    return points[:, :3]
+
+
+def parse_detections(payload):
+    """Extrae (track_id, keypoints, bbox) de la respuesta de `get_image_n_detections`.
+
+    Acepta una lista de detecciones o un diccionario con la lista bajo `detections`,
+    `results` o el nombre de la cámara. Los keypoints pueden venir como listas
+    [x, y(, conf)] o como {"xy": ..., "conf": ...}.
+
+    Returns:
+        list[tuple]: (track_id | None, np.ndarray (K, 3) | None, list | None) por persona.
+    """
+    if isinstance(payload, dict):
+        for key in ("detections", "results", "predictions"):
+            if key in payload:
+                return parse_detections(payload[key])
+        lists = [value for value in payload.values() if isinstance(value, list)]
+        return parse_detections(lists[0]) if len(lists) == 1 else []
+    people = []
+    for detection in payload or []:
+        if not isinstance(detection, dict):
+            continue
+        keypoints = detection.get("keypoints")
+        bbox = detection.get("bbox") or detection.get("box")
+        if isinstance(bbox, dict):
+            bbox = [bbox.get(k) for k in ("x1", "y1", "x2", "y2")]
+        track_id = detection.get("track_id", detection.get("id"))
+        people.append((track_id, _as_keypoints(keypoints) if keypoints else None, bbox))
+    return people
+
+
+def face_boxes(keypoints, min_confidence=0.3, margin=0.4, min_size=24):
+    """Cajas de cara (x1, y1, x2, y2) a partir de los keypoints de pose de N personas.
+
+    El centro es la media de los keypoints faciales visibles. El lado es la mayor
+    dispersión entre ellos ampliada por `margin`, y nunca menor que el 60% del ancho de
+    hombros ni que `min_size`, para cubrir caras de perfil con un solo punto visible.
+
+    Args:
+        keypoints (np.ndarray): Array (N, K, 3) con x, y y confianza.
+
+    Returns:
+        tuple: (cajas (M, 4), índices (M,) de las personas con cara visible).
+    """
+    if keypoints.size == 0:
+        return np.empty((0, 4), np.float32), np.empty(0, int)
+    face = keypoints[:, FACE_KEYPOINTS]
+    visible = face[..., 2] >= min_confidence
+    people = np.flatnonzero(visible.any(axis=1))
+    if not len(people):
+        return np.empty((0, 4), np.float32), people
+    visible = visible[people]
+    x = np.where(visible, face[people, :, 0], np.nan)
+    y = np.where(visible, face[people, :, 1], np.nan)
+    cx, cy = np.nanmean(x, axis=1), np.nanmean(y, axis=1)
+    spread = np.maximum(np.nanmax(x, axis=1) - np.nanmin(x, axis=1), np.nanmax(y, axis=1) - np.nanmin(y, axis=1))
+    size = np.maximum(spread * (1 + 2 * margin), min_size)
+    if keypoints.shape[1] > max(SHOULDERS):
+        shoulders = keypoints[people][:, SHOULDERS]
+        both = (shoulders[..., 2] >= min_confidence).all(axis=1)
+        width = np.abs(shoulders[:, 0, 0] - shoulders[:, 1, 0])
+        size = np.where(both, np.maximum(size, width * 0.6), size)
+    # La frente queda por encima de ojos y orejas
+    cy = cy - size * 0.1
+    half = size / 2
+    return np.stack([cx - half, cy - half, cx + half, cy + half], axis=1).astype(np.float32), people
+
+
+def head_from_bbox(bbox):
+    """Franja superior de la caja de una persona sin keypoints faciales fiables."""
+    x1, y1, x2, y2 = map(float, bbox[:4])
+    return [x1, y1, x2, y1 + min((y2 - y1) * 0.25, x2 - x1)]
+
+
+def anonymize_regions(image, boxes, method="pixelate", pixel_size=12):
+    """Pixela o difumina in situ las regiones `boxes` (x1, y1, x2, y2) de `image`."""
+    height, width = image.shape[:2]
+    boxes = np.round(boxes).astype(int)
+    boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, width)
+    boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, height)
+    for x1, y1, x2, y2 in boxes:
+        if x2 - x1 < 2 or y2 - y1 < 2:
+            continue
+        roi = image[y1:y2, x1:x2]
+        small = (max(1, (x2 - x1) // pixel_size), max(1, (y2 - y1) // pixel_size))
+        reduced = cv2.resize(roi, small, interpolation=cv2.INTER_AREA)
+        if method == "blur":
+            # Difuminar la versión reducida y ampliarla equivale a un kernel enorme a bajo coste
+            reduced = cv2.GaussianBlur(reduced, (3, 3), 0)
+            roi[...] = cv2.resize(reduced, (x2 - x1, y2 - y1), interpolation=cv2.INTER_LINEAR)
+        else:
+            roi[...] = cv2.resize(reduced, (x2 - x1, y2 - y1), interpolation=cv2.INTER_NEAREST)
+
+
+class FaceTracker:
+    def __init__(self, max_age=1.0, grow_per_second=0.5):
+        """
+        Mantiene las caras entre dos detecciones con un modelo de velocidad constante.
+
+        Cada pista guarda su última caja y su velocidad; `predict` la desplaza hasta el
+        instante pedido y la amplía `grow_per_second` por segundo transcurrido para
+        cubrir el error de la predicción. Las pistas sin detección durante `max_age`
+        segundos se eliminan.
+        """
+        self.max_age = max_age
+        self.grow_per_second = grow_per_second
+        self.tracks = {}
+        self.last_update = None
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def update(self, timestamp, boxes, track_ids):
+        with self._lock:
+            tracks = {}
+            # Primero las caras con identificador, para que una caja sin él no les quite la pista
+            taken = {track_id for track_id in track_ids if track_id is not None}
+            for box, track_id in zip(boxes, track_ids):
+                if track_id is None:
+                    track_id = self._match(box, taken)
+                    taken.add(track_id)
+                previous = self.tracks.get(track_id)
+                velocity = np.zeros(4, np.float32)
+                if previous is not None and timestamp > previous["timestamp"]:
+                    velocity = (box - previous["box"]) / (timestamp - previous["timestamp"])
+                tracks[track_id] = {"box": box, "velocity": velocity, "timestamp": timestamp}
+            # Las pistas no vistas en esta detección se conservan hasta caducar
+            for track_id, track in self.tracks.items():
+                if track_id not in tracks and timestamp - track["timestamp"] <= self.max_age:
+                    tracks[track_id] = track
+            self.tracks = tracks
+            self.last_update = timestamp
+
+    def _match(self, box, taken=()):
+        """Asocia una caja sin identificador a la pista libre más cercana, o abre una nueva.
+
+        Cada pista se asigna como mucho a una caja por detección (`taken`), así que dos
+        caras cercanas nunca comparten identificador.
+        """
+        best, best_distance = None, None
+        center = (box[:2] + box[2:]) / 2
+        for track_id, track in self.tracks.items():
+            if track_id in taken:
+                continue
+            distance = np.linalg.norm(center - (track["box"][:2] + track["box"][2:]) / 2)
+            if distance < (box[2] - box[0]) and (best_distance is None or distance < best_distance):
+                best, best_distance = track_id, distance
+        if best is None:
+            self._next_id += 1
+            best = f"auto{self._next_id}"
+        return best
+
+    def predict(self, timestamp):
+        """Cajas previstas en `timestamp` como array (N, 4)."""
+        with self._lock:
+            tracks = [t for t in self.tracks.values() if abs(timestamp - t["timestamp"]) <= self.max_age]
+        if not tracks:
+            return np.empty((0, 4), np.float32)
+        boxes = np.stack([t["box"] for t in tracks])
+        velocity = np.stack([t["velocity"] for t in tracks])
+        age = np.array([timestamp - t["timestamp"] for t in tracks], np.float32)[:, None]
+        boxes = boxes + velocity * np.clip(age, 0, None)
+        grow = (boxes[:, 2:] - boxes[:, :2]) * self.grow_per_second * np.abs(age) / 2
+        return np.hstack([boxes[:, :2] - grow, boxes[:, 2:] + grow])
+
+
+class FaceAnonymizer:
+    def __init__(self, camera_name, model, anonymize_cfg=None):
+        """
+        Borrado local de caras a partir de los keypoints de pose de api-yolo.
+
+        Las detecciones se piden con `get_image_n_detections` solo cada `detect_every`
+        frames y en un hilo aparte, así que el stream se graba a los FPS completos de la
+        cámara aunque la inferencia vaya más lenta. Entre detecciones `FaceTracker`
+        prevé la posición de cada cara.
+
+        Args:
+            camera_name (str): Nombre de la cámara.
+            model (Model): Cliente de api-yolo.
+            anonymize_cfg (dict, optional): Sección `anonymize` de cfg.json.
+        """
+        self.camera_name = camera_name
+        self.model = model
+        self.cfg = {**DEFAULT_ANONYMIZE_CFG, **(anonymize_cfg or {})}
+        self.tracker = FaceTracker(self.cfg["max_age_seconds"], self.cfg["grow_per_second"])
+        self.detect_every = max(1, int(self.cfg["detect_every"]))
+        self.normalized = False
+        self.requests = 0
+        self.errors = 0
+        self.frames_anonymized = 0
+        self._frames = 0
+        self._in_flight = threading.Lock()
+        self._closed = False
+
+    def on_frame(self):
+        """Cuenta un frame recibido y lanza una detección cada `detect_every` frames."""
+        self._frames += 1
+        if self._frames % self.detect_every == 1 or self.detect_every == 1:
+            # Si la petición anterior sigue en curso no se encola otra
+            if not self._closed and self._in_flight.acquire(blocking=False):
+                threading.Thread(target=self._detect, name=f"{self.camera_name}-detect", daemon=True).start()
+
+    def _detect(self):
+        try:
+            sent = time.time()
+            payload = self.model.get_image_n_detections(
+                self.camera_name, processed=False, show_confidence=False, show_id=False, show_speed=False,
+                show_position=False, show_estela=False, show_keypoints=False, show_contours=False
+            )
+            self.requests += 1
+            # Se usa la hora local de la petición: el reloj de api-yolo puede no coincidir
+            self._update(payload, sent)
+        except Exception as e:
+            self.errors += 1
+            if self.errors == 1 or self.errors % 100 == 0:
+                logger.error(f"{self.camera_name}: Error obteniendo detecciones ({self.errors}): {e}")
+        finally:
+            self._in_flight.release()
+
+    def _update(self, payload, timestamp):
+        people = parse_detections(payload)
+        boxes, ids = [], []
+        with_keypoints = [p for p in people if p[1] is not None]
+        if with_keypoints:
+            count = max(len(p[1]) for p in with_keypoints)
+            keypoints = np.zeros((len(with_keypoints), count, 3), np.float32)
+            for i, (_, points, _) in enumerate(with_keypoints):
+                keypoints[i, :len(points)] = points
+            self.normalized = bool(keypoints[..., :2].max() <= 1.0)
+            min_size = 0 if self.normalized else self.cfg["min_size"]
+            faces, index = face_boxes(keypoints, self.cfg["min_confidence"], self.cfg["margin"], min_size)
+            boxes += list(faces)
+            ids += [with_keypoints[i][0] for i in index]
+            covered = set(index.tolist())
+            missing = [p for i, p in enumerate(with_keypoints) if i not in covered]
+        else:
+            missing = []
+        if self.cfg["bbox_fallback"]:
+            for track_id, _, bbox in missing + [p for p in people if p[1] is None]:
+                if bbox is not None:
+                    boxes.append(np.asarray(head_from_bbox(bbox), np.float32))
+                    ids.append(track_id)
+        self.tracker.update(timestamp, boxes, ids)
+
+    def boxes_at(self, timestamp, frame_size):
+        """Caras previstas en `timestamp`, en píxeles del frame (ancho, alto)."""
+        if self.cfg["fail_closed"] and self._stale(timestamp):
+            width, height = frame_size
+            return np.array([[0, 0, width, height]], np.float32)
+        boxes = self.tracker.predict(timestamp)
+        if self.normalized and len(boxes):
+            boxes = boxes * np.array(frame_size * 2, np.float32)
+        return boxes
+
+    def _stale(self, timestamp):
+        last = self.tracker.last_update
+        return last is None or timestamp - last > self.cfg["max_age_seconds"]
+
+    def apply(self, image, boxes):
+        """Borra las caras `boxes` de `image` (in situ)."""
+        anonymize_regions(image, boxes, self.cfg["method"], int(self.cfg["pixel_size"]))
+        self.frames_anonymized += 1
+
+    def encode(self, image):
+        """Re-codifica a JPEG un frame anonimizado (encoders que solo aceptan JPEG)."""
+        ok, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, int(self.cfg["jpeg_quality"])])
+        if not ok:
+            raise RuntimeError(f"{self.camera_name}: No se pudo re-codificar el frame anonimizado")
+        return encoded.tobytes()
+
+    def close(self):
+        self._closed = True
+
+
+def create_anonymizer(camera_name, model, anonymize_cfg=None):
+    """Crea el anonimizador si la sección `anonymize` de cfg.json lo activa."""
+    if not (anonymize_cfg or {}).get("enabled"):
+        return None
+    return FaceAnonymizer(camera_name, model, anonymize_cfg)
@@ -0,0 +1,142 @@
+import json
+import time
+
+import aiohttp
+
+from frame_extractor import MJPEGFrameExtractor, boundary_from_content_type
+
+
+def _query(params):
+    """Serialize query params the same way `requests` does (aiohttp rejects booleans)."""
+    return {key: str(value) if isinstance(value, bool) else value for key, value in params.items()}
+
+
+class AsyncModel:
+    def __init__(self, uri_device, cfg_path, timeout=200, pool_maxsize=100, keepalive_timeout=60):
+        """Asyncio counterpart of `Model` built on a pooled `aiohttp.ClientSession`.
+
+        A single event loop can drive every camera stream: connections are kept alive
+        and reused, and `stream` yields frames without dedicating a thread per camera.
+        Use it as an async context manager, or call `close` when done.
+
+        Args:
+            uri_device (str): Base URL of the API. E.g., "http://api:5001".
+            cfg_path (str): Path to the configuration file.
+            timeout (int, optional): Timeout for API requests. Defaults to 200.
+            pool_maxsize (int, optional): Maximum simultaneous connections. Defaults to 100.
+            keepalive_timeout (float, optional): Seconds to keep idle connections. Defaults to 60.
+        """
+        self.uri = uri_device
+        self.cfg_path = cfg_path
+        self.timeout = timeout
+        self.pool_maxsize = pool_maxsize
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_maxsize, keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
+    async def close(self):
+        """Close the pooled connections."""
+        if self._session is not None:
+            await self._session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _request(self, method, endpoint, error, params=None, as_json=True):
+        url = f"{self.uri}/{endpoint}"
+        async with self.session.request(method, url, params=_query(params or {})) as response:
+            if not response.ok:
+                raise Exception(error)
+            if as_json:
+                return await response.json(content_type=None)
+            return await response.read()
+
+    async def load_cameras_and_models(self):
+        """Async version of `Model.load_cameras_and_models`."""
+        return await self._request("POST", "load_cameras_and_models", "Failed to load cameras and models",
+                                   params={'cfg_path': self.cfg_path})
+
+    async def start_process(self):
+        """Async version of `Model.start_process`."""
+        return await self._request("POST", "start_process", "Failed to start the process")
+
+    async def stop_process(self):
+        """Async version of `Model.stop_process`."""
+        return await self._request("POST", "stop_process", "Failed to stop the process")
+
+    async def check_status(self):
+        """Async version of `Model.check_status`."""
+        return await self._request("GET", "check_status", "Failed to check the status")
+
+    async def get_results(self):
+        """Async version of `Model.get_results`."""
+        return await self._request("GET", "get_results", "Failed to get the results")
+
+    async def get_image(self, camera_name, processed=True, **options):
+        """Async version of `Model.get_image`; `options` accepts the same display flags."""
+        params = {'camera_name': camera_name, 'processed': processed, **options}
+        return await self._request("GET", "get_image", "Failed to get the image", params=params, as_json=False)
+
+    async def get_image_n_detections(self, camera_name, processed=True, **options):
+        """Async version of `Model.get_image_n_detections`; `options` accepts the same display flags."""
+        params = {'camera_name': camera_name, 'processed': processed, **options}
+        return await self._request("GET", "get_image_n_detections", "Failed to get the image and detections",
+                                   params=params)
+
+    async def get_calibration(self, camera_name):
+        """Async version of `Model.get_calibration`."""
+        return await self._request("GET", "get_calibration", "Failed to get the calibration plot",
+                                   params={'camera_name': camera_name}, as_json=False)
+
+    async def get_camera_properties(self, camera_name):
+        """Async version of `Model.get_camera_properties`."""
+        return await self._request("GET", "get_camera_properties", "Failed to get camera properties",
+                                   params={'camera_name': camera_name})
+
+    async def update_camera_calibration(self, camera_name, roi=None, target=None):
+        """Async version of `Model.update_camera_calibration`."""
+        params = {}
+        if roi is not None:
+            params['roi'] = json.dumps(roi)
+        if target is not None:
+            params['target'] = json.dumps(target)
+        return await self._request("POST", f"update_camera_calibration/{camera_name}",
+                                   "Failed to update camera calibration", params=params)
+
+    async def stream(self, camera_name, processed=False, read_timeout=10):
+        """Async generator over the JPEG frames of a camera's `/stream`.
+
+        Each frame is a `memoryview` that is only valid until the next iteration; copy
+        it with `bytes(frame)` to keep it.
+
+        Args:
+            camera_name (str): The name of the camera.
+            processed (bool): Whether to stream the processed image. Defaults to False.
+            read_timeout (float, optional): Maximum seconds without data. Defaults to 10.
+
+        Yields:
+            tuple: (timestamp, frame) with the arrival time and the JPEG data.
+        """
+        url = f"{self.uri}/stream"
+        params = _query({'camera_name': camera_name, 'processed': processed})
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=read_timeout)
+        async with self.session.get(url, params=params, timeout=timeout) as response:
+            if not response.ok:
+                raise Exception("Failed to open the stream")
+            extractor = MJPEGFrameExtractor(boundary=boundary_from_content_type(response.headers.get("Content-Type")))
+            async for chunk in response.content.iter_any():
+                timestamp = time.time()
+                for frame in extractor.feed(chunk):
+                    yield timestamp, frame
@@ -0,0 +1,159 @@
+"""Extracción de clips por hora de captura usando los índices de frames de cada segmento.
+
+Uso:
+    python clips.py cam1 "2024-10-17 10:00:00" "2024-10-17 10:00:30" -o clip.mp4
+"""
+import os
+import re
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from frame_index import INDEX_SUFFIX, read_index
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_DIR_FORMAT = "%Y%m%d_%H%M%S"
+
+
+def parse_time(value):
+    """Acepta segundos desde epoch o una fecha ISO (`2024-10-17 10:00:00`) en hora local."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return datetime.fromisoformat(str(value)).timestamp()
+
+
+def find_segments(base_dir, camera_name, start, end):
+    """Segmentos de `camera_name` con algún frame capturado entre `start` y `end`.
+
+    Solo se leen los índices de los directorios que empiezan antes de `end`.
+
+    Returns:
+        list[tuple]: (video_path, FrameIndex) ordenados por hora de captura.
+    """
+    pattern = re.compile(rf"^{re.escape(camera_name)}(_\d{{6}})?\.\w+{re.escape(INDEX_SUFFIX)}$")
+    segments = []
+    for directory in sorted(Path(base_dir).iterdir()):
+        try:
+            dir_start = datetime.strptime(directory.name, SEGMENT_DIR_FORMAT).timestamp()
+        except ValueError:
+            continue
+        if not directory.is_dir() or dir_start > end:
+            continue
+        for path in directory.iterdir():
+            if not pattern.match(path.name):
+                continue
+            video_path = path.with_name(path.name[:-len(INDEX_SUFFIX)])
+            try:
+                index = read_index(path)
+            except (OSError, ValueError) as e:
+                logger.error(f"No se pudo leer el índice {path}: {e}")
+                continue
+            if len(index) and video_path.exists() and index.start <= end and index.end >= start:
+                segments.append((video_path, index))
+    segments.sort(key=lambda segment: segment[1].start)
+    return segments
+
+
+def _cut(video_path, index, start, end, output_path):
+    """Recorta un segmento con copia de stream desde el keyframe anterior a `start`.
+
+    Returns:
+        tuple | None: (hora de captura del primer frame, del último) o None si no hay frames.
+    """
+    first = index.frame_at(start)
+    last = int(np.searchsorted(index.times, end, side="right")) - 1
+    if first > last:
+        return None
+    # Con copia de stream el clip solo puede empezar en un keyframe
+    keyframe = index.keyframe_before(first)
+    seek = index.pts(keyframe if index.complete else first)
+    duration = index.pts(last + 1) - seek
+    subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-ss", f"{seek:.6f}", "-i", str(video_path),
+                    "-t", f"{duration:.6f}", "-map", "0:v", "-c", "copy", "-avoid_negative_ts", "make_zero",
+                    str(output_path)], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return float(index.times[keyframe if index.complete else first]), float(index.times[last])
+
+
+def extract_clip(camera_name, start, end, output_path, base_dir="../files"):
+    """Extrae el clip de `camera_name` entre dos horas de captura sin re-codificar.
+
+    Se buscan los segmentos por su índice de frames, se recorta cada uno desde el
+    keyframe anterior a `start` con `-c copy` y, si el intervalo abarca varios
+    segmentos, se concatenan los trozos con el demuxer `concat`.
+
+    Args:
+        camera_name (str): Nombre de la cámara.
+        start (float): Inicio (segundos desde epoch).
+        end (float): Fin (segundos desde epoch).
+        output_path (Path): Clip de salida; conviene usar la extensión de los segmentos.
+        base_dir (Path, optional): Directorio raíz de grabaciones. Defaults to "../files".
+
+    Returns:
+        dict: Ruta, hora real de inicio y fin del clip y segmentos usados.
+
+    Raises:
+        FileNotFoundError: Si no hay grabaciones de la cámara en el intervalo.
+    """
+    output_path = Path(output_path)
+    segments = find_segments(base_dir, camera_name, start, end)
+    if not segments:
+        raise FileNotFoundError(f"No hay grabaciones de {camera_name} entre {datetime.fromtimestamp(start)} "
+                                f"y {datetime.fromtimestamp(end)}")
+    work_dir = Path(tempfile.mkdtemp(prefix=f".{output_path.stem}_", dir=output_path.parent))
+    try:
+        parts = []
+        bounds = []
+        for i, (video_path, index) in enumerate(segments):
+            part = work_dir / f"{i:03d}{video_path.suffix}"
+            cut = _cut(video_path, index, start, end, part)
+            if cut is not None:
+                parts.append(part)
+                bounds.append(cut)
+        if not parts:
+            raise FileNotFoundError(f"No hay frames de {camera_name} en el intervalo pedido")
+        if len(parts) == 1:
+            os.replace(parts[0], output_path)
+        else:
+            concat_list = work_dir / "parts.txt"
+            concat_list.write_text("".join(f"file '{part.resolve()}'\n" for part in parts))
+            subprocess.run(["ffmpeg", "-y", "-loglevel", "error", "-f", "concat", "-safe", "0",
+                            "-i", str(concat_list), "-c", "copy", str(output_path)],
+                           check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    try:
+        os.chmod(output_path, 0o777)
+    except Exception as e:
+        logger.error(f"Error al cambiar permisos del clip {output_path}: {e}")
+    return {
+        "path": output_path,
+        "start": bounds[0][0],
+        "end": bounds[-1][1],
+        "segments": [str(video_path) for video_path, _ in segments],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("camera", help="Nombre de la cámara.")
+    parser.add_argument("start", help="Inicio: fecha ISO en hora local o segundos desde epoch.")
+    parser.add_argument("end", help="Fin: fecha ISO en hora local o segundos desde epoch.")
+    parser.add_argument("-o", "--output", required=True, help="Fichero del clip.")
+    parser.add_argument("--base-dir", default="../files", help="Directorio raíz de grabaciones.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    clip = extract_clip(args.camera, parse_time(args.start), parse_time(args.end), args.output, args.base_dir)
+    print(f"Clip {clip['path']}: {datetime.fromtimestamp(clip['start'])} - {datetime.fromtimestamp(clip['end'])} "
+          f"({len(clip['segments'])} segmentos)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+import os
+import time
+import logging
+import subprocess
+from array import array
+
+import cv2
+import numpy as np
+
+from frame_index import index_path, write_index
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ENCODER_CFG = {
+    "backend": "ffmpeg",
+    "codec": "libx264",
+    "preset": "veryfast",
+    "crf": 23,
+    "bitrate": None,
+    "pix_fmt": "yuv420p",
+    "input": "raw",
+    "keyframe_seconds": None,
+    "max_fill_seconds": 2.0,
+    "index": True,
+}
+
+
+class OpenCVEncoder:
+    def __init__(self, output_path, frame_size, fps, index=True):
+        """
+        Encoder original basado en `cv2.VideoWriter` (mp4v a FPS fijo).
+
+        Los timestamps se ignoran, así que el vídeo necesita una segunda pasada con
+        `adjust_video_fps` para corregir la duración (`needs_fps_fix`).
+
+        Args:
+            output_path (Path): Ruta del vídeo de salida.
+            frame_size (tuple): (ancho, alto) de los frames.
+            fps (float): FPS nominales del contenedor.
+            index (bool, optional): Escribir el índice de frames al cerrar. Defaults to True.
+        """
+        self.output_path = output_path
+        self.frame_size = tuple(frame_size)
+        self.fps = float(fps)
+        self.needs_fps_fix = True
+        self.decode_free = False
+        self.frames_written = 0
+        self.frame_times = array("d") if index else None
+        self.writer = cv2.VideoWriter(
+            str(output_path),
+            cv2.VideoWriter_fourcc(*"mp4v"),
+            fps,
+            self.frame_size
+        )
+
+    def write(self, frame, timestamp=None):
+        self.writer.write(frame)
+        self.frames_written += 1
+        if self.frame_times is not None:
+            self.frame_times.append(timestamp or time.time())
+
+    def write_jpeg(self, data, timestamp=None):
+        frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if frame is not None:
+            self.write(frame, timestamp)
+
+    def release(self):
+        self.writer.release()
+        _write_frame_index(self.output_path, self.frame_times, self.fps)
+
+    def discard(self):
+        """Cierra un encoder que no llegó a escribir frames y borra su fichero."""
+        self.writer.release()
+        _remove_output(self.output_path)
+
+
+class FFmpegPipeEncoder:
+    def __init__(self, output_path, frame_size, fps, codec="libx264", preset="veryfast", crf=23,
+                 pix_fmt="yuv420p", input="raw", ffmpeg_bin="ffmpeg", extra_args=None, bitrate=None,
+                 keyframe_seconds=None, max_fill_seconds=2.0, index=True):
+        """
+        Codifica los frames en una sola pasada a través de un proceso ffmpeg persistente.
+
+        Los frames se envían por stdin, como BGR crudo (`input="raw"`) o como los JPEG
+        originales (`input="jpeg"`), y el fichero queda finalizado al cerrar el segmento.
+
+        La salida es CFR correcta: cada frame se coloca en la rejilla de `fps` según su
+        timestamp real de captura, duplicando el último frame para cubrir huecos y
+        descartando los que llegan antes de su hueco. Así la duración del vídeo coincide
+        con el tiempo de pared sin necesidad de re-codificar después. Un hueco de más de
+        `max_fill_seconds` (pausa por disco lleno o por carga, reconexión de la cámara) no
+        se rellena: la rejilla continúa tras el último frame escrito y el salto queda
+        reflejado en el índice, que guarda la hora real de captura.
+
+        Args:
+            output_path (Path): Ruta del vídeo de salida.
+            frame_size (tuple): (ancho, alto) de los frames.
+            fps (float): FPS de la rejilla CFR.
+            codec (str): Codec de vídeo de ffmpeg. Defaults to "libx264".
+            preset (str, optional): Preset del codec. Defaults to "veryfast".
+            crf (int, optional): Factor de calidad constante. Defaults to 23.
+            pix_fmt (str, optional): Formato de píxel de salida. Defaults to "yuv420p".
+            input (str): "raw" (BGR) o "jpeg". Defaults to "raw".
+            ffmpeg_bin (str): Ejecutable de ffmpeg. Defaults to "ffmpeg".
+            extra_args (list, optional): Argumentos de salida adicionales.
+            bitrate (str, optional): Bitrate objetivo (p. ej. "800k"); sustituye a `crf`.
+            keyframe_seconds (float, optional): Intervalo máximo entre keyframes; acota el
+                margen de los clips extraídos con copia de stream.
+            max_fill_seconds (float, optional): Hueco máximo que se rellena repitiendo el
+                último frame; None rellena cualquier hueco. Defaults to 2.0.
+            index (bool, optional): Escribir al cerrar el índice con la hora de captura de
+                cada frame de la rejilla (`<vídeo>.idx`). Defaults to True.
+        """
+        if input not in ("raw", "jpeg"):
+            raise ValueError(f"Entrada no soportada: {input}")
+
+        self.output_path = output_path
+        self.frame_size = tuple(int(v) for v in frame_size)
+        self.fps = float(fps)
+        self.input = input
+        self.needs_fps_fix = False
+        # Con entrada JPEG el grabador puede entregar los frames sin decodificarlos
+        self.decode_free = input == "jpeg"
+
+        self.frames_written = 0
+        self.frames_duplicated = 0
+        self.frames_dropped = 0
+        self.max_fill = None if max_fill_seconds is None else max(0, round(max_fill_seconds * self.fps))
+        self.frame_times = array("d") if index else None
+        self._start_ts = None
+        self._last_payload = None
+        self._last_ts = None
+
+        self.command = self._build_command(ffmpeg_bin, codec, preset, crf, pix_fmt, extra_args or [], bitrate,
+                                           keyframe_seconds)
+        self.process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+
+    def _build_command(self, ffmpeg_bin, codec, preset, crf, pix_fmt, extra_args, bitrate=None,
+                       keyframe_seconds=None):
+        width, height = self.frame_size
+        command = [ffmpeg_bin, "-hide_banner", "-loglevel", "error", "-y"]
+        if self.input == "raw":
+            command += ["-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}",
+                        "-r", f"{self.fps:g}", "-i", "pipe:0"]
+        else:
+            command += ["-f", "image2pipe", "-c:v", "mjpeg", "-framerate", f"{self.fps:g}", "-i", "pipe:0"]
+
+        command += ["-an", "-c:v", codec]
+        if codec != "copy":
+            if preset:
+                command += ["-preset", str(preset)]
+            if bitrate:
+                command += ["-b:v", str(bitrate), "-maxrate", str(bitrate), "-bufsize", str(bitrate)]
+            elif crf is not None:
+                command += ["-crf", str(crf)]
+            if pix_fmt:
+                command += ["-pix_fmt", pix_fmt]
+            if keyframe_seconds:
+                command += ["-g", str(max(1, round(self.fps * keyframe_seconds)))]
+        command += ["-r", f"{self.fps:g}"]
+        command += list(extra_args)
+        command.append(str(self.output_path))
+        return command
+
+    def write(self, frame, timestamp=None):
+        """Escribe un frame BGR decodificado.
+
+        Args:
+            frame (np.ndarray): Frame BGR.
+            timestamp (float, optional): Tiempo de captura (`time.time()`). Defaults to ahora.
+        """
+        if self.input == "jpeg":
+            ok, encoded = cv2.imencode(".jpg", frame)
+            if ok:
+                self._emit(encoded.data, timestamp)
+            return
+        height, width = frame.shape[:2]
+        if (width, height) != self.frame_size:
+            frame = cv2.resize(frame, self.frame_size, interpolation=cv2.INTER_AREA)
+        self._emit(np.ascontiguousarray(frame).data, timestamp)
+
+    def write_jpeg(self, data, timestamp=None):
+        """Escribe un frame JPEG comprimido tal y como llegó del stream.
+
+        Args:
+            data (bytes | memoryview): Datos JPEG.
+            timestamp (float, optional): Tiempo de captura (`time.time()`). Defaults to ahora.
+        """
+        if self.input == "raw":
+            frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+            if frame is not None:
+                self.write(frame, timestamp)
+            return
+        # La vista puede apuntar a un buffer reutilizable: se copia si hay que repetirla
+        self._emit(bytes(data), timestamp)
+
+    def _emit(self, payload, timestamp):
+        if timestamp is None:
+            timestamp = time.time()
+        if self._start_ts is None:
+            self._start_ts = timestamp
+
+        slot = round((timestamp - self._start_ts) * self.fps)
+        if slot < self.frames_written:
+            # Llega antes de que le toque hueco en la rejilla
+            self.frames_dropped += 1
+            return
+        missing = slot - self.frames_written
+        if self.max_fill is not None and missing > self.max_fill:
+            # Hueco largo: repetir el último frame escribiría de golpe todo el tiempo perdido
+            logger.info(f"Hueco de {missing / self.fps:.1f}s en {self.output_path}: "
+                        f"se continúa sin rellenarlo.")
+            self._start_ts = timestamp - self.frames_written / self.fps
+            missing = 0
+        if self._last_payload is not None:
+            for _ in range(missing):
+                self._pipe(self._last_payload, self._last_ts)
+                self.frames_duplicated += 1
+        self._pipe(payload, timestamp)
+        # Los frames decodificados son arrays nuevos y los JPEG ya se copiaron en write_jpeg
+        self._last_payload = payload
+        self._last_ts = timestamp
+
+    def _pipe(self, payload, timestamp):
+        try:
+            self.process.stdin.write(payload)
+            self.frames_written += 1
+            if self.frame_times is not None:
+                # Los duplicados repiten la hora de captura del frame que muestran
+                self.frame_times.append(timestamp)
+        except (BrokenPipeError, OSError) as e:
+            raise RuntimeError(f"ffmpeg terminó inesperadamente escribiendo {self.output_path}: {e}") from e
+
+    def release(self):
+        """Cierra stdin y espera a que ffmpeg finalice el fichero."""
+        try:
+            if self.process.stdin and not self.process.stdin.closed:
+                self.process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        returncode = self.process.wait()
+        self._last_payload = None
+        if returncode != 0:
+            logger.error(f"ffmpeg terminó con código {returncode} al generar {self.output_path}")
+        try:
+            os.chmod(self.output_path, 0o777)
+        except Exception as e:
+            logger.error(f"Error al cambiar permisos del video {self.output_path}: {e}")
+        _write_frame_index(self.output_path, self.frame_times, self.fps)
+
+    def discard(self):
+        """Termina ffmpeg sin finalizar el vídeo y borra el fichero (encoder sin frames)."""
+        self.process.kill()
+        try:
+            if self.process.stdin and not self.process.stdin.closed:
+                self.process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.wait()
+        self._last_payload = None
+        _remove_output(self.output_path)
+
+
+def _remove_output(output_path):
+    try:
+        os.remove(output_path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error(f"Error borrando {output_path}: {e}")
+
+
+def _write_frame_index(output_path, frame_times, fps):
+    if not frame_times:
+        return
+    try:
+        write_index(index_path(output_path), np.frombuffer(frame_times, np.float64), fps)
+    except Exception as e:
+        logger.error(f"Error escribiendo el índice de frames de {output_path}: {e}")
+
+
+def output_extension(encoder_cfg=None):
+    """Extensión del vídeo de salida según el backend configurado.
+
+    El modo passthrough guarda los JPEG tal cual, así que necesita un contenedor que
+    admita MJPEG (`container`: "mkv" o "avi"); el resto genera mp4.
+    """
+    cfg = encoder_cfg or {}
+    if cfg.get("backend") == "passthrough":
+        return f".{cfg.get('container', 'mkv')}"
+    return ".mp4"
+
+
+def create_encoder(output_path, frame_size, fps, encoder_cfg=None):
+    """Crea el encoder configurado en la sección `encoder` de cfg.json.
+
+    Args:
+        output_path (Path): Ruta del vídeo de salida.
+        frame_size (tuple): (ancho, alto) de los frames.
+        fps (float): FPS objetivo.
+        encoder_cfg (dict, optional): Configuración del encoder; se completa con
+            `DEFAULT_ENCODER_CFG`.
+
+    Returns:
+        FFmpegPipeEncoder | OpenCVEncoder: Encoder listo para `write`/`write_jpeg`/`release`.
+    """
+    cfg = {**DEFAULT_ENCODER_CFG, **(encoder_cfg or {})}
+    backend = cfg.pop("backend")
+    if backend == "passthrough":
+        # Los JPEG recibidos se copian al contenedor sin decodificar ni re-codificar
+        return FFmpegPipeEncoder(output_path, frame_size, fps, codec="copy", input="jpeg",
+                                 ffmpeg_bin=cfg.get("ffmpeg_bin", "ffmpeg"),
+                                 extra_args=cfg.get("extra_args"), max_fill_seconds=cfg["max_fill_seconds"],
+                                 index=cfg["index"])
+    if backend == "opencv":
+        return OpenCVEncoder(output_path, frame_size, fps, index=cfg["index"])
+    if backend == "ffmpeg":
+        return FFmpegPipeEncoder(output_path, frame_size, fps, **cfg)
+    raise ValueError(f"Backend de encoder no soportado: {backend}")
@@ -0,0 +1,256 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+SOI = b"\xff\xd8"
+EOI = b"\xff\xd9"
+HEADER_END = b"\r\n\r\n"
+
+
+def boundary_from_content_type(content_type):
+    """Extrae el boundary de una cabecera `multipart/x-mixed-replace; boundary=frame`.
+
+    Args:
+        content_type (str): Valor de la cabecera Content-Type de la respuesta.
+
+    Returns:
+        bytes | None: Boundary sin el prefijo `--`, o None si no viene indicado.
+    """
+    if not content_type:
+        return None
+    for param in content_type.split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key.lower() == "boundary" and value:
+            value = value.strip().strip('"')
+            if value.startswith("--"):
+                value = value[2:]
+            return value.encode("latin-1")
+    return None
+
+
+def parse_part_headers(raw):
+    """Convierte el bloque de cabeceras de una parte multipart en un diccionario."""
+    headers = {}
+    for line in raw.split(b"\r\n"):
+        key, sep, value = line.partition(b":")
+        if sep:
+            headers[key.strip().lower().decode("latin-1")] = value.strip().decode("latin-1")
+    return headers
+
+
+class MJPEGFrameExtractor:
+    def __init__(self, boundary=None, initial_capacity=4 * 1048576, max_buffer=64 * 1048576):
+        """
+        Extrae frames JPEG de un stream MJPEG (multipart/x-mixed-replace) en tiempo lineal.
+
+        Los bytes se copian una única vez a un buffer `bytearray` reutilizable y cada
+        búsqueda se reanuda donde terminó la anterior, de modo que ningún byte se examina
+        dos veces. Los frames se devuelven como `memoryview` sobre ese buffer, sin copia.
+
+        Si se conoce el boundary, se usan las cabeceras de cada parte y, cuando está
+        presente, `Content-Length` para cortar el frame sin buscar marcadores. Sin
+        boundary, o sin `Content-Length`, se delimita el frame por los marcadores
+        SOI (FFD8) y EOI (FFD9).
+
+        Las vistas devueltas por `feed` solo son válidas hasta la siguiente llamada a
+        `feed`; quien necesite conservar un frame debe copiarlo con `bytes(frame)`.
+
+        Args:
+            boundary (bytes | str, optional): Boundary multipart (sin `--`). Defaults to None.
+            initial_capacity (int): Tamaño inicial del buffer en bytes. Defaults to 4 MiB.
+            max_buffer (int): Máximo de bytes pendientes antes de descartar y resincronizar.
+                Defaults to 64 MiB.
+        """
+        if isinstance(boundary, str):
+            boundary = boundary.encode("latin-1")
+        self.delimiter = b"--" + boundary if boundary else None
+        self.max_buffer = max_buffer
+
+        self._buf = bytearray(initial_capacity)
+        self._view = memoryview(self._buf)
+        self._r = 0  # Inicio de los datos no consumidos
+        self._w = 0  # Fin de los datos recibidos
+        self._scan = 0  # Offset desde el que reanudar la búsqueda pendiente
+
+        # Estado de la parte actual
+        self._body = None  # Inicio del cuerpo del frame (SOI) si ya se localizó
+        self._length = None  # Content-Length de la parte actual si se conoce
+        self._in_part = False  # Cabeceras leídas sin Content-Length: falta el SOI del cuerpo
+
+        self.frames = 0
+        self.bytes_in = 0
+        self.resyncs = 0
+
+    @property
+    def pending(self):
+        """Bytes recibidos que aún no forman parte de un frame completo."""
+        return self._w - self._r
+
+    def feed(self, chunk):
+        """Añade un chunk del stream y devuelve los frames completos que contiene.
+
+        Args:
+            chunk (bytes): Datos recibidos de la red.
+
+        Returns:
+            list[memoryview]: Frames JPEG completos, en orden de llegada.
+        """
+        if chunk:
+            self._append(chunk)
+        frames = []
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                break
+            frames.append(frame)
+        self.frames += len(frames)
+        return frames
+
+    def iter_frames(self, chunks):
+        """Generador de frames a partir de un iterable de chunks (p. ej. `iter_content`)."""
+        for chunk in chunks:
+            yield from self.feed(chunk)
+
+    def reset(self):
+        """Descarta los datos pendientes (p. ej. tras una reconexión)."""
+        self._r = self._w = self._scan = 0
+        self._body = self._length = None
+        self._in_part = False
+
+    def _append(self, chunk):
+        n = len(chunk)
+        self.bytes_in += n
+        if self._w + n > len(self._buf):
+            self._compact(n)
+        self._view[self._w:self._w + n] = chunk
+        self._w += n
+
+    def _compact(self, incoming):
+        """Mueve los datos pendientes al inicio del buffer, ampliándolo si no caben.
+
+        Nunca se redimensiona el `bytearray` en sitio: si hace falta más espacio se crea
+        uno nuevo, así las vistas exportadas anteriormente no bloquean la operación.
+        """
+        pending = self._w - self._r
+        if pending + incoming > self.max_buffer:
+            logger.warning(f"Buffer MJPEG desbordado ({pending} bytes sin frame). Resincronizando.")
+            self.resyncs += 1
+            self.reset()
+            pending = 0
+            if incoming > len(self._buf):
+                self._buf = bytearray(incoming)
+                self._view = memoryview(self._buf)
+            return
+
+        shift = self._r
+        if pending + incoming > len(self._buf):
+            capacity = max(2 * len(self._buf), pending + incoming)
+            new_buf = bytearray(capacity)
+            new_view = memoryview(new_buf)
+            new_view[:pending] = self._view[self._r:self._w]
+            self._buf, self._view = new_buf, new_view
+        elif pending:
+            self._view[:pending] = self._view[self._r:self._w]
+
+        self._r = 0
+        self._w = pending
+        self._scan = max(0, self._scan - shift)
+        if self._body is not None:
+            self._body -= shift
+
+    def _next_frame(self):
+        if self._body is None and not self._find_body():
+            return None
+
+        buf, body = self._buf, self._body
+        if self._length is not None:
+            end = body + self._length
+            if end > self._w:
+                return None
+        else:
+            eoi = buf.find(EOI, max(self._scan, body + 2), self._w)
+            if eoi == -1:
+                # El último byte puede ser el 0xFF de un EOI partido entre chunks
+                self._scan = max(body + 2, self._w - 1)
+                return None
+            end = eoi + 2
+
+        frame = self._view[body:end]
+        self._r = self._scan = end
+        self._body = self._length = None
+        return frame
+
+    def _find_body(self):
+        """Localiza el inicio del siguiente frame y, si lo hay, su Content-Length."""
+        buf = self._buf
+        if self.delimiter is not None and not self._in_part:
+            delim = buf.find(self.delimiter, self._scan, self._w)
+            if delim != -1:
+                header_end = buf.find(HEADER_END, delim, self._w)
+                if header_end == -1:
+                    self._r = self._scan = delim
+                    return False
+                headers = parse_part_headers(bytes(self._view[delim:header_end]))
+                body = header_end + len(HEADER_END)
+                length = headers.get("content-length")
+                if length is not None and length.isdigit():
+                    self._body, self._length = body, int(length)
+                    return True
+                # Sin Content-Length: se delimita por marcadores a partir del cuerpo. Si el
+                # chunk termina antes del SOI, la siguiente llamada lo busca directamente en
+                # lugar de saltar al delimitador de la parte siguiente
+                self._r = self._scan = body
+                self._in_part = True
+
+        soi = buf.find(SOI, self._scan, self._w)
+        if soi == -1:
+            # Se conserva el final por si contiene un marcador o delimitador partido
+            keep = len(self.delimiter) if self.delimiter is not None else 1
+            self._scan = max(self._r, self._w - keep)
+            if self._w - self._r > 65536:
+                self._r = self._scan
+            return False
+        self._body = soi
+        self._length = None
+        self._in_part = False
+        return True
+
+
+# Marcadores SOF (Start Of Frame); C4, C8 y CC comparten rango pero son DHT, JPG y DAC
+SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def jpeg_dimensions(data):
+    """Obtiene (ancho, alto) de un JPEG leyendo su cabecera SOF, sin decodificarlo.
+
+    Args:
+        data (bytes | memoryview): Datos JPEG.
+
+    Returns:
+        tuple | None: (ancho, alto), o None si la cabecera no es válida.
+    """
+    n = len(data)
+    if n < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    i = 2
+    while i + 4 <= n:
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Bytes de relleno entre segmentos
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2
+            continue
+        if marker in (0xD9, 0xDA):
+            return None
+        if marker in SOF_MARKERS:
+            if i + 9 > n:
+                return None
+            height = (data[i + 5] << 8) | data[i + 6]
+            width = (data[i + 7] << 8) | data[i + 8]
+            return width, height
+        i += 2 + ((data[i + 2] << 8) | data[i + 3])
+    return None
@@ -0,0 +1,153 @@
+import os
+import struct
+import logging
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INDEX_SUFFIX = ".idx"
+MAGIC = b"FIDX"
+VERSION = 1
+# magic, versión, flags, FPS de la rejilla, número de frames
+HEADER = struct.Struct("<4sHHdI")
+FLAG_COMPLETE = 1
+# 17 bytes por frame: hora de captura, offset del paquete en el fichero (-1 si no se
+# conoce todavía) y si es un keyframe
+RECORD_DTYPE = np.dtype([("time", "<f8"), ("offset", "<i8"), ("keyframe", "u1")])
+
+
+def index_path(video_path):
+    """Índice de frames junto al vídeo (`cam1.mp4.idx`)."""
+    video_path = Path(video_path)
+    return video_path.with_name(f"{video_path.name}{INDEX_SUFFIX}")
+
+
+class FrameIndex:
+    def __init__(self, fps, records, complete=False):
+        """
+        Índice de un segmento: frame -> hora de captura, keyframe y offset en bytes.
+
+        El encoder lo escribe al cerrar el vídeo con la hora de captura de cada frame de
+        la rejilla CFR (los duplicados repiten la del frame original). La tarea `index`
+        del post-procesado lo completa con los keyframes y offsets del fichero final.
+
+        Args:
+            fps (float): FPS del vídeo; el frame `n` se presenta en `n / fps`.
+            records (np.ndarray): Registros `RECORD_DTYPE`, uno por frame.
+            complete (bool): Si ya tiene keyframes y offsets.
+        """
+        self.fps = float(fps)
+        self.records = records
+        self.complete = complete
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def times(self):
+        return self.records["time"]
+
+    @property
+    def start(self):
+        return float(self.times[0]) if len(self) else None
+
+    @property
+    def end(self):
+        return float(self.times[-1]) if len(self) else None
+
+    def frame_at(self, timestamp):
+        """Primer frame capturado a partir de `timestamp` (o `len` si no hay ninguno)."""
+        return int(np.searchsorted(self.times, timestamp, side="left"))
+
+    def keyframe_before(self, frame):
+        """Último keyframe en o antes de `frame` (0 si el índice no está completo)."""
+        if not self.complete:
+            return 0
+        keyframes = np.flatnonzero(self.records["keyframe"][:frame + 1])
+        return int(keyframes[-1]) if len(keyframes) else 0
+
+    def pts(self, frame):
+        return frame / self.fps
+
+
+def write_index(path, times, fps, offsets=None, keyframes=None):
+    """Escribe el índice de forma atómica (temporal + `os.replace`)."""
+    records = np.empty(len(times), RECORD_DTYPE)
+    records["time"] = times
+    records["offset"] = -1 if offsets is None else offsets
+    records["keyframe"] = 0 if keyframes is None else keyframes
+    complete = offsets is not None and keyframes is not None
+    path = Path(path)
+    tmp = path.with_name(f"{path.name}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, FLAG_COMPLETE if complete else 0, float(fps), len(records)))
+        f.write(records.tobytes())
+    os.replace(tmp, path)
+    try:
+        os.chmod(path, 0o777)
+    except Exception as e:
+        logger.error(f"Error al cambiar permisos de {path}: {e}")
+
+
+def read_index(path):
+    """Lee un índice escrito con `write_index`.
+
+    Raises:
+        ValueError: Si el fichero no es un índice válido.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        raise ValueError(f"Índice truncado: {path}")
+    magic, version, flags, fps, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"Índice no soportado: {path}")
+    records = np.frombuffer(data, RECORD_DTYPE, count, HEADER.size)
+    return FrameIndex(fps, records, bool(flags & FLAG_COMPLETE))
+
+
+def probe_packets(video_path, prefix=()):
+    """Paquetes de vídeo del fichero sin decodificarlos: (pts, offset, keyframe) por frame.
+
+    Returns:
+        list[tuple]: Paquetes ordenados por tiempo de presentación.
+    """
+    command = ["ffprobe", "-v", "error", "-select_streams", "v:0",
+               "-show_entries", "packet=pts_time,pos,flags", "-of", "compact=p=0", str(video_path)]
+    output = subprocess.run(list(prefix) + command, check=True, capture_output=True, text=True).stdout
+    packets = []
+    for line in output.splitlines():
+        fields = dict(item.split("=", 1) for item in line.strip().split("|") if "=" in item)
+        if fields.get("pts_time") in (None, "", "N/A"):
+            continue
+        pos = fields.get("pos", "N/A")
+        packets.append((float(fields["pts_time"]), int(pos) if pos.lstrip("-").isdigit() else -1,
+                        fields.get("flags", "").startswith("K")))
+    packets.sort()
+    return packets
+
+
+def complete_index(video_path, prefix=()):
+    """Completa el índice del encoder con keyframes y offsets del vídeo final.
+
+    Se ejecuta después de `fps_fix` y `remux`, que reescriben el fichero. Cada paquete
+    se asocia al frame de la rejilla del encoder con su mismo tiempo de presentación,
+    así que el índice sigue siendo válido aunque `fps_fix` cambie los FPS.
+    """
+    path = index_path(video_path)
+    if not path.exists():
+        logger.warning(f"{video_path} no tiene índice de frames; se omite.")
+        return
+    index = read_index(path)
+    packets = probe_packets(video_path, prefix)
+    if not packets or not len(index):
+        return
+    pts = np.array([packet[0] for packet in packets])
+    source = np.clip(np.rint((pts - pts[0]) * index.fps).astype(np.int64), 0, len(index) - 1)
+    fps = 1.0 / float(np.median(np.diff(pts))) if len(pts) > 1 else index.fps
+    write_index(path, index.times[source], fps,
+                offsets=[packet[1] for packet in packets],
+                keyframes=[packet[2] for packet in packets])
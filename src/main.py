@@ -2,15 +2,26 @@ import os
 import cv2
 import time
 from datetime import datetime
-import numpy as np
 from model import Model
+from pipeline import CameraPipeline
+from process_engine import ProcessEngine
+from encoder import create_encoder, output_extension
+from segments import SegmentRoller, DEFAULT_RECORDING_CFG, segment_dir, segment_start
+from trigger import ActivityMonitor, TriggeredRecorder
+from postprocess import PostProcessor
+from metrics import MetricsRegistry, MetricsService
+from anonymizer import create_anonymizer
+from profiles import camera_settings
+from supervisor import CameraSupervisor, write_gap_marker
+from scheduler import LoadScheduler, camera_priority
+from storage import Storage
+from sinks import SinkFanout, camera_sinks, sinks_pipeline_cfg, video_outputs
+from startup import start_api, camera_frame_size
+from reload import ConfigWatcher, CameraThreads, camera_names
 import json
 import logging
-from pathlib import Path
-import requests
 import threading
-import concurrent.futures
-import subprocess
+import signal
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -34,125 +45,314 @@ class VideoRecorder:
         with open(cfg_path, 'r') as f:
             self.cfg = json.load(f)
         validate_config(self.cfg)
+        self.metrics = MetricsRegistry()
+        self.metrics_service = MetricsService(self.metrics, self.cfg.get('metrics'))
+        # Staging, cuota y espacio libre de `../files`
+        self.storage = Storage(self.cfg.get('storage'))
+        self.postprocessor = PostProcessor(self.cfg.get('postprocess'), self.metrics, self.storage)
+        self.startup = None
+        self.scheduler = LoadScheduler(self.metrics, self.cfg.get('scheduler'), self.stop_event)
+        # Cambios de cfg.json en caliente: cámaras nuevas, eliminadas o con otro perfil
+        self.watcher = ConfigWatcher(cfg_path, self.cfg, self.apply_config, self.cfg.get('reload'), self.stop_event)
+        self.cameras = None
+        self.monitor = None
+        # Fin de la grabación en curso en el modo por duración fija (None en modo continuo)
+        self.segment_deadline = None
 
-    def record_camera(self, camera_name):
+    def record_camera(self, camera_name, stop_event=None):
+        stop_event = stop_event or self.stop_event
         try:
             print(f"Iniciando grabación para {camera_name}...")
-            frame_data = self.model.get_image(camera_name, processed=False)
-            if not frame_data:
-                logger.error(f"No se recibieron datos de la cámara {camera_name}.")
-                return
-
-            frame = cv2.imdecode(np.frombuffer(frame_data, np.uint8), cv2.IMREAD_COLOR)
-            if frame is None:
-                logger.error(f"No se pudo decodificar la imagen de la cámara {camera_name}.")
-                return
-
-            height, width = frame.shape[:2]
-            output_path = self.current_output_dir / f"{camera_name}.mp4"
-            writer = cv2.VideoWriter(
-                str(output_path),
-                cv2.VideoWriter_fourcc(*'mp4v'),
-                self.target_fps,
-                (width, height)
-            )
+            # Perfil de la cámara: encoder, límite de FPS y resolución propios
+            encoder_cfg, pipeline_cfg, fps = camera_settings(self.cfg, camera_name, self.target_fps)
+            output_path = self.current_output_dir / f"{camera_name}{output_extension(encoder_cfg)}"
+            sinks = camera_sinks(self.cfg, camera_name)
+            fanouts = []
+
+            def fanout_factory(frame_size):
+                fanout = SinkFanout(
+                    camera_name, frame_size, sinks, encoder_cfg, pipeline_cfg, fps,
+                    lambda name, size, sink_encoder_cfg, sink_fps: create_encoder(
+                        self.current_output_dir / f"{name}{output_extension(sink_encoder_cfg)}",
+                        size, sink_fps, sink_encoder_cfg)
+                )
+                fanouts.append(fanout)
+                return fanout
 
             print(f"Grabando en {camera_name}, guardando en {output_path}...")
-            url = f"{self.model.uri}/stream"
-            params = {'camera_name': camera_name, 'processed': False}
-            
-            with requests.get(url, params=params, stream=True, timeout=self.model.timeout) as response:
-                response.raise_for_status()
-                buffer = b''
-                start_time = time.time()
-                frame_count = 0
-
-                while not self.stop_event.is_set():
-                    elapsed_time = time.time() - start_time
-                    if elapsed_time >= self.video_duration:
-                        print(f"{camera_name}: Tiempo límite alcanzado ({elapsed_time:.2f}s). Deteniendo grabación.")
-                        break
-
-                    for chunk in response.iter_content(chunk_size=1048576):
-                        if self.stop_event.is_set():
-                            break
-                        
-                        elapsed_time = time.time() - start_time
-                        if elapsed_time >= self.video_duration:
-                            print(f"{camera_name}: Tiempo límite alcanzado ({elapsed_time:.2f}s). Deteniendo grabación.")
-                            break
-
-                        buffer += chunk
-                        while b'\xff\xd9' in buffer:
-                            start = buffer.find(b'\xff\xd8')
-                            end = buffer.find(b'\xff\xd9') + 2
-                            if start != -1:
-                                frame_data = buffer[start:end]
-                                buffer = buffer[end:]
-
-                                frame = cv2.imdecode(np.frombuffer(frame_data, np.uint8), cv2.IMREAD_COLOR)
-                                if frame is not None:
-                                    writer.write(frame)
-                                    frame_count += 1
-                                    if frame_count % 100 == 0:
-                                        print(f"{camera_name}: {frame_count} frames capturados")
-
-                writer.release()
-                try: 
-                    os.chmod(output_path, 0o777) 
-                except Exception as e:
-                    logger.error(f"Error al cambiar permisos del video {output_path}: {e}")
-                print(f"Finalizada grabación de {camera_name}, total frames: {frame_count}")
-                average_fps = frame_count / (time.time() - start_time)
-                logger.info(f"{camera_name}: Grabación finalizada. FPS promedio: {average_fps:.2f}")
-
-                # Re-codificar el video para ajustar los FPS
-                self.adjust_video_fps(output_path, average_fps)
+            # Un corte del stream solo afecta a esta cámara: se reconecta sobre el mismo vídeo
+            supervisor = CameraSupervisor(camera_name, stop_event, self.cfg.get('supervisor'),
+                                          self.metrics.camera(camera_name),
+                                          lambda name, gap: write_gap_marker(
+                                              self.storage.archive_dir(self.current_output_dir.name), gap),
+                                          self.startup.first_frame if self.startup else None)
+            if sinks:
+                # Una sola ingesta para todas las salidas: el pipeline decodifica al tamaño
+                # de la mayor y con los FPS de la más rápida
+                writer = supervisor.hold(fanout_factory)
+                session_pipeline_cfg = sinks_pipeline_cfg(sinks, encoder_cfg, pipeline_cfg, fps)
+            else:
+                writer = supervisor.hold(lambda frame_size: create_encoder(output_path, frame_size, fps, encoder_cfg))
+                session_pipeline_cfg = pipeline_cfg
+            # Sin sonda previa: con el tamaño de `get_camera_properties` el encoder arranca
+            # mientras se abre el stream; si no, el pipeline lo lee del primer JPEG
+            frame_size = camera_frame_size(self.model, camera_name, session_pipeline_cfg)
+            if frame_size is not None:
+                writer.prepare(frame_size)
+            # Degradación bajo carga según la prioridad de la cámara
+            load = self.scheduler.camera(camera_name, camera_priority(self.cfg, camera_name), fps)
+
+            def session(remaining):
+                with self.model.open_stream(camera_name, processed=False, timeout=10) as response:
+                    # Lectura, extracción, decodificación y escritura corren en etapas separadas
+                    pipeline = CameraPipeline(
+                        camera_name,
+                        response,
+                        writer.open,
+                        session_pipeline_cfg,
+                        stop_event,
+                        self.metrics.camera(camera_name),
+                        create_anonymizer(camera_name, self.model, self.cfg.get('anonymize')),
+                        load,
+                        self.storage
+                    )
+                    return pipeline.run(remaining)
+
+            # Las cámaras añadidas en caliente graban solo hasta el final de la grabación en curso
+            stats = supervisor.run(session, max(0.0, self.segment_deadline - time.time()))
+
+            outputs = video_outputs(fanouts, stats['connected']) if sinks else [
+                (output_path, stats['fps'], writer.needs_fps_fix)]
+            if writer.frame_size is not None:
+                for path, _, _ in outputs:
+                    try:
+                        os.chmod(path, 0o777)
+                    except Exception as e:
+                        logger.error(f"Error al cambiar permisos del video {path}: {e}")
+            print(f"Finalizada grabación de {camera_name}, total frames: {stats['frames_written']}")
+            logger.info(f"{camera_name}: Grabación finalizada. FPS promedio: {stats['fps']:.2f}. "
+                        f"Frames descartados: {stats['dropped']}. Reconexiones: {stats['reconnects']}, "
+                        f"huecos: {stats['gap_seconds']:.1f}s, "
+                        f"bloqueos: {stats['stalls']} ({stats['stall_seconds']:.1f}s)")
+
+            # Solo el encoder de OpenCV necesita re-codificar el video para ajustar los FPS
+            if writer.frame_size is not None:
+                for path, path_fps, needs_fps_fix in outputs:
+                    self.finalize_segment(path, path_fps, needs_fps_fix, camera_name)
             
             cv2.destroyAllWindows()
         except Exception as e:
             logger.error(f"Error en la grabación de {camera_name}: {e}")
         finally:
-            self.stop_event.set()
-            self.model.stop_process()
-            print("Proceso finalizado correctamente.")
+            print(f"Grabación de {camera_name} finalizada.")
+
+    def finalize_segment(self, video_path, fps, needs_fps_fix, camera_name=None):
+        """Encola el post-procesado del video sin esperar a que termine."""
+        tasks = (['fps_fix'] if needs_fps_fix and fps else []) + self.postprocessor.cfg['tasks']
+        self.postprocessor.submit(video_path, tasks, fps=fps, camera=camera_name)
+
+    def record_processes(self):
+        """Graba todas las cámaras repartidas entre procesos de ingesta (`ProcessEngine`)."""
+        print(f"Iniciando grabación multiproceso en {len(self.cfg['cameras'])} cámaras...")
+        engine = ProcessEngine(self.model.uri, self.cfg, self.current_output_dir, self.target_fps,
+                               self.video_duration, self.stop_event, self.metrics,
+                               self.startup.first_frame if self.startup else None)
+        for camera_name, stats in engine.run().items():
+            if stats.get('error'):
+                logger.error(f"Error en la grabación de {camera_name}: {stats['error']}")
+            logger.info(f"{camera_name}: Grabación finalizada. FPS promedio: {stats.get('fps', 0.0):.2f}. "
+                        f"Frames descartados: {stats.get('dropped')}, en memoria compartida: {stats.get('ring_dropped')}")
+            if 'needs_fps_fix' in stats:
+                self.finalize_segment(stats['output_path'], stats.get('fps'), stats['needs_fps_fix'], camera_name)
+
+    def segment_roller(self, camera_name, frame_size, align=None, output_name=None, encoder_cfg=None,
+                       fps=None):
+        """Crea el `SegmentRoller` de una cámara según la sección `recording`.
+
+        Las salidas de `sinks` indican su propio nombre de fichero, encoder y FPS.
+        """
+        recording_cfg = {**DEFAULT_RECORDING_CFG, **(self.cfg.get('recording') or {})}
+        if encoder_cfg is None:
+            encoder_cfg, _, fps = camera_settings(self.cfg, camera_name, self.target_fps)
+        return SegmentRoller(
+            output_name or camera_name,
+            frame_size,
+            self.storage.root,
+            lambda path, size: create_encoder(path, size, fps, encoder_cfg),
+            output_extension(encoder_cfg),
+            recording_cfg.get('segment_minutes', self.video_duration / 60) * 60,
+            max_bytes=recording_cfg['segment_max_mb'] * 1048576,
+            align=recording_cfg['align'] if align is None else align,
+            on_segment_closed=self.on_segment_closed,
+            # Un cambio de perfil pendiente reinicia la cámara justo en el límite del segmento
+            on_boundary=lambda name: self.cameras is not None and self.cameras.at_boundary(camera_name)
+        )
+
+    def record_camera_continuous(self, camera_name, monitor=None, stop_event=None):
+        """Graba una cámara sin cortes, rotando el fichero de salida en cada segmento.
+
+        Con `monitor` (modo `trigger`) solo se escribe mientras hay actividad: cada
+        evento va a su propio directorio, con el pre-roll guardado en memoria.
+        """
+        def roller_factory(frame_size):
+            if monitor is None and sinks:
+                # Cada salida de vídeo rota sus propios segmentos
+                return SinkFanout(
+                    camera_name, frame_size, sinks, encoder_cfg, pipeline_cfg, fps,
+                    lambda name, size, sink_encoder_cfg, sink_fps: self.segment_roller(
+                        camera_name, size, output_name=name, encoder_cfg=sink_encoder_cfg, fps=sink_fps)
+                )
+            if monitor is None:
+                return self.segment_roller(camera_name, frame_size)
+            return TriggeredRecorder(
+                camera_name,
+                monitor,
+                # Los eventos no se alinean al reloj: el directorio indica cuándo empezaron
+                lambda: self.segment_roller(camera_name, frame_size, align=False),
+                self.cfg.get('trigger')
+            )
 
-    def adjust_video_fps(self, video_path, target_fps):
         try:
-            temp_path = str(video_path).replace(".mp4", "_temp.mp4")
-            command = [
-                "ffmpeg", "-i", str(video_path), "-filter:v", f"fps=fps={target_fps}",
-                "-c:a", "copy", temp_path
-            ]
-            # Redirigir la salida a DEVNULL para suprimir los mensajes
-            subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            os.replace(temp_path, video_path)
-            try: 
-                os.chmod(video_path, 0o777) 
+            print(f"Iniciando grabación continua para {camera_name}...")
+            encoder_cfg, pipeline_cfg, fps = camera_settings(self.cfg, camera_name, self.target_fps)
+            sinks = camera_sinks(self.cfg, camera_name)
+            if sinks and monitor is not None:
+                logger.warning(f"{camera_name}: El modo trigger graba una sola salida; se ignoran las de `sinks`.")
+                sinks = []
+            session_pipeline_cfg = sinks_pipeline_cfg(sinks, encoder_cfg, pipeline_cfg, fps) if sinks else pipeline_cfg
+            supervisor = CameraSupervisor(camera_name, stop_event or self.stop_event, self.cfg.get('supervisor'),
+                                          self.metrics.camera(camera_name), self.on_gap,
+                                          self.startup.first_frame if self.startup else None)
+            # El segmento en curso sigue abierto mientras se reconecta
+            roller = supervisor.hold(roller_factory)
+            load = self.scheduler.camera(camera_name, camera_priority(self.cfg, camera_name), fps)
+
+            def session(remaining):
+                with self.model.open_stream(camera_name, processed=False, timeout=10) as response:
+                    pipeline = CameraPipeline(camera_name, response, roller.open, session_pipeline_cfg,
+                                              stop_event or self.stop_event, self.metrics.camera(camera_name),
+                                              create_anonymizer(camera_name, self.model, self.cfg.get('anonymize')),
+                                              load, self.storage)
+                    return pipeline.run(remaining)
+
+            stats = supervisor.run(session)
+            logger.info(f"{camera_name}: Grabación continua finalizada. Frames: {stats['frames_written']}. "
+                        f"Frames descartados: {stats['dropped']}. Reconexiones: {stats['reconnects']}, "
+                        f"huecos: {stats['gap_seconds']:.1f}s, "
+                        f"bloqueos: {stats['stalls']} ({stats['stall_seconds']:.1f}s)")
+        except Exception as e:
+            logger.error(f"Error en la grabación continua de {camera_name}: {e}")
+
+    def segment_interval(self):
+        """Duración de los segmentos de la grabación continua y si se alinean al reloj."""
+        recording_cfg = {**DEFAULT_RECORDING_CFG, **(self.cfg.get('recording') or {})}
+        return recording_cfg.get('segment_minutes', self.video_duration / 60) * 60, recording_cfg['align']
+
+    def on_gap(self, camera_name, gap):
+        """Marca el hueco en el directorio del segmento en el que empezó."""
+        interval, align = self.segment_interval()
+        write_gap_marker(segment_dir(self.storage.archive, segment_start(gap['start'], interval, align)), gap)
+
+    def apply_config(self, cfg, diff):
+        """Aplica en caliente los cambios de cfg.json (ver `ConfigWatcher`).
+
+        Las cámaras nuevas empiezan a grabar y las eliminadas cierran sus vídeos; las
+        modificadas se reinician en el próximo límite de segmento (en el modo por
+        duración fija, en la próxima grabación). El resto sigue grabando sin cortes.
+        """
+        self.cfg = cfg
+        reload_cfg = self.watcher.reload_cfg
+        for camera_name in diff['removed']:
+            logger.info(f"{camera_name}: Eliminada de la configuración; se cierra su grabación.")
+            self.cameras.stop(camera_name)
+            self.scheduler.remove(camera_name)
+        if diff['api'] and reload_cfg['reload_api']:
+            try:
+                self.model.load_cameras_and_models()
             except Exception as e:
-                logger.error(f"Error al cambiar permisos del video {video_path}: {e}")
-            print(f"Video de {video_path} ajustado a {target_fps:.2f} FPS.")
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Error al ajustar FPS del video {video_path}: {e}")
+                logger.error(f"Error recargando las cámaras en api-yolo: {e}")
+        if self.monitor is not None:
+            self.monitor.camera_names = camera_names(cfg)
+        for camera_name in diff['added']:
+            logger.info(f"{camera_name}: Nueva cámara en la configuración; se inicia su grabación.")
+            self.cameras.start(camera_name)
+        for camera_name in diff['changed']:
+            if self.segment_deadline is None:
+                interval, align = self.segment_interval()
+                boundary = segment_start(time.time(), interval, align) + interval
+                logger.info(f"{camera_name}: Configuración modificada; se aplicará en el límite de segmento "
+                            f"de las {time.strftime('%H:%M:%S', time.localtime(boundary))}.")
+                self.cameras.restart_at_boundary(camera_name, boundary, reload_cfg['boundary_grace_seconds'])
+            else:
+                logger.info(f"{camera_name}: Configuración modificada; se aplicará en la próxima grabación.")
+
+    def on_segment_closed(self, camera_name, segment):
+        """Se ejecuta al finalizar cada segmento de la grabación continua."""
+        if segment['frames']:
+            self.finalize_segment(segment['path'], segment['fps'], segment['needs_fps_fix'], camera_name)
+
+    def record_continuous(self):
+        """Mantiene una conexión por cámara abierta indefinidamente y rota los segmentos sin huecos.
+
+        Con `"mode": "trigger"` en la sección `recording` solo se graba mientras api-yolo
+        detecta alguna de las `tracked_classes`.
+        """
+        try:
+            print("Iniciando sistema en modo continuo...")
+            self.stop_event.clear()
+            self.storage.start(self.postprocessor.pending_paths())
+            self.startup = start_api(self.model, [camera['name'] for camera in self.cfg['cameras']],
+                                     self.cfg.get('startup'), self.stop_event)
+
+            if (self.cfg.get('recording') or {}).get('mode') == 'trigger':
+                classes = (self.cfg.get('tracker_config') or {}).get('tracked_classes')
+                self.monitor = ActivityMonitor(self.model, [camera['name'] for camera in self.cfg['cameras']],
+                                               classes, self.cfg.get('trigger'), self.stop_event).start()
+            self.scheduler.start()
+            # Un hilo por cámara: las que se añadan o quiten de cfg.json no paran al resto
+            self.cameras = CameraThreads(
+                lambda name, stop: self.record_camera_continuous(name, self.monitor, stop), self.stop_event)
+            for camera in self.cfg['cameras']:
+                self.cameras.start(camera['name'])
+            print(f"Iniciando grabación continua en {len(self.cameras.names())} cámaras...")
+            self.watcher.start()
+            self.cameras.wait()
+        except Exception as e:
+            logger.error(f"Error general: {e}")
+        finally:
+            self.stop_event.set()
+            self.watcher.stop()
+            self.scheduler.stop()
+            if self.monitor is not None:
+                self.monitor.stop()
+            self.model.stop_process()
+            self.postprocessor.shutdown()
+            self.storage.close(self.postprocessor.pending_paths())
+            self.metrics_service.close()
+            print("Proceso finalizado correctamente.")
 
     def record(self):
         try:
             print("Iniciando sistema...")
-            self.model.load_cameras_and_models()
-            self.model.start_process()
-            time.sleep(2)
+            self.stop_event.clear()
+            self.storage.start(self.postprocessor.pending_paths())
+            self.startup = start_api(self.model, [camera['name'] for camera in self.cfg['cameras']],
+                                     self.cfg.get('startup'), self.stop_event)
 
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            self.current_output_dir = Path("../files") / timestamp
-            self.current_output_dir.mkdir(parents=True, exist_ok=True)
-            os.chmod(self.current_output_dir, 0o777)
-
-            self.stop_event.clear()
+            self.current_output_dir = self.storage.segment_dir(timestamp)
+            self.segment_deadline = time.time() + self.video_duration
 
-            with concurrent.futures.ThreadPoolExecutor(max_workers=len(self.cfg['cameras'])) as executor:
-                futures = [executor.submit(self.record_camera, camera['name']) for camera in self.cfg['cameras']]
-                print(f"Iniciando grabación en {len(futures)} cámaras...")
-                concurrent.futures.wait(futures)
+            if (self.cfg.get('engine') or {}).get('mode') == 'processes':
+                self.record_processes()
+            else:
+                self.scheduler.start()
+                self.cameras = CameraThreads(self.record_camera, self.stop_event)
+                for camera in self.cfg['cameras']:
+                    self.cameras.start(camera['name'])
+                print(f"Iniciando grabación en {len(self.cameras.names())} cámaras...")
+                self.watcher.start()
+                self.cameras.wait()
 
             print("Grabación completada correctamente.")
             logger.info("Grabación completada correctamente.")
@@ -160,10 +360,20 @@ class VideoRecorder:
             logger.error(f"Error general: {e}")
         finally:
             self.stop_event.set()
+            self.watcher.stop()
+            self.scheduler.stop()
             self.model.stop_process()
+            self.postprocessor.shutdown()
+            self.storage.close(self.postprocessor.pending_paths())
+            self.metrics_service.close()
             print("Proceso finalizado correctamente.")
 
 if __name__ == "__main__":
     recorder = VideoRecorder(video_duration_minutes=15, fixed_fps=25)
-    recorder.record()
+    # Al parar el contenedor se cierran los ficheros en curso en lugar de dejarlos truncados
+    signal.signal(signal.SIGTERM, lambda signum, frame: recorder.stop_event.set())
+    if (recorder.cfg.get('recording') or {}).get('mode') in ('continuous', 'trigger'):
+        recorder.record_continuous()
+    else:
+        recorder.record()
     print("Ejecución finalizada.")
@@ -1,16 +1,23 @@
 import os
-import cv2
 import time
 from datetime import datetime
-import numpy as np
 import json
 import logging
-from pathlib import Path
-import requests
-from concurrent.futures import ThreadPoolExecutor
-import subprocess
-from requests.exceptions import ChunkedEncodingError
+import threading
 from model import Model  # Asegúrate de importar el modelo
+from pipeline import CameraPipeline
+from process_engine import ProcessEngine
+from encoder import create_encoder, output_extension
+from postprocess import PostProcessor
+from metrics import MetricsRegistry, MetricsService
+from anonymizer import create_anonymizer
+from profiles import camera_settings
+from supervisor import CameraSupervisor, write_gap_marker
+from startup import start_api, camera_frame_size
+from scheduler import LoadScheduler, camera_priority
+from storage import Storage
+from sinks import SinkFanout, camera_sinks, sinks_pipeline_cfg, video_outputs
+from reload import ConfigWatcher, CameraThreads
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
@@ -29,7 +36,7 @@ class OptimizedVideoRecorder:
         self.video_duration = video_duration_minutes * 60  # Convertir minutos a segundos
         self.fixed_fps = fixed_fps
         self.cfg_path = cfg_path
-        self.stop_event = False
+        self.stop_event = threading.Event()
 
         # Cargar configuración
         with open(cfg_path, "r") as f:
@@ -42,136 +49,213 @@ class OptimizedVideoRecorder:
         # Inicializar el modelo
         self.model = Model("http://api-yolo:3002", cfg_path)
 
+        # Métricas por cámara (endpoint Prometheus y snapshots JSON opcionales)
+        self.metrics = MetricsRegistry()
+        self.metrics_service = MetricsService(self.metrics, self.cfg.get("metrics"))
+
+        # Staging, cuota y espacio libre de `../files`
+        self.storage = Storage(self.cfg.get("storage"))
+
+        # Post-procesado de los videos en segundo plano (y paso al archivo)
+        self.postprocessor = PostProcessor(self.cfg.get("postprocess"), self.metrics, self.storage)
+
+        # Tiempos del arranque (`load_cameras_and_models`)
+        self.startup = None
+
+        # Degradación de las cámaras menos prioritarias si el host no da abasto
+        self.scheduler = LoadScheduler(self.metrics, self.cfg.get("scheduler"), self.stop_event)
+
+        # Cámaras añadidas o eliminadas de cfg.json sin parar al resto
+        self.watcher = ConfigWatcher(cfg_path, self.cfg, self.apply_config, self.cfg.get("reload"), self.stop_event)
+        self.cameras = None
+        self.deadline = None
+
     def load_cameras_and_models(self):
+        """Arranca api-yolo y espera a que esté listo (`check_status`) sin esperas fijas."""
         logger.info("Cargando cámaras y modelos...")
-        self.model.load_cameras_and_models()
-        self.model.start_process()
+        self.startup = start_api(self.model, [camera["name"] for camera in self.cfg["cameras"]],
+                                 self.cfg.get("startup"), self.stop_event)
 
-    def record_camera(self, camera_name, output_dir):
+    def record_camera(self, camera_name, output_dir, stop_event=None):
         """
         Graba el video de una cámara específica y guarda directamente al archivo.
 
         Args:
             camera_name (str): Nombre de la cámara.
             output_dir (Path): Directorio de salida para guardar el video.
+            stop_event (CameraStop, optional): Parada propia de la cámara (ver `CameraThreads`).
         """
+        stop_event = stop_event or self.stop_event
         logger.info(f"Iniciando grabación para la cámara: {camera_name}")
         try:
-            video_path = output_dir / f"{camera_name}.mp4"
-            url = f"{self.model.uri}/stream"
-            params = {"camera_name": camera_name, "processed": False}
-
-            response = requests.get(url, params=params, stream=True, timeout=10)
-            response.raise_for_status()
-
-            buffer = b""
-            frame_count = 0
-            start_time = time.time()
-            writer = None
-
-            for chunk in response.iter_content(chunk_size=16384):
-                if self.stop_event:
-                    break
-
-                if not chunk:
-                    logger.error(f"Error: Chunk vacío recibido para la cámara {camera_name}.")
-                    break
-
-                buffer += chunk
-                while b"\xff\xd9" in buffer:
-                    start = buffer.find(b"\xff\xd8")
-                    end = buffer.find(b"\xff\xd9") + 2
-
-                    if start != -1 and end > start:
-                        frame_data = buffer[start:end]
-                        buffer = buffer[end:]
-
-                        frame = cv2.imdecode(np.frombuffer(frame_data, np.uint8), cv2.IMREAD_COLOR)
-                        if frame is not None:
-                            if writer is None:
-                                height, width = frame.shape[:2]
-                                writer = cv2.VideoWriter(
-                                    str(video_path),
-                                    cv2.VideoWriter_fourcc(*"mp4v"),
-                                    self.fixed_fps,
-                                    (width, height)
-                                )
-
-                            writer.write(frame)
-                            frame_count += 1
-
-                            if frame_count % 30 == 0:
-                                logger.info(f"{camera_name}: {frame_count} frames capturados.")
-
-                elapsed_time = time.time() - start_time
-                if elapsed_time >= self.video_duration:
-                    logger.info(f"{camera_name}: Tiempo límite alcanzado ({elapsed_time:.2f}s). Deteniendo grabación.")
-                    break
-
-            if writer:
-                writer.release()
-                try:
-                    os.chmod(video_path, 0o777) 
-                except Exception as e:
-                    logger.error(f"Error al cambiar permisos del video {video_path}: {e}")
-
-            average_fps = frame_count / (time.time() - start_time)
-            logger.info(f"{camera_name}: Grabación finalizada. FPS promedio: {average_fps:.2f}")
-
-            self.adjust_video_fps(video_path, average_fps)
-
-        except ChunkedEncodingError as e:
-            logger.error(f"Error de codificación de chunk en la cámara {camera_name}: {e}")
+            # Perfil de la cámara: encoder, límite de FPS y resolución propios
+            encoder_cfg, pipeline_cfg, fps = camera_settings(self.cfg, camera_name, self.fixed_fps)
+            video_path = output_dir / f"{camera_name}{output_extension(encoder_cfg)}"
+            # Salidas adicionales (preview, snapshots...) servidas desde la misma ingesta
+            sinks = camera_sinks(self.cfg, camera_name)
+            fanouts = []
+
+            def fanout_factory(frame_size):
+                fanout = SinkFanout(
+                    camera_name, frame_size, sinks, encoder_cfg, pipeline_cfg, fps,
+                    lambda name, size, sink_encoder_cfg, sink_fps: create_encoder(
+                        output_dir / f"{name}{output_extension(sink_encoder_cfg)}", size, sink_fps, sink_encoder_cfg)
+                )
+                fanouts.append(fanout)
+                return fanout
+
+            # Los cortes del stream se reintentan sin afectar al resto de cámaras
+            supervisor = CameraSupervisor(
+                camera_name,
+                stop_event,
+                self.cfg.get("supervisor"),
+                self.metrics.camera(camera_name),
+                lambda name, gap: write_gap_marker(self.storage.archive_dir(output_dir.name), gap),
+                self.startup.first_frame if self.startup else None
+            )
+            if sinks:
+                writer = supervisor.hold(fanout_factory)
+                session_pipeline_cfg = sinks_pipeline_cfg(sinks, encoder_cfg, pipeline_cfg, fps)
+            else:
+                writer = supervisor.hold(lambda frame_size: create_encoder(video_path, frame_size, fps, encoder_cfg))
+                session_pipeline_cfg = pipeline_cfg
+            # Con el tamaño de `get_camera_properties` el encoder arranca mientras se abre el stream
+            frame_size = camera_frame_size(self.model, camera_name, session_pipeline_cfg)
+            if frame_size is not None:
+                writer.prepare(frame_size)
+            load = self.scheduler.camera(camera_name, camera_priority(self.cfg, camera_name), fps)
+
+            def session(remaining):
+                with self.model.open_stream(camera_name, processed=False, timeout=10) as response:
+                    # Lectura, extracción, decodificación y escritura corren en etapas separadas
+                    pipeline = CameraPipeline(
+                        camera_name,
+                        response,
+                        writer.open,
+                        session_pipeline_cfg,
+                        stop_event,
+                        self.metrics.camera(camera_name),
+                        create_anonymizer(camera_name, self.model, self.cfg.get("anonymize")),
+                        load,
+                        self.storage
+                    )
+                    return pipeline.run(remaining)
+
+            # Las cámaras añadidas en caliente terminan con el resto
+            stats = supervisor.run(session, max(0.0, self.deadline - time.time()))
+
+            outputs = video_outputs(fanouts, stats["connected"]) if sinks else [
+                (video_path, stats["fps"], writer.needs_fps_fix)]
+            if writer.frame_size:
+                for path, _, _ in outputs:
+                    try:
+                        os.chmod(path, 0o777)
+                    except Exception as e:
+                        logger.error(f"Error al cambiar permisos del video {path}: {e}")
+
+            logger.info(f"{camera_name}: Grabación finalizada. FPS promedio: {stats['fps']:.2f}. "
+                        f"Frames descartados: {stats['dropped']}. Reconexiones: {stats['reconnects']}, "
+                        f"huecos: {stats['gap_seconds']:.1f}s, "
+                        f"bloqueos: {stats['stalls']} ({stats['stall_seconds']:.1f}s)")
+
+            # Solo el encoder de OpenCV necesita re-codificar el video para ajustar los FPS
+            if writer.frame_size:
+                for path, path_fps, needs_fps_fix in outputs:
+                    self.finalize_segment(path, path_fps, needs_fps_fix, camera_name)
+
         except Exception as e:
             logger.error(f"Error en la grabación de la cámara {camera_name}: {e}")
 
-    def adjust_video_fps(self, video_path, target_fps):
-        try:
-            temp_path = str(video_path).replace(".mp4", "_temp.mp4")
-            command = [
-                "ffmpeg", "-i", str(video_path), "-filter:v", f"fps=fps={target_fps}",
-                "-c:a", "copy", temp_path
-            ]
-            # Redirigir la salida a DEVNULL para suprimir los mensajes
-            subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            os.replace(temp_path, video_path)
-            try: 
-                os.chmod(video_path, 0o777) 
+    def finalize_segment(self, video_path, fps, needs_fps_fix, camera_name=None):
+        """
+        Encola el post-procesado del video sin esperar a que termine.
+
+        Args:
+            video_path (Path): Video finalizado.
+            fps (float): FPS medios reales de la grabación.
+            needs_fps_fix (bool): Si el encoder necesita re-codificar para ajustar los FPS.
+            camera_name (str, optional): Cámara del video, para las métricas.
+        """
+        tasks = (["fps_fix"] if needs_fps_fix and fps else []) + self.postprocessor.cfg["tasks"]
+        self.postprocessor.submit(video_path, tasks, fps=fps, camera=camera_name)
+
+    def apply_config(self, cfg, diff):
+        """
+        Aplica los cambios de cfg.json durante la grabación (ver `ConfigWatcher`).
+
+        Las cámaras nuevas graban hasta el final del vídeo en curso y las eliminadas lo
+        cierran ya; los cambios de perfil se aplican en la siguiente grabación.
+        """
+        self.cfg = cfg
+        for camera_name in diff["removed"]:
+            logger.info(f"{camera_name}: Eliminada de la configuración; se cierra su grabación.")
+            self.cameras.stop(camera_name)
+            self.scheduler.remove(camera_name)
+        if diff["api"] and self.watcher.reload_cfg["reload_api"]:
+            try:
+                self.model.load_cameras_and_models()
             except Exception as e:
-                logger.error(f"Error al cambiar permisos del video {video_path}: {e}")
-            logger.info(f"Video de {video_path} ajustado a {target_fps:.2f} FPS.")
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Error al ajustar FPS del video {video_path}: {e}")
+                logger.error(f"Error recargando las cámaras en api-yolo: {e}")
+        for camera_name in diff["added"]:
+            logger.info(f"{camera_name}: Nueva cámara en la configuración; se inicia su grabación.")
+            self.cameras.start(camera_name)
+        for camera_name in diff["changed"]:
+            logger.info(f"{camera_name}: Configuración modificada; se aplicará en la próxima grabación.")
+
+    def record_processes(self, output_dir):
+        """
+        Graba todas las cámaras repartiéndolas entre procesos de ingesta.
+
+        Args:
+            output_dir (Path): Directorio de salida para guardar los videos.
+        """
+        engine = ProcessEngine(self.model.uri, self.cfg, output_dir, self.fixed_fps,
+                               self.video_duration, self.stop_event, self.metrics,
+                               self.startup.first_frame if self.startup else None)
+        for camera_name, stats in engine.run().items():
+            if stats.get("error"):
+                logger.error(f"Error en la grabación de la cámara {camera_name}: {stats['error']}")
+            logger.info(f"{camera_name}: Grabación finalizada. FPS promedio: {stats.get('fps', 0.0):.2f}. "
+                        f"Frames descartados: {stats.get('dropped')}, en memoria compartida: {stats.get('ring_dropped')}")
+            if "needs_fps_fix" in stats:
+                self.finalize_segment(stats["output_path"], stats.get("fps"), stats["needs_fps_fix"], camera_name)
 
     def record_all(self):
         """
         Graba videos de todas las cámaras simultáneamente utilizando hilos.
         """
+        self.stop_event.clear()
+        self.storage.start(self.postprocessor.pending_paths())
         self.load_cameras_and_models()
 
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_dir = Path("../files") / timestamp
-        output_dir.mkdir(parents=True, exist_ok=True)
-        os.chmod(output_dir, 0o777)
+        output_dir = self.storage.segment_dir(timestamp)
+        self.deadline = time.time() + self.video_duration
 
         logger.info("Iniciando grabación para todas las cámaras...")
 
-        self.stop_event = False
-        with ThreadPoolExecutor(max_workers=len(self.cfg["cameras"])) as executor:
-            futures = [
-                executor.submit(self.record_camera, camera["name"], output_dir)
-                for camera in self.cfg["cameras"]
-            ]
+        if (self.cfg.get("engine") or {}).get("mode") == "processes":
+            self.record_processes(output_dir)
+        else:
+            self.scheduler.start()
+            try:
+                self.cameras = CameraThreads(lambda name, stop: self.record_camera(name, output_dir, stop),
+                                             self.stop_event)
+                for camera in self.cfg["cameras"]:
+                    self.cameras.start(camera["name"])
+                self.watcher.start()
 
-            # Esperar a que todos los procesos terminen
-            for future in futures:
-                future.result()
+                # Esperar a que todas las cámaras terminen, también las añadidas mientras tanto
+                self.cameras.wait()
+            finally:
+                self.watcher.stop()
+                self.scheduler.stop()
 
         logger.info("Grabación completada para todas las cámaras.")
 
     def stop(self):
         """Detiene el proceso de grabación."""
-        self.stop_event = True
+        self.stop_event.set()
         logger.info("Grabación detenida.")
 
 if __name__ == "__main__":
@@ -180,3 +264,10 @@ if __name__ == "__main__":
         recorder.record_all()
     except KeyboardInterrupt:
         recorder.stop()
+    finally:
+        # api-yolo solo se detiene al terminar, nunca por el fallo de una cámara
+        recorder.model.stop_process()
+        # Los trabajos que no hayan empezado se retoman en la siguiente ejecución
+        recorder.postprocessor.shutdown()
+        recorder.storage.close(recorder.postprocessor.pending_paths())
+        recorder.metrics_service.close()
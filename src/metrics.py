@@ -0,0 +1,436 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METRICS_CFG = {
+    "enabled": True,
+    "host": "127.0.0.1",
+    "port": 9464,
+    "sample_seconds": 5,
+    "snapshot_path": None,
+    "snapshot_seconds": 60,
+}
+
+STAGES = ("read", "split", "decode", "anonymize", "encode")
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+JOB_BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        """
+        Histograma de cubetas fijas (límites superiores en segundos).
+
+        `observe` solo hace una búsqueda binaria y tres sumas, así que puede llamarse
+        en cada frame.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def quantile(self, q):
+        """Cuantil aproximado: límite superior de la cubeta que lo contiene."""
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        accumulated = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            accumulated += count
+            if accumulated >= target:
+                return bound if bound != float("inf") else self.buckets[-1]
+        return self.buckets[-1]
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "avg": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class CameraMetrics:
+    def __init__(self, camera_name):
+        """
+        Contadores e histogramas de una cámara.
+
+        Cada contador lo incrementa una sola etapa del pipeline, así que no necesitan
+        lock. Las colas y el encoder en uso se enlazan con `bind_queues`/`bind_encoder`
+        y se leen al exportar; al desenlazarlos sus descartes se acumulan para que los
+        contadores no retrocedan entre segmentos.
+
+        Args:
+            camera_name (str): Nombre de la cámara.
+        """
+        self.camera_name = camera_name
+        self.frames_in = 0
+        self.frames_decimated = 0
+        self.frames_shed = 0
+        self.frames_paused = 0
+        self.frames_late = 0
+        self.frames_repeated = 0
+        self.stalls = 0
+        self.stall_seconds = 0.0
+        # Últimos bloqueos (el stream repetía el mismo JPEG)
+        self.recent_stalls = deque(maxlen=20)
+        self.frames_written = 0
+        self.bytes_in = 0
+        self.connections = 0
+        self.reconnects = 0
+        # Nivel de degradación del planificador de carga (0 = calidad completa)
+        self.shed_level = 0
+        self.stages = {stage: Histogram(STAGE_BUCKETS) for stage in STAGES}
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.rates = {"ingest_fps": 0.0, "written_fps": 0.0, "bytes_per_second": 0.0}
+
+        self._queues = ()
+        self._queue_offsets = {}
+        self._encoder = None
+        self._encoder_offset = (0, 0)
+        self._dropped_base = {}
+        self._duplicated_base = 0
+        self._skipped_base = 0
+        self._last_sample = (time.time(), 0, 0, 0)
+
+    def add_stall(self, stall):
+        self.stalls += 1
+        self.stall_seconds += stall["seconds"]
+        self.recent_stalls.append(stall)
+
+    def bind_queues(self, queues):
+        self._fold_queues()
+        self.add_queues(queues)
+
+    def add_queues(self, queues):
+        """Enlaza más colas sin soltar las actuales (p. ej. las de cada salida del encoder)."""
+        for q in queues:
+            # Una cola que sigue viva tras una reconexión ya tiene descartes acumulados
+            self._queue_offsets[id(q)] = q.dropped
+        self._queues += tuple(queues)
+
+    def bind_encoder(self, encoder):
+        self._fold_encoder()
+        self._encoder = encoder
+        # Un encoder que sigue abierto tras una reconexión ya tiene contadores acumulados
+        self._encoder_offset = (getattr(encoder, "frames_duplicated", 0), getattr(encoder, "frames_dropped", 0))
+
+    def unbind(self):
+        """Acumula los descartes de las colas y del encoder actuales y los suelta."""
+        self._fold_queues()
+        self._fold_encoder()
+
+    def _fold_queues(self):
+        for q in self._queues:
+            stage = q.name.rsplit(":", 1)[-1]
+            self._dropped_base[stage] = self._dropped_base.get(stage, 0) + q.dropped - self._queue_offsets.get(id(q), 0)
+        self._queues = ()
+        self._queue_offsets = {}
+
+    def _fold_encoder(self):
+        if self._encoder is not None:
+            self._duplicated_base += getattr(self._encoder, "frames_duplicated", 0) - self._encoder_offset[0]
+            self._skipped_base += getattr(self._encoder, "frames_dropped", 0) - self._encoder_offset[1]
+        self._encoder = None
+        self._encoder_offset = (0, 0)
+
+    def dropped(self):
+        """Frames descartados por cola (`decode`, `write`...)."""
+        dropped = dict(self._dropped_base)
+        for q in self._queues:
+            stage = q.name.rsplit(":", 1)[-1]
+            dropped[stage] = dropped.get(stage, 0) + q.dropped - self._queue_offsets.get(id(q), 0)
+        return dropped
+
+    def queue_depth(self):
+        return {q.name.rsplit(":", 1)[-1]: q.qsize() for q in self._queues}
+
+    def duplicated(self):
+        """Frames repetidos por el encoder para rellenar huecos de la rejilla CFR."""
+        return self._duplicated_base + getattr(self._encoder, "frames_duplicated", 0) - self._encoder_offset[0]
+
+    def skipped(self):
+        """Frames que el encoder descartó por caer en un hueco ya ocupado de la rejilla CFR."""
+        return self._skipped_base + getattr(self._encoder, "frames_dropped", 0) - self._encoder_offset[1]
+
+    def sample(self, now=None):
+        """Actualiza las tasas por segundo con los contadores desde la muestra anterior."""
+        now = now or time.time()
+        current = (now, self.frames_in, self.frames_written, self.bytes_in)
+        elapsed = now - self._last_sample[0]
+        if elapsed > 0:
+            self.rates = {
+                "ingest_fps": (current[1] - self._last_sample[1]) / elapsed,
+                "written_fps": (current[2] - self._last_sample[2]) / elapsed,
+                "bytes_per_second": (current[3] - self._last_sample[3]) / elapsed,
+            }
+        self._last_sample = current
+
+    def snapshot(self):
+        return {
+            "frames_in": self.frames_in,
+            "frames_decimated": self.frames_decimated,
+            "frames_shed": self.frames_shed,
+            "frames_paused": self.frames_paused,
+            "frames_late": self.frames_late,
+            "frames_repeated": self.frames_repeated,
+            "stalls": self.stalls,
+            "stall_seconds": self.stall_seconds,
+            "recent_stalls": list(self.recent_stalls),
+            "frames_written": self.frames_written,
+            "bytes_in": self.bytes_in,
+            **self.rates,
+            "dropped": self.dropped(),
+            "duplicated": self.duplicated(),
+            "skipped": self.skipped(),
+            "queue_depth": self.queue_depth(),
+            "connections": self.connections,
+            "reconnects": self.reconnects,
+            "shed_level": self.shed_level,
+            "stage_seconds": {stage: histogram.snapshot() for stage, histogram in self.stages.items()},
+            "latency_seconds": self.latency.snapshot(),
+        }
+
+
+def _labels(**labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def _render_histogram(lines, name, histogram, **labels):
+    accumulated = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        accumulated += count
+        lines.append(f"{name}_bucket{_labels(**labels, le=bound)} {accumulated}")
+    lines.append(f"{name}_bucket{_labels(**labels, le='+Inf')} {histogram.count}")
+    lines.append(f"{name}_sum{_labels(**labels)} {histogram.sum}")
+    lines.append(f"{name}_count{_labels(**labels)} {histogram.count}")
+
+
+class MetricsRegistry:
+    def __init__(self):
+        """Métricas de todas las cámaras y de los trabajos de post-procesado."""
+        self.cameras = {}
+        self.jobs = {}
+        self.job_failures = {}
+        # `PostProcessor.metrics`: profundidad de la cola de post-procesado
+        self.postprocess_queue = None
+        self._lock = threading.Lock()
+
+    def camera(self, camera_name):
+        """Devuelve (creándolas si no existen) las métricas de una cámara."""
+        with self._lock:
+            if camera_name not in self.cameras:
+                self.cameras[camera_name] = CameraMetrics(camera_name)
+            return self.cameras[camera_name]
+
+    def observe_job(self, camera_name, task, seconds, ok=True):
+        """Registra la duración de una tarea de post-procesado (ffmpeg, checksum...)."""
+        key = (camera_name, task)
+        with self._lock:
+            if key not in self.jobs:
+                self.jobs[key] = Histogram(JOB_BUCKETS)
+                self.job_failures[key] = 0
+            if not ok:
+                self.job_failures[key] += 1
+        self.jobs[key].observe(seconds)
+
+    def sample(self):
+        now = time.time()
+        for camera in list(self.cameras.values()):
+            camera.sample(now)
+
+    def snapshot(self):
+        return {
+            "timestamp": time.time(),
+            "cameras": {name: camera.snapshot() for name, camera in list(self.cameras.items())},
+            "postprocess": {
+                f"{camera_name}/{task}": {**histogram.snapshot(), "failures": self.job_failures[(camera_name, task)]}
+                for (camera_name, task), histogram in list(self.jobs.items())
+            },
+            "postprocess_queue": self.postprocess_queue() if self.postprocess_queue is not None else None,
+        }
+
+    def render_prometheus(self):
+        """Exporta las métricas en el formato de texto de Prometheus."""
+        cameras = list(self.cameras.values())
+        lines = []
+
+        def family(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(**labels)} {value}")
+
+        family("recorder_frames_in_total", "counter", "Frames extraídos del stream.",
+               [({"camera": c.camera_name}, c.frames_in) for c in cameras])
+        family("recorder_frames_decimated_total", "counter", "Frames descartados por el límite de FPS del perfil.",
+               [({"camera": c.camera_name}, c.frames_decimated) for c in cameras])
+        family("recorder_frames_shed_total", "counter", "Frames descartados por el planificador de carga.",
+               [({"camera": c.camera_name}, c.frames_shed) for c in cameras])
+        family("recorder_frames_paused_total", "counter", "Frames descartados por falta de espacio en disco.",
+               [({"camera": c.camera_name}, c.frames_paused) for c in cameras])
+        family("recorder_frames_late_total", "counter", "Frames descartados por llegar tarde al escritor.",
+               [({"camera": c.camera_name}, c.frames_late) for c in cameras])
+        family("recorder_frames_repeated_total", "counter", "Frames idénticos al anterior (no se decodifican).",
+               [({"camera": c.camera_name}, c.frames_repeated) for c in cameras])
+        family("recorder_stalls_total", "counter", "Bloqueos de la cámara (el stream repite el mismo frame).",
+               [({"camera": c.camera_name}, c.stalls) for c in cameras])
+        family("recorder_stall_seconds_total", "counter", "Segundos con la cámara bloqueada.",
+               [({"camera": c.camera_name}, c.stall_seconds) for c in cameras])
+        family("recorder_frames_written_total", "counter", "Frames entregados al encoder.",
+               [({"camera": c.camera_name}, c.frames_written) for c in cameras])
+        family("recorder_bytes_in_total", "counter", "Bytes leídos del stream.",
+               [({"camera": c.camera_name}, c.bytes_in) for c in cameras])
+        family("recorder_ingest_fps", "gauge", "Frames extraídos por segundo.",
+               [({"camera": c.camera_name}, c.rates["ingest_fps"]) for c in cameras])
+        family("recorder_written_fps", "gauge", "Frames escritos por segundo.",
+               [({"camera": c.camera_name}, c.rates["written_fps"]) for c in cameras])
+        family("recorder_bytes_per_second", "gauge", "Bytes leídos por segundo.",
+               [({"camera": c.camera_name}, c.rates["bytes_per_second"]) for c in cameras])
+        family("recorder_frames_dropped_total", "counter", "Frames descartados por cola llena.",
+               [({"camera": c.camera_name, "queue": q}, n) for c in cameras for q, n in c.dropped().items()])
+        family("recorder_frames_duplicated_total", "counter", "Frames repetidos para mantener los FPS constantes.",
+               [({"camera": c.camera_name}, c.duplicated()) for c in cameras])
+        family("recorder_frames_skipped_total", "counter", "Frames descartados para mantener los FPS constantes.",
+               [({"camera": c.camera_name}, c.skipped()) for c in cameras])
+        family("recorder_queue_depth", "gauge", "Elementos pendientes en cada cola del pipeline.",
+               [({"camera": c.camera_name, "queue": q}, n) for c in cameras for q, n in c.queue_depth().items()])
+        family("recorder_stream_connections_total", "counter", "Conexiones abiertas a /stream.",
+               [({"camera": c.camera_name}, c.connections) for c in cameras])
+        family("recorder_reconnects_total", "counter", "Reconexiones tras un corte del stream.",
+               [({"camera": c.camera_name}, c.reconnects) for c in cameras])
+        family("recorder_shed_level", "gauge", "Degradación por carga: 0 completa, 1 FPS, 2 resolución, 3 pausa.",
+               [({"camera": c.camera_name}, c.shed_level) for c in cameras])
+
+        lines.append("# HELP recorder_stage_seconds Tiempo de cada etapa del pipeline por chunk o frame.")
+        lines.append("# TYPE recorder_stage_seconds histogram")
+        for c in cameras:
+            for stage, histogram in c.stages.items():
+                _render_histogram(lines, "recorder_stage_seconds", histogram, camera=c.camera_name, stage=stage)
+        lines.append("# HELP recorder_frame_latency_seconds Tiempo desde la llegada de un frame hasta su escritura.")
+        lines.append("# TYPE recorder_frame_latency_seconds histogram")
+        for c in cameras:
+            _render_histogram(lines, "recorder_frame_latency_seconds", c.latency, camera=c.camera_name)
+
+        jobs = list(self.jobs.items())
+        lines.append("# HELP recorder_postprocess_task_seconds Duración de las tareas de post-procesado.")
+        lines.append("# TYPE recorder_postprocess_task_seconds histogram")
+        for (camera_name, task), histogram in jobs:
+            _render_histogram(lines, "recorder_postprocess_task_seconds", histogram, camera=camera_name, task=task)
+        family("recorder_postprocess_failures_total", "counter", "Tareas de post-procesado fallidas.",
+               [({"camera": camera_name, "task": task}, self.job_failures[(camera_name, task)])
+                for (camera_name, task), _ in jobs])
+        if self.postprocess_queue is not None:
+            queue = self.postprocess_queue()
+            family("recorder_postprocess_queue_depth", "gauge", "Trabajos de post-procesado en cola o en curso.",
+                   [({"state": "pending"}, queue["pending"]), ({"state": "running"}, queue["running"])])
+            family("recorder_postprocess_oldest_pending_seconds", "gauge",
+                   "Antigüedad del trabajo de post-procesado más antiguo en cola.",
+                   [({}, queue["oldest_pending_age"])])
+        return "\n".join(lines) + "\n"
+
+
+def _make_handler(registry):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = registry.render_prometheus().encode()
+                content_type = "text/plain; version=0.0.4; charset=utf-8"
+            elif self.path == "/metrics.json":
+                body = json.dumps(registry.snapshot()).encode()
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return MetricsHandler
+
+
+class MetricsService:
+    def __init__(self, registry, metrics_cfg=None):
+        """
+        Publica un `MetricsRegistry`: endpoint HTTP (`/metrics` en formato Prometheus y
+        `/metrics.json`), cálculo periódico de tasas y, opcionalmente, instantáneas JSON
+        en `snapshot_path` cada `snapshot_seconds`.
+
+        Args:
+            registry (MetricsRegistry): Métricas a publicar.
+            metrics_cfg (dict, optional): Sección `metrics` de cfg.json.
+        """
+        self.registry = registry
+        self.cfg = {**DEFAULT_METRICS_CFG, **(metrics_cfg or {})}
+        self.server = None
+        self._stop = threading.Event()
+        self._threads = []
+        if not self.cfg["enabled"]:
+            return
+        if self.cfg["port"]:
+            try:
+                self.server = ThreadingHTTPServer((self.cfg["host"], int(self.cfg["port"])), _make_handler(registry))
+                self.server.daemon_threads = True
+                self._start(self.server.serve_forever, "metrics-http")
+                logger.info(f"Métricas disponibles en http://{self.cfg['host']}:{self.cfg['port']}/metrics")
+            except OSError as e:
+                logger.error(f"No se pudo abrir el endpoint de métricas en el puerto {self.cfg['port']}: {e}")
+        self._start(self._sample_loop, "metrics-sampler")
+
+    def _start(self, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _sample_loop(self):
+        last_snapshot = time.time()
+        while not self._stop.wait(self.cfg["sample_seconds"]):
+            self.registry.sample()
+            if self.cfg["snapshot_path"] and time.time() - last_snapshot >= self.cfg["snapshot_seconds"]:
+                last_snapshot = time.time()
+                self.write_snapshot()
+
+    def write_snapshot(self):
+        """Escribe la instantánea JSON de forma atómica."""
+        path = Path(self.cfg["snapshot_path"])
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f"{path.name}.tmp")
+            tmp.write_text(json.dumps(self.registry.snapshot(), indent=4))
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.error(f"No se pudo guardar la instantánea de métricas {path}: {e}")
+
+    def close(self):
+        self._stop.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.cfg["enabled"] and self.cfg["snapshot_path"]:
+            self.write_snapshot()
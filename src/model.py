@@ -1,24 +1,57 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
 
 
 class Model:
-    def __init__(self, uri_device, cfg_path, timeout=200):
+    def __init__(self, uri_device, cfg_path, timeout=200, pool_maxsize=32):
         """Initialize the Model class to interact with the specified endpoints in the API.
 
+        All requests share one `requests.Session`, so TCP connections to the API are
+        kept alive and reused instead of being opened for every call.
+
         Args:
             uri_device (str): Base URL of the API. E.g., "http://api:5001".
             cfg_path (str): Path to the configuration file.
             timeout (int, optional): Timeout for API requests. Defaults to 200.
+            pool_maxsize (int, optional): Maximum pooled connections to the API, at least
+                one per concurrent camera stream. Defaults to 32.
         """
         self.uri = uri_device
         self.cfg_path = cfg_path
         self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def close(self):
+        """Close the pooled connections."""
+        self.session.close()
+
+    def open_stream(self, camera_name, processed=False, timeout=None):
+        """Open the MJPEG `/stream` of a camera.
+
+        Args:
+            camera_name (str): The name of the camera.
+            processed (bool): Whether to stream the processed image. Defaults to False.
+            timeout (float, optional): Connect/read timeout. Defaults to the model timeout.
+
+        Returns:
+            requests.Response: Streaming response; use it as a context manager.
+        """
+        url = f"{self.uri}/stream"
+        params = {'camera_name': camera_name, 'processed': processed}
+        response = self.session.get(url, params=params, stream=True, timeout=timeout or self.timeout)
+        if not response.ok:
+            response.close()
+            raise Exception("Failed to open the stream")
+        return response
 
     def load_cameras_and_models(self):
         """Load cameras and models given the configuration path."""
         url = f"{self.uri}/load_cameras_and_models"
-        response = requests.post(url, params={'cfg_path': self.cfg_path}, timeout=self.timeout)
+        response = self.session.post(url, params={'cfg_path': self.cfg_path}, timeout=self.timeout)
         if not response.ok:
             raise Exception("Failed to load cameras and models")
         return response.json()
@@ -26,7 +59,7 @@ class Model:
     def start_process(self):
         """Start the process for detection and inference."""
         url = f"{self.uri}/start_process"
-        response = requests.post(url, timeout=self.timeout)
+        response = self.session.post(url, timeout=self.timeout)
         if not response.ok:
             raise Exception("Failed to start the process")
         return response.json()
@@ -34,7 +67,7 @@ class Model:
     def stop_process(self):
         """Stop the process for detection and inference."""
         url = f"{self.uri}/stop_process"
-        response = requests.post(url, timeout=self.timeout)
+        response = self.session.post(url, timeout=self.timeout)
         if not response.ok:
             raise Exception("Failed to stop the process")
         return response.json()
@@ -42,7 +75,7 @@ class Model:
     def check_status(self):
         """Check the status of the process."""
         url = f"{self.uri}/check_status"
-        response = requests.get(url, timeout=self.timeout)
+        response = self.session.get(url, timeout=self.timeout)
         if not response.ok:
             raise Exception("Failed to check the status")
         return response.json()
@@ -50,7 +83,7 @@ class Model:
     def get_results(self):
         """Get the results of the detection and inference process."""
         url = f"{self.uri}/get_results"
-        response = requests.get(url, timeout=self.timeout)
+        response = self.session.get(url, timeout=self.timeout)
         if not response.ok:
             raise Exception("Failed to get the results")
         return response.json()
@@ -85,7 +118,7 @@ class Model:
             'show_contours': show_contours,
             'show_only_segmentation': show_only_segmentation
         }
-        response = requests.get(url, params=params, timeout=self.timeout)
+        response = self.session.get(url, params=params, timeout=self.timeout)
         if not response.ok:
             raise Exception("Failed to get the image")
         return response.content
@@ -120,7 +153,7 @@ class Model:
             'show_contours': show_contours,
             'show_only_segmentation': show_only_segmentation
         }
-        response = requests.get(url, params=params, timeout=self.timeout)
+        response = self.session.get(url, params=params, timeout=self.timeout)
         if not response.ok:
             raise Exception("Failed to get the image and detections")
         return response.json()
@@ -134,7 +167,7 @@ class Model:
         """
         url = f"{self.uri}/get_calibration"
         params = {'camera_name': camera_name}
-        response = requests.get(url, params=params, timeout=self.timeout)
+        response = self.session.get(url, params=params, timeout=self.timeout)
         if not response.ok:
             raise Exception("Failed to get the calibration plot")
         return response.content
@@ -151,7 +184,7 @@ class Model:
         """
         url = f"{self.uri}/get_camera_properties"
         params = {'camera_name': camera_name}
-        response = requests.get(url, params=params, timeout=self.timeout)
+        response = self.session.get(url, params=params, timeout=self.timeout)
         if not response.ok:
             raise Exception("Failed to get camera properties")
         return response.json()
@@ -175,7 +208,7 @@ class Model:
         if target is not None:
             params['target'] = json.dumps(target)
         
-        response = requests.post(url, params=params, timeout=self.timeout)
+        response = self.session.post(url, params=params, timeout=self.timeout)
         if not response.ok:
             raise Exception("Failed to update camera calibration")
         return response.json()
\ No newline at end of file
@@ -0,0 +1,589 @@
+import time
+import zlib
+import heapq
+import socket
+import logging
+import threading
+from collections import deque
+
+import cv2
+import numpy as np
+
+from frame_extractor import MJPEGFrameExtractor, boundary_from_content_type, jpeg_dimensions
+from metrics import CameraMetrics
+from profiles import FrameDecimator, fit_resolution, reduced_decode_flag
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ("block", "drop_oldest", "drop_newest")
+REPEAT_POLICIES = ("duplicate", "drop", "off")
+
+DEFAULT_PIPELINE_CFG = {
+    "chunk_size": 65536,
+    "chunk_queue_size": 256,
+    "frame_queue_size": 32,
+    "decoders": 2,
+    "overflow_policy": "drop_oldest",
+    "log_every": 100,
+    "max_fps": 0,
+    "resolution": None,
+    "repeat_policy": "duplicate",
+    "stall_seconds": 2.0,
+}
+
+
+def iter_stream_chunks(response, chunk_size):
+    """Itera los datos del stream según llegan, sin esperar a completar `chunk_size`.
+
+    `iter_content` bloquea hasta reunir `chunk_size` bytes, lo que agrupa varios frames
+    en una misma lectura y falsea su hora de llegada. Con urllib3 2.x se usa `read1`,
+    que devuelve lo disponible en una sola lectura del socket.
+    """
+    read1 = getattr(response.raw, "read1", None)
+    if read1 is None:
+        yield from response.iter_content(chunk_size=chunk_size)
+        return
+    while True:
+        chunk = read1(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def interrupt_stream(response):
+    """Corta el socket de una respuesta en streaming para desbloquear una lectura en curso.
+
+    `response.close()` desde otro hilo no despierta un `read1` bloqueado: con una cámara
+    en silencio el lector esperaría al timeout de lectura. `shutdown` del socket hace
+    que la lectura termine al momento.
+    """
+    raw = getattr(response, "raw", None)
+    candidates = (
+        lambda: raw._connection.sock,
+        lambda: raw._fp.fp.raw._sock,
+    )
+    for candidate in candidates:
+        try:
+            sock = candidate()
+        except AttributeError:
+            continue
+        if sock is None:
+            continue
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        return True
+    return False
+
+
+class QueueClosed(Exception):
+    """La cola se cerró y ya no quedan elementos pendientes."""
+
+
+class BoundedQueue:
+    def __init__(self, maxsize, policy="block", name="queue"):
+        """
+        Cola FIFO acotada entre dos etapas del pipeline.
+
+        Cuando está llena, `policy` decide qué ocurre al insertar:
+        - "block": el productor espera a que haya hueco.
+        - "drop_oldest": se descarta el elemento más antiguo de la cola.
+        - "drop_newest": se descarta el elemento que se intenta insertar.
+
+        Args:
+            maxsize (int): Capacidad máxima.
+            policy (str): Política de desbordamiento. Defaults to "block".
+            name (str): Nombre para logs y métricas.
+        """
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Política de desbordamiento no soportada: {policy}")
+        self.maxsize = max(1, int(maxsize))
+        self.policy = policy
+        self.name = name
+        self.dropped = 0
+        self._items = deque()
+        self._closed = False
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def qsize(self):
+        return len(self._items)
+
+    def put(self, item):
+        """Inserta un elemento aplicando la política de desbordamiento.
+
+        Returns:
+            bool: False si el elemento insertado se descartó.
+        """
+        with self._lock:
+            if self._closed:
+                return False
+            if len(self._items) >= self.maxsize:
+                if self.policy == "drop_newest":
+                    self.dropped += 1
+                    return False
+                if self.policy == "drop_oldest":
+                    self._items.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self._items) >= self.maxsize and not self._closed:
+                        self._not_full.wait()
+                    if self._closed:
+                        return False
+            self._items.append(item)
+            self._not_empty.notify()
+            return True
+
+    def get(self, timeout=None):
+        """Extrae el siguiente elemento.
+
+        Raises:
+            QueueClosed: Si la cola está cerrada y vacía.
+            TimeoutError: Si vence `timeout` sin elementos.
+        """
+        with self._lock:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self._items:
+                if self._closed:
+                    raise QueueClosed(self.name)
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError(self.name)
+                self._not_empty.wait(remaining)
+            item = self._items.popleft()
+            self._not_full.notify()
+            return item
+
+    def close(self):
+        """Impide nuevas inserciones; los consumidores vacían lo pendiente y terminan."""
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+
+class Frame:
+    __slots__ = ("seq", "timestamp", "data", "image", "repeat")
+
+    def __init__(self, seq, timestamp, data, image=None, repeat=False):
+        """
+        Frame en tránsito por el pipeline.
+
+        Args:
+            seq (int): Número de secuencia asignado por el extractor.
+            timestamp (float): Hora de llegada del chunk que completó el frame.
+            data (bytes): JPEG comprimido.
+            image (np.ndarray, optional): Imagen BGR una vez decodificada.
+            repeat (bool, optional): Mismo JPEG que el frame anterior; no lleva datos y
+                el escritor repite el último frame escrito con la nueva hora.
+        """
+        self.seq = seq
+        self.timestamp = timestamp
+        self.data = data
+        self.image = image
+        self.repeat = repeat
+
+    def __lt__(self, other):
+        return self.seq < other.seq
+
+
+class CameraPipeline:
+    def __init__(self, camera_name, response, encoder_factory, pipeline_cfg=None, stop_event=None, metrics=None,
+                 anonymizer=None, load=None, storage=None):
+        """
+        Pipeline de grabación por etapas de una cámara:
+
+        lector de red -> extractor de frames -> decodificadores -> escritor
+
+        Cada etapa corre en su propio hilo y se comunica con la siguiente mediante una
+        `BoundedQueue`. La cola de chunks siempre bloquea (descartar bytes corrompería
+        el stream), pero es amplia y el extractor es barato. Las colas de frames aplican
+        `overflow_policy`, de modo que un disco o un decodificador lento descartan frames
+        completos en lugar de frenar la lectura del socket.
+
+        Si el encoder admite JPEG directamente (`decode_free`) no se arrancan
+        decodificadores y los frames pasan del extractor al escritor.
+
+        Con `max_fps` el extractor descarta los frames sobrantes antes de copiarlos o
+        decodificarlos. Con `resolution` los frames se decodifican directamente a 1/2,
+        1/4 u 1/8 (`IMREAD_REDUCED_COLOR_*`) y el encoder recibe el tamaño reducido.
+
+        Con `anonymizer` los decodificadores borran las caras de cada frame. Si además
+        el encoder es `decode_free`, solo se decodifican (y se re-codifican a JPEG) los
+        frames con alguna cara prevista; el resto se escribe sin tocar.
+
+        Con `load` el planificador de carga puede reducir los FPS, decodificar a menor
+        resolución (el frame se re-escala al tamaño del encoder) o pausar la cámara.
+        Con `storage` no se escribe nada mientras falte espacio en disco (`paused`).
+
+        Cada frame se identifica por su longitud y el CRC32 del JPEG antes de copiarlo.
+        Si api-yolo repite el mismo JPEG (cámara bloqueada) no se decodifica: con
+        `repeat_policy` `duplicate` se repite el último frame escrito con la nueva hora y
+        con `drop` se descarta. Las repeticiones de al menos `stall_seconds` se registran
+        como bloqueos de la cámara (`stalls`).
+
+        Args:
+            camera_name (str): Nombre de la cámara.
+            response (requests.Response): Respuesta en streaming de `/stream`.
+            encoder_factory (callable): Recibe (ancho, alto) y devuelve el encoder.
+            pipeline_cfg (dict, optional): Sección `pipeline` de cfg.json.
+            stop_event (threading.Event, optional): Evento global de parada.
+            metrics (CameraMetrics, optional): Métricas de la cámara (contadores, tiempos
+                por etapa y latencia).
+            anonymizer (FaceAnonymizer, optional): Borrado de caras; el pipeline lo cierra
+                al terminar.
+            load (CameraLoad, optional): Degradación de la cámara según `LoadScheduler`.
+            storage (Storage, optional): Almacenamiento; pausa la grabación sin espacio.
+        """
+        self.camera_name = camera_name
+        self.response = response
+        self.encoder_factory = encoder_factory
+        self.cfg = {**DEFAULT_PIPELINE_CFG, **(pipeline_cfg or {})}
+        self.stop_event = stop_event or threading.Event()
+        self.metrics = metrics or CameraMetrics(camera_name)
+        self.anonymizer = anonymizer
+        self.load = load
+        self.storage = storage
+
+        policy = self.cfg["overflow_policy"]
+        self.chunk_queue = BoundedQueue(self.cfg["chunk_queue_size"], "block", f"{camera_name}:chunks")
+        self.decode_queue = BoundedQueue(self.cfg["frame_queue_size"], policy, f"{camera_name}:decode")
+        self.write_queue = BoundedQueue(self.cfg["frame_queue_size"], policy, f"{camera_name}:write")
+
+        self.decimator = FrameDecimator(self.cfg["max_fps"]) if self.cfg["max_fps"] else None
+        if self.cfg["repeat_policy"] not in REPEAT_POLICIES:
+            raise ValueError(f"Política de repeticiones no soportada: {self.cfg['repeat_policy']}")
+        self.encoder = None
+        self.frame_size = None
+        self.native_size = None
+        self.frames_in = 0
+        self.frames_decimated = 0
+        self.frames_written = 0
+        self.decode_errors = 0
+        self.frames_repeated = 0
+        self.stalls = []
+        self.start_time = None
+        self.error = None
+
+        self._done = threading.Event()
+        self._threads = []
+        self._decoders = []
+        self._seq = 0
+        self._fingerprint = None
+        self._stall = None
+        self._last_written = None
+        self._decode_flag = cv2.IMREAD_COLOR
+        self._box_scale = None
+
+    @property
+    def queues(self):
+        return (self.chunk_queue, self.decode_queue, self.write_queue)
+
+    def stats(self):
+        """Resumen de contadores del pipeline."""
+        elapsed = max(time.time() - self.start_time, 1e-6) if self.start_time else 0.0
+        return {
+            "camera": self.camera_name,
+            "elapsed": elapsed,
+            "frames_in": self.frames_in,
+            "decimated": self.frames_decimated,
+            "frames_written": self.frames_written,
+            "decode_errors": self.decode_errors,
+            "repeated": self.frames_repeated,
+            "stalls": list(self.stalls),
+            "fps": self.frames_written / elapsed if elapsed else 0.0,
+            "dropped": {q.name: q.dropped for q in self.queues},
+            "queue_depth": {q.name: q.qsize() for q in self.queues},
+        }
+
+    def run(self, duration):
+        """Graba hasta agotar `duration` segundos, recibir la parada o cerrarse el stream.
+
+        Al terminar se vacían todas las colas en orden, de modo que los frames ya
+        recibidos llegan al fichero antes de cerrar el encoder.
+
+        Returns:
+            dict: Estadísticas finales (ver `stats`).
+        """
+        self.start_time = time.time()
+        self.metrics.connections += 1
+        self.metrics.bind_queues(self.queues)
+        self._start()
+        deadline = self.start_time + duration
+        while not self.stop_event.is_set() and not self._done.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                logger.info(f"{self.camera_name}: Tiempo límite alcanzado ({time.time() - self.start_time:.2f}s).")
+                break
+            self._done.wait(min(remaining, 0.5))
+        self.shutdown()
+        if self.error is not None:
+            raise self.error
+        return self.stats()
+
+    def _start(self):
+        self._spawn(self._read_loop, "reader")
+        self._spawn(self._extract_loop, "extractor")
+        self._spawn(self._write_loop, "writer")
+
+    def _spawn(self, target, stage):
+        thread = threading.Thread(target=self._guard, args=(target,), name=f"{self.camera_name}-{stage}", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        return thread
+
+    def _guard(self, target):
+        try:
+            target()
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+            logger.error(f"{self.camera_name}: Error en la etapa {threading.current_thread().name}: {e}")
+            self._done.set()
+            # Ninguna etapa puede quedarse esperando a otra que ya no existe
+            for q in self.queues:
+                q.close()
+
+    def shutdown(self):
+        """Detiene la lectura y drena las etapas en orden."""
+        self._done.set()
+        interrupt_stream(self.response)
+        try:
+            self.response.close()
+        except Exception:
+            pass
+        for thread in self._threads:
+            thread.join()
+        self.metrics.unbind()
+        if self.anonymizer is not None:
+            self.anonymizer.close()
+
+    def _read_loop(self):
+        read_time = self.metrics.stages["read"]
+        try:
+            start = time.perf_counter()
+            for chunk in iter_stream_chunks(self.response, self.cfg["chunk_size"]):
+                read_time.observe(time.perf_counter() - start)
+                if self._done.is_set() or self.stop_event.is_set():
+                    break
+                if chunk:
+                    self.metrics.bytes_in += len(chunk)
+                    self.chunk_queue.put((time.time(), chunk))
+                start = time.perf_counter()
+        except Exception:
+            # Cerrar la respuesta desde otro hilo interrumpe la lectura con una excepción
+            if not self._done.is_set():
+                raise
+        finally:
+            self.chunk_queue.close()
+            self._done.set()
+
+    def _extract_loop(self):
+        extractor = MJPEGFrameExtractor(
+            boundary=boundary_from_content_type(self.response.headers.get("Content-Type"))
+        )
+        split_time = self.metrics.stages["split"]
+        output = None
+        try:
+            while True:
+                try:
+                    timestamp, chunk = self.chunk_queue.get()
+                except QueueClosed:
+                    break
+                start = time.perf_counter()
+                views = extractor.feed(chunk)
+                split_time.observe(time.perf_counter() - start)
+                for view in views:
+                    if output is None:
+                        output = self._resolve_output(view)
+                        if output is None:
+                            continue
+                    self.frames_in += 1
+                    self.metrics.frames_in += 1
+                    if self.anonymizer is not None:
+                        self.anonymizer.on_frame()
+                    if self.decimator is not None and not self.decimator.keep(timestamp):
+                        # Los frames sobrantes no se copian ni se decodifican
+                        self.frames_decimated += 1
+                        self.metrics.frames_decimated += 1
+                        continue
+                    if self.load is not None and not self.load.keep(timestamp):
+                        # Descartado por el planificador de carga
+                        self.metrics.frames_shed += 1
+                        continue
+                    if self.storage is not None and self.storage.paused:
+                        self.metrics.frames_paused += 1
+                        continue
+                    if self.cfg["repeat_policy"] != "off" and self._is_repeat(view, timestamp):
+                        if self.cfg["repeat_policy"] == "duplicate":
+                            output.put(Frame(self._seq, timestamp, None, repeat=True))
+                            self._seq += 1
+                        continue
+                    # La vista se invalida en el siguiente feed: se copia para otras etapas
+                    output.put(Frame(self._seq, timestamp, bytes(view)))
+                    self._seq += 1
+        finally:
+            self._end_stall(time.time())
+            (output or self.write_queue).close()
+            for decoder in self._decoders:
+                decoder.join()
+            self.write_queue.close()
+
+    def _is_repeat(self, view, timestamp):
+        """Compara la huella (longitud, CRC32) del JPEG con la del anterior y sigue los bloqueos."""
+        fingerprint = (len(view), zlib.crc32(view))
+        if fingerprint != self._fingerprint:
+            self._fingerprint = fingerprint
+            self._end_stall(timestamp)
+            return False
+        self.frames_repeated += 1
+        self.metrics.frames_repeated += 1
+        if self._stall is None:
+            self._stall = {"camera": self.camera_name, "start": timestamp, "frames": 0, "logged": False}
+        self._stall["frames"] += 1
+        if not self._stall["logged"] and timestamp - self._stall["start"] >= self.cfg["stall_seconds"]:
+            self._stall["logged"] = True
+            logger.warning(f"{self.camera_name}: Cámara bloqueada: el stream repite el mismo frame desde "
+                           f"hace {timestamp - self._stall['start']:.1f}s.")
+        return True
+
+    def _end_stall(self, timestamp):
+        stall, self._stall = self._stall, None
+        if stall is None or timestamp - stall["start"] < self.cfg["stall_seconds"]:
+            return
+        del stall["logged"]
+        stall["end"] = timestamp
+        stall["seconds"] = round(timestamp - stall["start"], 3)
+        self.stalls.append(stall)
+        self.metrics.add_stall(stall)
+        logger.warning(f"{self.camera_name}: Fin del bloqueo tras {stall['seconds']:.1f}s "
+                       f"({stall['frames']} frames repetidos).")
+
+    def _resolve_output(self, view):
+        """Crea el encoder con el tamaño del primer frame y decide si hace falta decodificar."""
+        frame_size = jpeg_dimensions(view)
+        if frame_size is None:
+            return None
+        self.native_size = frame_size
+        if self.cfg["resolution"]:
+            frame_size = fit_resolution(frame_size, self.cfg["resolution"])
+            if frame_size != self.native_size:
+                self._decode_flag = reduced_decode_flag(self.native_size, frame_size)
+                self._box_scale = np.array([frame_size[0] / self.native_size[0],
+                                            frame_size[1] / self.native_size[1]] * 2, np.float32)
+        self.frame_size = frame_size
+        self.encoder = self.encoder_factory(frame_size)
+        self.metrics.bind_encoder(self.encoder)
+        # Colas propias del encoder (una por salida con `SinkFanout`)
+        self.metrics.add_queues(getattr(self.encoder, "queues", ()))
+        if self.encoder.decode_free and self.anonymizer is None:
+            return self.write_queue
+        for i in range(max(1, int(self.cfg["decoders"]))):
+            self._decoders.append(self._spawn(self._decode_loop, f"decoder{i}"))
+        return self.decode_queue
+
+    def _decode_loop(self):
+        decode_time = self.metrics.stages["decode"]
+        anonymize_time = self.metrics.stages["anonymize"]
+        decode_free = self.encoder.decode_free
+        while True:
+            try:
+                frame = self.decode_queue.get()
+            except QueueClosed:
+                return
+            if frame.repeat:
+                # Repetición del frame anterior: no hay nada que decodificar
+                self.write_queue.put(frame)
+                continue
+            boxes = None
+            if self.anonymizer is not None:
+                boxes = self.anonymizer.boxes_at(frame.timestamp, self.native_size)
+                if self._box_scale is not None and len(boxes):
+                    boxes = boxes * self._box_scale
+                if decode_free and not len(boxes):
+                    # Sin caras el JPEG original se escribe tal cual, sin decodificar
+                    self.write_queue.put(frame)
+                    continue
+            start = time.perf_counter()
+            decode_flag = self._decode_flag
+            if self.load is not None:
+                decode_flag = self.load.decode_flag(self.native_size, self.frame_size, decode_flag)
+            frame.image = cv2.imdecode(np.frombuffer(frame.data, np.uint8), decode_flag)
+            if frame.image is not None and frame.image.shape[1::-1] != self.frame_size:
+                frame.image = cv2.resize(frame.image, self.frame_size, interpolation=cv2.INTER_AREA)
+            decode_time.observe(time.perf_counter() - start)
+            if frame.image is None:
+                self.decode_errors += 1
+                # Un frame que no se puede anonimizar no se escribe
+                frame.data = None
+            elif boxes is not None and len(boxes):
+                start = time.perf_counter()
+                self.anonymizer.apply(frame.image, boxes)
+                if decode_free:
+                    frame.data, frame.image = self.anonymizer.encode(frame.image), None
+                else:
+                    # El JPEG original aún tiene las caras: ninguna salida debe usarlo
+                    frame.data = None
+                anonymize_time.observe(time.perf_counter() - start)
+            # Se envía aunque falle para que el escritor no espere por su número de secuencia
+            self.write_queue.put(frame)
+
+    def _write_loop(self):
+        # Con varios decodificadores los frames llegan desordenados: como mucho hay
+        # `decoders` frames en vuelo, así que basta con reordenar esa ventana
+        window = max(1, int(self.cfg["decoders"]))
+        pending = []
+        next_seq = 0
+        try:
+            while True:
+                try:
+                    frame = self.write_queue.get(timeout=1.0)
+                except TimeoutError:
+                    if pending:
+                        next_seq = self._write(heapq.heappop(pending))
+                    continue
+                except QueueClosed:
+                    break
+                if frame.seq < next_seq:
+                    # Llegó después de que el escritor lo diera por perdido y siguiera adelante
+                    self.metrics.frames_late += 1
+                    logger.debug(f"{self.camera_name}: Frame {frame.seq} descartado por llegar tarde al escritor.")
+                    continue
+                heapq.heappush(pending, frame)
+                while pending and (pending[0].seq == next_seq or len(pending) > window):
+                    next_seq = self._write(heapq.heappop(pending))
+            while pending:
+                self._write(heapq.heappop(pending))
+        finally:
+            if self.encoder is not None:
+                self.encoder.release()
+
+    def _write(self, frame):
+        if frame.repeat:
+            if self._last_written is None:
+                return frame.seq + 1
+            # Se repite lo último escrito (ya anonimizado) con la hora del frame repetido
+            frame.image, frame.data = self._last_written
+        start = time.perf_counter()
+        write_frame = getattr(self.encoder, "write_frame", None)
+        if frame.image is not None and write_frame is not None:
+            # Con varias salidas el encoder recibe también el JPEG original
+            write_frame(frame.image, frame.data, frame.timestamp)
+        elif frame.image is not None:
+            self.encoder.write(frame.image, frame.timestamp)
+        elif self.encoder.decode_free and frame.data is not None:
+            self.encoder.write_jpeg(frame.data, frame.timestamp)
+        else:
+            return frame.seq + 1
+        if not frame.repeat:
+            self._last_written = (frame.image, frame.data)
+        self.metrics.stages["encode"].observe(time.perf_counter() - start)
+        self.metrics.latency.observe(time.time() - frame.timestamp)
+        self.metrics.frames_written += 1
+        self.frames_written += 1
+        if self.frames_written % self.cfg["log_every"] == 0:
+            dropped = sum(q.dropped for q in self.queues)
+            logger.info(f"{self.camera_name}: {self.frames_written} frames escritos, {dropped} descartados.")
+        return frame.seq + 1
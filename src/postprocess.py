@@ -0,0 +1,310 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+import subprocess
+from collections import deque
+from pathlib import Path
+
+from frame_index import complete_index
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POSTPROCESS_CFG = {
+    "workers": 1,
+    "nice": 10,
+    "ionice_class": 3,
+    "tasks": ["checksum"],
+    "state_path": "../files/postprocess_jobs.json",
+    "log_every_seconds": 60,
+}
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def temp_path(video_path):
+    """Ruta temporal junto al vídeo, conservando la extensión (`cam1_temp.mp4`)."""
+    video_path = Path(video_path)
+    return video_path.with_name(f"{video_path.stem}_temp{video_path.suffix}")
+
+
+def _run(command, prefix):
+    # Redirigir la salida a DEVNULL para suprimir los mensajes
+    subprocess.run(prefix + command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _chmod(path):
+    try:
+        os.chmod(path, 0o777)
+    except Exception as e:
+        logger.error(f"Error al cambiar permisos de {path}: {e}")
+
+
+def adjust_video_fps(video_path, target_fps, prefix=()):
+    """Re-codifica el vídeo con `fps=target_fps` (solo necesario con el encoder de OpenCV)."""
+    tmp = temp_path(video_path)
+    _run(["ffmpeg", "-y", "-i", str(video_path), "-filter:v", f"fps=fps={target_fps}", "-c:a", "copy", str(tmp)],
+         list(prefix))
+    os.replace(tmp, video_path)
+    _chmod(video_path)
+
+
+def remux(video_path, prefix=()):
+    """Reescribe el contenedor sin re-codificar; en mp4 mueve el índice al inicio."""
+    video_path = Path(video_path)
+    tmp = temp_path(video_path)
+    command = ["ffmpeg", "-y", "-i", str(video_path), "-c", "copy"]
+    if video_path.suffix == ".mp4":
+        command += ["-movflags", "+faststart"]
+    _run(command + [str(tmp)], list(prefix))
+    os.replace(tmp, video_path)
+    _chmod(video_path)
+
+
+def thumbnail(video_path, prefix=(), width=320):
+    """Genera `<vídeo>.jpg` con el primer frame escalado a `width` píxeles de ancho."""
+    video_path = Path(video_path)
+    output = video_path.with_suffix(".jpg")
+    _run(["ffmpeg", "-y", "-i", str(video_path), "-frames:v", "1", "-vf", f"scale={width}:-2", str(output)],
+         list(prefix))
+    _chmod(output)
+
+
+def checksum(video_path, prefix=()):
+    """Escribe `<vídeo>.sha256` con el formato de `sha256sum`."""
+    video_path = Path(video_path)
+    digest = hashlib.sha256()
+    with open(video_path, "rb") as f:
+        for block in iter(lambda: f.read(1048576), b""):
+            digest.update(block)
+    output = video_path.with_name(f"{video_path.name}.sha256")
+    output.write_text(f"{digest.hexdigest()}  {video_path.name}\n")
+    _chmod(output)
+
+
+TASKS = {
+    "fps_fix": lambda job, prefix: adjust_video_fps(job["path"], job["params"]["fps"], prefix),
+    "remux": lambda job, prefix: remux(job["path"], prefix),
+    "thumbnail": lambda job, prefix: thumbnail(job["path"], prefix),
+    "checksum": lambda job, prefix: checksum(job["path"], prefix),
+    "index": lambda job, prefix: complete_index(job["path"], prefix),
+}
+
+
+class PostProcessor:
+    def __init__(self, postprocess_cfg=None, metrics=None, storage=None):
+        """
+        Cola de post-procesado de segmentos con un pool acotado de hilos.
+
+        Los grabadores solo encolan trabajos (`submit`) y nunca esperan a que terminen.
+        Cada trabajo aplica en orden sus tareas (`fps_fix`, `remux`, `index`, `thumbnail`,
+        `checksum`) con prioridad de CPU y de disco reducidas (`nice`/`ionice`) para no
+        competir con la grabación. El estado de los trabajos se guarda en `state_path`,
+        así que tras una caída los trabajos pendientes o a medias se retoman.
+
+        Con `storage` cada vídeo se pasa al archivo (`Storage.commit`) al terminar sus
+        tareas, aunque alguna falle, de modo que el post-procesado trabaja en staging.
+
+        Args:
+            postprocess_cfg (dict, optional): Sección `postprocess` de cfg.json.
+            metrics (MetricsRegistry, optional): Registro donde anotar la duración de cada tarea
+                y la profundidad de la cola.
+            storage (Storage, optional): Almacenamiento de los segmentos.
+        """
+        self.cfg = {**DEFAULT_POSTPROCESS_CFG, **(postprocess_cfg or {})}
+        self.registry = metrics
+        self.storage = storage
+        self.state_path = Path(self.cfg["state_path"])
+        self.prefix = self._priority_prefix()
+        self.jobs = {}
+        self.completed = 0
+        self.failed = 0
+        self.durations = deque(maxlen=100)
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._closed = False
+        self._last_report = time.time()
+        self._load_state()
+        self._workers = [
+            threading.Thread(target=self._work_loop, name=f"postprocess-{i}", daemon=True)
+            for i in range(max(1, int(self.cfg["workers"])))
+        ]
+        for worker in self._workers:
+            worker.start()
+        if self.registry is not None:
+            # `/metrics` exporta la profundidad de la cola
+            self.registry.postprocess_queue = self.metrics
+
+    def _priority_prefix(self):
+        prefix = []
+        if self.cfg["ionice_class"] is not None and shutil.which("ionice"):
+            prefix += ["ionice", "-c", str(self.cfg["ionice_class"])]
+        if self.cfg["nice"] and shutil.which("nice"):
+            prefix += ["nice", "-n", str(self.cfg["nice"])]
+        return prefix
+
+    def _load_state(self):
+        if not self.state_path.exists():
+            return
+        try:
+            jobs = json.loads(self.state_path.read_text())
+        except (OSError, ValueError) as e:
+            logger.error(f"No se pudo leer el estado de post-procesado {self.state_path}: {e}")
+            return
+        for job in jobs:
+            if job["status"] in (PENDING, RUNNING):
+                # Un trabajo a medias se repite entero: las tareas escriben en temporales
+                job["status"] = PENDING
+                self.jobs[job["id"]] = job
+                self._queue.append(job["id"])
+        if self._queue:
+            logger.info(f"Retomando {len(self._queue)} trabajos de post-procesado pendientes.")
+
+    def _save_state(self):
+        """Guarda los trabajos no terminados de forma atómica. Requiere `_lock`."""
+        pending = [job for job in self.jobs.values() if job["status"] in (PENDING, RUNNING)]
+        try:
+            self.state_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.state_path.with_name(f"{self.state_path.name}.tmp")
+            tmp.write_text(json.dumps(pending, default=str))
+            os.replace(tmp, self.state_path)
+        except OSError as e:
+            logger.error(f"No se pudo guardar el estado de post-procesado: {e}")
+
+    def submit(self, path, tasks=None, **params):
+        """Encola un segmento para post-procesado sin bloquear al llamante.
+
+        Args:
+            path (Path): Vídeo a procesar.
+            tasks (list, optional): Tareas a aplicar. Defaults to las de cfg.json.
+            **params: Parámetros de las tareas (p. ej. `fps` para `fps_fix`, o `camera`
+                para las métricas).
+
+        Returns:
+            str | None: Identificador del trabajo, o None si no había nada que hacer.
+        """
+        tasks = [task for task in (tasks if tasks is not None else self.cfg["tasks"]) if task in TASKS]
+        if not tasks and self.storage is None:
+            return None
+        job = {
+            "id": uuid.uuid4().hex,
+            "path": str(path),
+            "tasks": tasks,
+            "params": params,
+            "status": PENDING,
+            "created": time.time(),
+        }
+        with self._lock:
+            self.jobs[job["id"]] = job
+            self._queue.append(job["id"])
+            self._save_state()
+            self._wakeup.notify()
+        return job["id"]
+
+    def pending_paths(self):
+        """Vídeos con trabajos sin terminar."""
+        with self._lock:
+            return [job["path"] for job in self.jobs.values() if job["status"] in (PENDING, RUNNING)]
+
+    def metrics(self):
+        """Profundidad de la cola y tiempos de los trabajos."""
+        with self._lock:
+            statuses = [job["status"] for job in self.jobs.values()]
+            oldest = min((self.jobs[job_id]["created"] for job_id in self._queue), default=None)
+        return {
+            "pending": statuses.count(PENDING),
+            "running": statuses.count(RUNNING),
+            "done": self.completed,
+            "failed": self.failed,
+            "oldest_pending_age": time.time() - oldest if oldest else 0.0,
+            "avg_job_seconds": sum(self.durations) / len(self.durations) if self.durations else 0.0,
+        }
+
+    def _work_loop(self):
+        while True:
+            with self._lock:
+                while not self._queue and not self._closed:
+                    self._wakeup.wait(timeout=self.cfg["log_every_seconds"])
+                    self._report()
+                if not self._queue:
+                    return
+                job = self.jobs[self._queue.popleft()]
+                job["status"] = RUNNING
+                self._save_state()
+            self._process(job)
+            with self._lock:
+                # Solo se conservan en memoria los trabajos activos
+                self.jobs.pop(job["id"], None)
+                if job["status"] == DONE:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+                self._save_state()
+                self._report()
+
+    def _process(self, job):
+        start = time.time()
+        camera_name = job["params"].get("camera") or Path(job["path"]).stem
+        try:
+            for task in job["tasks"]:
+                if not os.path.exists(job["path"]):
+                    raise FileNotFoundError(job["path"])
+                task_start = time.time()
+                ok = False
+                try:
+                    TASKS[task](job, self.prefix)
+                    ok = True
+                finally:
+                    if self.registry is not None:
+                        self.registry.observe_job(camera_name, task, time.time() - task_start, ok)
+            job["status"] = DONE
+        except Exception as e:
+            job["status"] = FAILED
+            job["error"] = str(e)
+            logger.error(f"Error en el post-procesado de {job['path']} ({job['tasks']}): {e}")
+        if self.storage is not None and os.path.exists(job["path"]):
+            try:
+                job["archived"] = str(self.storage.commit(job["path"]))
+            except Exception as e:
+                job["status"] = FAILED
+                job["error"] = str(e)
+                logger.error(f"Error pasando {job['path']} al archivo: {e}")
+        job["duration"] = time.time() - start
+        self.durations.append(job["duration"])
+        logger.info(f"Post-procesado de {job['path']} ({', '.join(job['tasks'])}): {job['status']} "
+                    f"en {job['duration']:.1f}s")
+
+    def _report(self):
+        """Registra periódicamente la profundidad de la cola. Requiere `_lock`."""
+        if time.time() - self._last_report < self.cfg["log_every_seconds"]:
+            return
+        self._last_report = time.time()
+        if self._queue:
+            logger.info(f"Post-procesado: {len(self._queue)} trabajos en cola.")
+
+    def shutdown(self, wait_running=True):
+        """Deja de aceptar trabajos; los pendientes quedan guardados para el siguiente arranque.
+
+        Args:
+            wait_running (bool): Esperar a que terminen los trabajos en curso. Defaults to True.
+        """
+        with self._lock:
+            self._closed = True
+            pending = list(self._queue)
+            self._queue.clear()
+            self._wakeup.notify_all()
+        if wait_running:
+            for worker in self._workers:
+                worker.join()
+        with self._lock:
+            for job_id in pending:
+                self.jobs[job_id]["status"] = PENDING
+            self._save_state()
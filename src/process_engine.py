@@ -0,0 +1,440 @@
+import os
+import time
+import queue
+import logging
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+from model import Model
+from encoder import create_encoder, output_extension
+from frame_extractor import jpeg_dimensions
+from pipeline import CameraPipeline
+from metrics import CameraMetrics
+from anonymizer import create_anonymizer
+from profiles import camera_settings
+from supervisor import CameraSupervisor, write_gap_marker
+from startup import camera_frame_size
+from reload import CameraStop
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ENGINE_CFG = {
+    "mode": "threads",
+    "workers": 0,
+    "ring_slots": 8,
+    "pin_cpus": False,
+    "resolution": [1920, 1080],
+    "fps": 25,
+}
+
+KIND_IMAGE = 0
+KIND_JPEG = 1
+
+
+class SharedFrameRing:
+    def __init__(self, slots, slot_size, ctx=None):
+        """
+        Buffer circular de frames en memoria compartida entre dos procesos.
+
+        Los píxeles (o el JPEG) se copian a un hueco de `shared_memory` y solo viaja por
+        la cola un pequeño descriptor (hueco, timestamp, tipo, forma), de modo que los
+        frames nunca se serializan con pickle. El productor nunca espera: si no hay
+        huecos libres el frame se descarta y se contabiliza.
+
+        Args:
+            slots (int): Número de huecos.
+            slot_size (int): Tamaño de cada hueco en bytes.
+            ctx (multiprocessing.context.BaseContext, optional): Contexto de multiprocessing.
+        """
+        ctx = ctx or mp.get_context()
+        self.slots = int(slots)
+        self.slot_size = int(slot_size)
+        self.shm = shared_memory.SharedMemory(create=True, size=self.slots * self.slot_size)
+        self.name = self.shm.name
+        self.free = ctx.Queue()
+        self.ready = ctx.Queue()
+        self.dropped = 0
+        self.oversized = 0
+        self._owner = True
+        for slot in range(self.slots):
+            self.free.put(slot)
+
+    def __getstate__(self):
+        return {
+            "name": self.name,
+            "slots": self.slots,
+            "slot_size": self.slot_size,
+            "free": self.free,
+            "ready": self.ready,
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.dropped = 0
+        self.oversized = 0
+        self._owner = False
+        self.shm = _attach_shared_memory(self.name)
+
+    def put(self, timestamp, image=None, data=None):
+        """Copia un frame decodificado (`image`) o un JPEG (`data`) a un hueco libre.
+
+        Returns:
+            bool: False si no había hueco libre o el frame no cabía.
+        """
+        nbytes = image.nbytes if image is not None else len(data)
+        if nbytes > self.slot_size:
+            if not self.oversized:
+                logger.error(f"Frame de {nbytes} bytes no cabe en el hueco de {self.slot_size} bytes; se descarta.")
+            self.oversized += 1
+            self.dropped += 1
+            return False
+        try:
+            slot = self.free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            return False
+
+        offset = slot * self.slot_size
+        if image is not None:
+            target = np.ndarray(image.shape, dtype=np.uint8, buffer=self.shm.buf, offset=offset)
+            target[...] = image
+            self.ready.put((slot, timestamp, KIND_IMAGE, image.shape))
+        else:
+            self.shm.buf[offset:offset + nbytes] = data
+            self.ready.put((slot, timestamp, KIND_JPEG, nbytes))
+        return True
+
+    def end(self):
+        """Indica al consumidor que el productor terminó."""
+        self.ready.put(None)
+
+    def get(self, timeout=None):
+        """Devuelve el siguiente descriptor (slot, timestamp, kind, shape|nbytes) o None al terminar.
+
+        Raises:
+            queue.Empty: Si vence `timeout` sin frames.
+        """
+        return self.ready.get(timeout=timeout)
+
+    def view(self, slot, kind, shape):
+        """Vista sin copia del contenido de un hueco."""
+        offset = slot * self.slot_size
+        if kind == KIND_IMAGE:
+            return np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf, offset=offset)
+        return self.shm.buf[offset:offset + shape]
+
+    def release(self, slot):
+        """Devuelve un hueco al productor."""
+        self.free.put(slot)
+
+    def close(self):
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+
+
+def _attach_shared_memory(name):
+    """Se conecta a un bloque existente sin que el proceso hijo lo registre como propio."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 siempre registra el bloque, pero los hijos comparten el
+        # resource_tracker del padre y el registro duplicado no tiene efecto
+        return shared_memory.SharedMemory(name=name)
+
+
+class RingWriter:
+    def __init__(self, ring, frame_size, decode_free):
+        """
+        Adaptador con la interfaz de encoder que publica los frames en un `SharedFrameRing`.
+
+        Permite reutilizar `CameraPipeline` en los procesos de ingesta: la etapa de
+        escritura deja cada frame en memoria compartida y el encoder real corre en el
+        proceso principal.
+
+        Raises:
+            ValueError: Si los frames de `frame_size` no caben en los huecos del buffer.
+        """
+        if frame_size[0] * frame_size[1] * 3 > ring.slot_size:
+            raise ValueError(f"Frames de {frame_size[0]}x{frame_size[1]} no caben en los huecos de "
+                             f"{ring.slot_size} bytes; indica su `resolution` en la entrada de la cámara.")
+        self.ring = ring
+        self.frame_size = frame_size
+        self.decode_free = decode_free
+        self.needs_fps_fix = False
+
+    def write(self, frame, timestamp=None):
+        self.ring.put(timestamp or time.time(), image=np.ascontiguousarray(frame))
+
+    def write_jpeg(self, data, timestamp=None):
+        self.ring.put(timestamp or time.time(), data=data)
+
+    def release(self):
+        self.ring.end()
+
+
+def camera_cost(camera, engine_cfg):
+    """Coste relativo de una cámara: píxeles por segundo según su resolución y FPS."""
+    width, height = camera.get("resolution", engine_cfg["resolution"])
+    return int(width) * int(height) * float(camera.get("fps", engine_cfg["fps"]))
+
+
+def assign_cameras(cameras, workers, engine_cfg=None):
+    """Reparte las cámaras entre procesos equilibrando píxeles por segundo.
+
+    Se asigna primero la cámara más costosa al proceso menos cargado (LPT).
+
+    Args:
+        cameras (list): Entradas `cameras` de cfg.json.
+        workers (int): Número de procesos.
+        engine_cfg (dict, optional): Sección `engine` de cfg.json.
+
+    Returns:
+        list[list[dict]]: Cámaras asignadas a cada proceso (sin grupos vacíos).
+    """
+    engine_cfg = {**DEFAULT_ENGINE_CFG, **(engine_cfg or {})}
+    groups = [[] for _ in range(max(1, min(workers, len(cameras))))]
+    loads = [0.0] * len(groups)
+    for camera in sorted(cameras, key=lambda c: camera_cost(c, engine_cfg), reverse=True):
+        target = loads.index(min(loads))
+        groups[target].append(camera)
+        loads[target] += camera_cost(camera, engine_cfg)
+    return [group for group in groups if group]
+
+
+def _ingest_worker(uri, cameras, cfg, rings, duration, stop_event, results, cpus, output_dir):
+    """Proceso de ingesta: lectura, extracción y decodificación de un grupo de cámaras."""
+    logging.basicConfig(level=logging.INFO)
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    model = Model(uri, None)
+
+    def run_camera(camera_name):
+        ring = rings[camera_name]
+        stats = {"camera": camera_name, "error": None}
+        encoder_cfg, pipeline_cfg, _ = camera_settings(cfg, camera_name, 0)
+        decode_free = encoder_cfg.get("backend") == "passthrough"
+        # Un tamaño que no cabe en el buffer no se arregla reconectando: se abandona la cámara
+        camera_stop = CameraStop(stop_event)
+        # Las reconexiones reutilizan el mismo buffer: el vídeo del proceso principal sigue abierto
+        supervisor = CameraSupervisor(camera_name, camera_stop, cfg.get("supervisor"),
+                                      on_gap=lambda name, gap: write_gap_marker(output_dir, gap))
+
+        def ring_writer(frame_size):
+            try:
+                return RingWriter(ring, frame_size, decode_free)
+            except ValueError as e:
+                logger.error(f"{camera_name}: {e}")
+                stats["error"] = str(e)
+                camera_stop.set()
+                raise
+
+        writer = supervisor.hold(ring_writer)
+
+        def session(remaining):
+            with model.open_stream(camera_name, processed=False, timeout=10) as response:
+                pipeline = CameraPipeline(
+                    camera_name,
+                    response,
+                    writer.open,
+                    pipeline_cfg,
+                    camera_stop,
+                    supervisor.metrics,
+                    create_anonymizer(camera_name, model, cfg.get("anonymize"))
+                )
+                return pipeline.run(remaining)
+
+        try:
+            stats.update(supervisor.run(session, duration))
+        except Exception as e:
+            logger.error(f"Error en la ingesta de la cámara {camera_name}: {e}")
+            stats["error"] = str(e)
+        if writer.frame_size is None:
+            ring.end()
+        stats["ring_dropped"] = ring.dropped
+        results.put(stats)
+
+    threads = [threading.Thread(target=run_camera, args=(camera["name"],)) for camera in cameras]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class ProcessEngine:
+    def __init__(self, uri, cfg, output_dir, fps, duration, stop_event=None, metrics=None, on_first_frame=None):
+        """
+        Motor de grabación multiproceso.
+
+        Las cámaras se reparten entre procesos de ingesta (`assign_cameras`), cada uno
+        con su propio GIL, que ejecutan lectura, extracción y decodificación. Los frames
+        resultantes llegan al proceso principal por un `SharedFrameRing` por cámara, y
+        aquí un hilo por cámara los entrega al encoder.
+
+        Args:
+            uri (str): URL base de api-yolo.
+            cfg (dict): Configuración completa (cfg.json).
+            output_dir (Path): Directorio de salida de los vídeos.
+            fps (float): FPS objetivo del encoder.
+            duration (float): Duración de la grabación en segundos.
+            stop_event (threading.Event, optional): Evento de parada del grabador.
+            metrics (MetricsRegistry, optional): Registro de métricas. Solo se miden las
+                etapas del proceso principal (llegada desde el buffer y escritura).
+            on_first_frame (callable, optional): Se llama con (camera_name) al escribir el
+                primer frame de cada cámara.
+        """
+        self.uri = uri
+        self.cfg = cfg
+        self.engine_cfg = {**DEFAULT_ENGINE_CFG, **(cfg.get("engine") or {})}
+        self.output_dir = output_dir
+        self.fps = fps
+        self.duration = duration
+        self.stop_event = stop_event
+        self.metrics = metrics
+        self.on_first_frame = on_first_frame
+        self.ctx = mp.get_context("spawn")
+
+    def _slot_size(self, camera, model):
+        """Bytes de un frame BGR de la cámara: su `resolution`, la que informa api-yolo
+        (`get_camera_properties`, con la del perfil aplicada) o la del motor."""
+        frame_size = camera.get("resolution")
+        if frame_size is None:
+            _, pipeline_cfg, _ = camera_settings(self.cfg, camera["name"], self.fps)
+            frame_size = camera_frame_size(model, camera["name"], pipeline_cfg)
+        if frame_size is None:
+            frame_size = self.engine_cfg["resolution"]
+            logger.warning(f"{camera['name']}: Tamaño desconocido; el buffer admite hasta "
+                           f"{frame_size[0]}x{frame_size[1]} (`resolution` de la cámara para cambiarlo).")
+        width, height = frame_size
+        return int(width) * int(height) * 3
+
+    def _cpu_sets(self, n_groups):
+        if not self.engine_cfg["pin_cpus"] or not hasattr(os, "sched_getaffinity"):
+            return [None] * n_groups
+        cpus = sorted(os.sched_getaffinity(0))
+        return [cpus[i::n_groups] or None for i in range(n_groups)]
+
+    def run(self):
+        """Graba todas las cámaras y devuelve las estadísticas por cámara.
+
+        Returns:
+            dict: {camera_name: stats} con las rutas de salida en `output_path`.
+        """
+        cameras = self.cfg["cameras"]
+        workers = int(self.engine_cfg["workers"]) or os.cpu_count() or 1
+        groups = assign_cameras(cameras, workers, self.engine_cfg)
+        logger.info(f"Repartiendo {len(cameras)} cámaras en {len(groups)} procesos: "
+                    f"{[[c['name'] for c in g] for g in groups]}")
+        if self.cfg.get("sinks") or any(camera.get("sinks") for camera in cameras):
+            logger.warning("El motor de procesos graba una sola salida por cámara; se ignoran las de `sinks`.")
+        if (self.cfg.get("scheduler") or {}).get("enabled"):
+            logger.warning("El planificador de carga no controla el motor de procesos; se ignora `scheduler`.")
+
+        model = Model(self.uri, None)
+        try:
+            rings = {
+                camera["name"]: SharedFrameRing(self.engine_cfg["ring_slots"], self._slot_size(camera, model), self.ctx)
+                for camera in cameras
+            }
+        finally:
+            model.close()
+        stop_event = self.ctx.Event()
+        results = self.ctx.Queue()
+        processes = []
+        writers = {}
+        stats = {}
+        try:
+            for group, cpus in zip(groups, self._cpu_sets(len(groups))):
+                group_rings = {camera["name"]: rings[camera["name"]] for camera in group}
+                process = self.ctx.Process(
+                    target=_ingest_worker,
+                    args=(self.uri, group, self.cfg, group_rings, self.duration, stop_event, results, cpus,
+                          self.output_dir),
+                    daemon=True
+                )
+                process.start()
+                processes.append(process)
+
+            for camera_name, ring in rings.items():
+                stats[camera_name] = {"camera": camera_name}
+                writer = threading.Thread(target=self._write_camera, args=(camera_name, ring, stats[camera_name]))
+                writer.start()
+                writers[camera_name] = writer
+
+            while any(p.is_alive() for p in processes):
+                if self.stop_event is not None and self.stop_event.is_set():
+                    stop_event.set()
+                time.sleep(0.5)
+            for process in processes:
+                process.join()
+            # Un proceso que muere sin avisar deja a su escritor esperando: se le despierta
+            for ring in rings.values():
+                ring.end()
+            for writer in writers.values():
+                writer.join()
+            while True:
+                try:
+                    result = results.get_nowait()
+                except queue.Empty:
+                    break
+                # Los datos del escritor (ruta, errores de escritura) prevalecen sobre los de ingesta
+                stats[result["camera"]] = {**result, **stats[result["camera"]]}
+                if self.metrics is not None:
+                    # Las reconexiones se cuentan en el proceso de ingesta
+                    self.metrics.camera(result["camera"]).reconnects += result.get("reconnects", 0)
+        finally:
+            stop_event.set()
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            for ring in rings.values():
+                ring.close()
+        return stats
+
+    def _write_camera(self, camera_name, ring, stats):
+        encoder_cfg, _, fps = camera_settings(self.cfg, camera_name, self.fps)
+        output_path = self.output_dir / f"{camera_name}{output_extension(encoder_cfg)}"
+        stats["output_path"] = output_path
+        metrics = self.metrics.camera(camera_name) if self.metrics is not None else CameraMetrics(camera_name)
+        encode_time = metrics.stages["encode"]
+        encoder = None
+        held = None
+        try:
+            while True:
+                item = ring.get()
+                if item is None:
+                    break
+                slot, timestamp, kind, shape = item
+                payload = ring.view(slot, kind, shape)
+                if encoder is None:
+                    frame_size = (shape[1], shape[0]) if kind == KIND_IMAGE else jpeg_dimensions(payload)
+                    encoder = create_encoder(output_path, frame_size, fps, encoder_cfg)
+                    metrics.bind_encoder(encoder)
+                    if self.on_first_frame is not None:
+                        self.on_first_frame(camera_name)
+                metrics.frames_in += 1
+                start = time.perf_counter()
+                if kind == KIND_IMAGE:
+                    encoder.write(payload, timestamp)
+                else:
+                    encoder.write_jpeg(payload, timestamp)
+                encode_time.observe(time.perf_counter() - start)
+                metrics.latency.observe(time.time() - timestamp)
+                metrics.frames_written += 1
+                # El encoder puede conservar el último frame para rellenar huecos de la
+                # rejilla CFR: el hueco anterior se libera al escribir el siguiente
+                if held is not None:
+                    ring.release(held)
+                held = slot
+        except Exception as e:
+            logger.error(f"Error escribiendo la cámara {camera_name}: {e}")
+            stats["error"] = str(e)
+        finally:
+            if encoder is not None:
+                encoder.release()
+                stats["needs_fps_fix"] = encoder.needs_fps_fix
+            metrics.unbind()
+            if held is not None:
+                ring.release(held)
@@ -0,0 +1,110 @@
+import logging
+
+import cv2
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROFILE = {
+    "max_fps": 0,
+    "resolution": None,
+    "fps": None,
+    "backend": None,
+    "codec": None,
+    "bitrate": None,
+    "crf": None,
+    "preset": None,
+}
+
+ENCODER_KEYS = ("backend", "codec", "bitrate", "crf", "preset")
+
+REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def camera_profile(cfg, camera_name):
+    """Perfil de grabación de una cámara.
+
+    Cada cámara puede indicar `"profile": "<nombre>"` (definido en la sección
+    `profiles`) o un diccionario con el perfil completo. Se parte siempre del perfil
+    `default` de `profiles`, si existe.
+    """
+    profiles = cfg.get("profiles") or {}
+    camera = next((c for c in cfg.get("cameras", []) if c.get("name") == camera_name), {})
+    profile = camera.get("profile", "default")
+    if isinstance(profile, str):
+        if profile != "default" and profile not in profiles:
+            logger.warning(f"{camera_name}: Perfil '{profile}' no definido, se usa el perfil por defecto.")
+        profile = profiles.get(profile) or {}
+    return {**DEFAULT_PROFILE, **(profiles.get("default") or {}), **profile}
+
+
+def camera_settings(cfg, camera_name, default_fps):
+    """Configuración efectiva de encoder, pipeline y FPS de una cámara según su perfil.
+
+    Returns:
+        tuple: (encoder_cfg, pipeline_cfg, fps).
+    """
+    profile = camera_profile(cfg, camera_name)
+    encoder_cfg = {**(cfg.get("encoder") or {})}
+    encoder_cfg.update({key: profile[key] for key in ENCODER_KEYS if profile[key] is not None})
+
+    pipeline_cfg = {**(cfg.get("pipeline") or {})}
+    if profile["max_fps"]:
+        pipeline_cfg["max_fps"] = profile["max_fps"]
+    if profile["resolution"]:
+        if encoder_cfg.get("backend") == "passthrough":
+            logger.warning(f"{camera_name}: El encoder passthrough no re-escala; se ignora la resolución del perfil.")
+        else:
+            pipeline_cfg["resolution"] = profile["resolution"]
+
+    fps = profile["fps"] or default_fps
+    if profile["max_fps"]:
+        # Una rejilla CFR más rápida que la decimación solo duplicaría frames
+        fps = min(fps, profile["max_fps"])
+    return encoder_cfg, pipeline_cfg, fps
+
+
+def fit_resolution(native_size, max_size):
+    """Tamaño (pares) que cabe en `max_size` manteniendo la proporción; nunca amplía."""
+    width, height = native_size
+    scale = min(max_size[0] / width, max_size[1] / height, 1.0)
+    if scale >= 1.0:
+        return (width, height)
+    return (max(2, int(width * scale) // 2 * 2), max(2, int(height * scale) // 2 * 2))
+
+
+def reduced_decode_flag(native_size, target_size):
+    """Flag de `imdecode` que decodifica directamente a 1/2, 1/4 u 1/8 de resolución.
+
+    Se elige la mayor reducción que no quede por debajo de `target_size`; el ajuste
+    fino restante se hace con `cv2.resize`.
+    """
+    width, height = native_size
+    for factor, flag in REDUCED_DECODE_FLAGS:
+        if width // factor >= target_size[0] and height // factor >= target_size[1]:
+            return flag
+    return cv2.IMREAD_COLOR
+
+
+class FrameDecimator:
+    def __init__(self, max_fps):
+        """
+        Limita los FPS de una cámara descartando frames según su timestamp.
+
+        Se conserva un frame por intervalo de `1 / max_fps` con una tolerancia de un
+        cuarto de intervalo para absorber el jitter de llegada.
+        """
+        self.interval = 1.0 / float(max_fps)
+        self.next_due = None
+
+    def keep(self, timestamp):
+        if self.next_due is not None and timestamp < self.next_due - self.interval * 0.25:
+            return False
+        if self.next_due is None or timestamp - self.next_due > self.interval:
+            # Tras un hueco la rejilla se reinicia en lugar de dejar pasar una ráfaga
+            self.next_due = timestamp
+        self.next_due += self.interval
+        return True
@@ -0,0 +1,313 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from profiles import camera_settings
+from sinks import camera_sinks
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RELOAD_CFG = {
+    "enabled": True,
+    "poll_seconds": 2.0,
+    "reload_api": True,
+    "boundary_grace_seconds": 5,
+}
+
+# Secciones que cambian la grabación de cada cámara: se aplican al reiniciar sus pipelines
+CAMERA_SECTIONS = ("profiles", "encoder", "pipeline", "sinks", "anonymize", "supervisor")
+# Secciones de api-yolo: se aplican volviendo a llamar a `load_cameras_and_models`
+API_SECTIONS = ("models", "tracker_config", "use_queues")
+# El resto (storage, metrics, recording...) necesita reiniciar el grabador
+
+
+def load_config(cfg_path):
+    """Lee y valida cfg.json: una lista `cameras` con nombres únicos.
+
+    Raises:
+        ValueError: Si el fichero no es JSON válido o la lista de cámaras es incorrecta.
+    """
+    with open(cfg_path, "r") as f:
+        cfg = json.load(f)
+    if not isinstance(cfg, dict) or not isinstance(cfg.get("cameras"), list):
+        raise ValueError("La configuración debe contener una lista de cámaras bajo la clave 'cameras'.")
+    names = [camera.get("name") for camera in cfg["cameras"]]
+    if not all(names) or len(set(names)) != len(names):
+        raise ValueError("Cada cámara debe tener un `name` único.")
+    return cfg
+
+
+def camera_names(cfg):
+    return [camera["name"] for camera in cfg.get("cameras", [])]
+
+
+def _camera_entry(cfg, camera_name):
+    return next((c for c in cfg.get("cameras", []) if c.get("name") == camera_name), {})
+
+
+def camera_fingerprint(cfg, camera_name):
+    """Todo lo que determina cómo se graba una cámara, serializado para compararlo."""
+    return json.dumps([
+        _camera_entry(cfg, camera_name),
+        camera_settings(cfg, camera_name, 0),
+        camera_sinks(cfg, camera_name),
+        cfg.get("anonymize"),
+        cfg.get("supervisor"),
+    ], sort_keys=True, default=str)
+
+
+def config_diff(old_cfg, new_cfg):
+    """Cambios entre dos configuraciones.
+
+    Returns:
+        dict: `added`, `removed` y `changed` (cámaras), `api` (si api-yolo debe recargar
+            sus cámaras) y `restart` (secciones que solo se aplican al reiniciar).
+    """
+    old_names, new_names = camera_names(old_cfg), camera_names(new_cfg)
+    added = [name for name in new_names if name not in old_names]
+    removed = [name for name in old_names if name not in new_names]
+    changed = [name for name in new_names if name in old_names
+               and camera_fingerprint(old_cfg, name) != camera_fingerprint(new_cfg, name)]
+    live = ("cameras",) + CAMERA_SECTIONS + API_SECTIONS
+    restart = sorted(key for key in set(old_cfg) | set(new_cfg)
+                     if key not in live and old_cfg.get(key) != new_cfg.get(key))
+    api = bool(added) or any(old_cfg.get(key) != new_cfg.get(key) for key in API_SECTIONS) or any(
+        _camera_entry(old_cfg, name) != _camera_entry(new_cfg, name) for name in changed)
+    return {"added": added, "removed": removed, "changed": changed, "api": api, "restart": restart}
+
+
+def live_config(old_cfg, new_cfg, restart_sections):
+    """`new_cfg` con las secciones que necesitan reinicio tal y como están en marcha."""
+    cfg = dict(new_cfg)
+    for key in restart_sections:
+        if key in old_cfg:
+            cfg[key] = old_cfg[key]
+        else:
+            cfg.pop(key, None)
+    return cfg
+
+
+class CameraStop:
+    def __init__(self, stop_event):
+        """
+        Parada de una sola cámara que también respeta la parada global.
+
+        Tiene la interfaz de `threading.Event` que usan `CameraSupervisor` y
+        `CameraPipeline` (`is_set`, `wait`, `set`), así que quitar una cámara de la
+        configuración la cierra igual que una parada normal: se vacían las colas y se
+        finaliza el vídeo en curso.
+
+        Args:
+            stop_event (threading.Event): Evento global de parada del grabador.
+        """
+        self.stop_event = stop_event
+        self._event = threading.Event()
+
+    def set(self):
+        self._event.set()
+
+    def is_set(self):
+        return self._event.is_set() or self.stop_event.is_set()
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.is_set():
+            remaining = 0.5 if deadline is None else min(0.5, deadline - time.monotonic())
+            if remaining <= 0:
+                return False
+            self._event.wait(remaining)
+        return True
+
+
+class CameraThreads:
+    def __init__(self, target, stop_event):
+        """
+        Un hilo de grabación por cámara que se puede arrancar, parar o reiniciar en marcha.
+
+        Sustituye al `ThreadPoolExecutor` fijo: las cámaras nuevas arrancan su propio
+        hilo y las eliminadas se paran sin tocar al resto. Un reinicio pendiente
+        (`restart_at_boundary`) para la cámara en el límite del segmento (`at_boundary`,
+        o al vencer el plazo si no llegan frames) y la vuelve a arrancar con la
+        configuración nueva en cuanto termina de cerrar sus vídeos.
+
+        Args:
+            target (callable): Recibe (camera_name, stop) y graba la cámara hasta `stop`.
+            stop_event (threading.Event): Evento global de parada del grabador.
+        """
+        self.target = target
+        self.stop_event = stop_event
+        self.closed = False
+        self._threads = {}
+        self._restarts = {}
+        self._lock = threading.Lock()
+
+    def names(self):
+        with self._lock:
+            return list(self._threads)
+
+    def start(self, camera_name):
+        with self._lock:
+            if self.closed or self.stop_event.is_set():
+                return
+            current = self._threads.get(camera_name)
+            if current is not None:
+                if current[1].is_set():
+                    # Todavía cerrando tras quitarla: arranca de nuevo al terminar
+                    self._restarts.setdefault(camera_name, None)
+                return
+            stop = CameraStop(self.stop_event)
+            thread = threading.Thread(target=self._run, args=(camera_name, stop), name=f"{camera_name}-recorder",
+                                      daemon=True)
+            self._threads[camera_name] = (thread, stop)
+        thread.start()
+
+    def stop(self, camera_name):
+        """Para la cámara: vacía su pipeline y cierra sus vídeos sin esperar."""
+        with self._lock:
+            self._cancel_restart(camera_name)
+            current = self._threads.get(camera_name)
+        if current is not None:
+            current[1].set()
+
+    def restart_at_boundary(self, camera_name, boundary, grace_seconds=5):
+        """Reinicia la cámara en el próximo límite de segmento (`boundary`, epoch)."""
+        with self._lock:
+            if camera_name not in self._threads or camera_name in self._restarts:
+                return
+            timer = threading.Timer(max(0.0, boundary - time.time()) + grace_seconds, self._restart_now,
+                                    args=(camera_name,))
+            timer.daemon = True
+            self._restarts[camera_name] = timer
+        timer.start()
+
+    def at_boundary(self, camera_name):
+        """Lo consulta el `SegmentRoller` al llegar al límite: True si la cámara se reinicia aquí."""
+        with self._lock:
+            pending = camera_name in self._restarts
+        if pending:
+            self._restart_now(camera_name)
+        return pending
+
+    def _restart_now(self, camera_name):
+        with self._lock:
+            current = self._threads.get(camera_name)
+        if current is not None and not current[1].is_set():
+            logger.info(f"{camera_name}: Límite de segmento: se reinicia con la nueva configuración.")
+            current[1].set()
+
+    def _cancel_restart(self, camera_name):
+        """Requiere `_lock`."""
+        timer = self._restarts.pop(camera_name, None)
+        if timer is not None:
+            timer.cancel()
+
+    def _run(self, camera_name, stop):
+        try:
+            self.target(camera_name, stop)
+        finally:
+            with self._lock:
+                restart = camera_name in self._restarts and not self.closed and not self.stop_event.is_set()
+                self._cancel_restart(camera_name)
+                if self._threads.get(camera_name, (None, None))[1] is stop:
+                    del self._threads[camera_name]
+            if restart:
+                self.start(camera_name)
+
+    def wait(self):
+        """Espera a que terminen todas las cámaras, también las añadidas mientras tanto."""
+        while True:
+            with self._lock:
+                threads = [thread for thread, _ in self._threads.values()]
+                if not threads:
+                    self.closed = True
+                    for camera_name in list(self._restarts):
+                        self._cancel_restart(camera_name)
+                    return
+            for thread in threads:
+                thread.join()
+
+
+class ConfigWatcher:
+    def __init__(self, cfg_path, cfg, on_change, reload_cfg=None, stop_event=None):
+        """
+        Vigila cfg.json y entrega los cambios sin reiniciar el grabador.
+
+        Cada `poll_seconds` compara la fecha y el tamaño del fichero; si cambian, lo
+        vuelve a leer y valida. Un fichero a medio escribir o inválido se ignora (se
+        mantiene la configuración en marcha) hasta la siguiente modificación. Las
+        secciones que no se pueden aplicar en caliente (`config_diff`) conservan su
+        valor actual y se avisa de que necesitan reiniciar.
+
+        Args:
+            cfg_path (str): Ruta de cfg.json.
+            cfg (dict): Configuración en marcha.
+            on_change (callable): Recibe (cfg, diff) con la nueva configuración efectiva.
+            reload_cfg (dict, optional): Sección `reload` de cfg.json.
+            stop_event (threading.Event, optional): Evento global de parada.
+        """
+        self.cfg_path = cfg_path
+        self.cfg = cfg
+        self.on_change = on_change
+        self.reload_cfg = {**DEFAULT_RELOAD_CFG, **(reload_cfg or {})}
+        self.stop_event = stop_event or threading.Event()
+        self.reloads = 0
+        self._signature = self._stat()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.cfg_path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def start(self):
+        if self.reload_cfg["enabled"] and self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="config-watcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _loop(self):
+        while not self._stop.wait(self.reload_cfg["poll_seconds"]) and not self.stop_event.is_set():
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"Error aplicando los cambios de {self.cfg_path}: {e}")
+
+    def check(self):
+        """Aplica los cambios del fichero, si los hay.
+
+        Returns:
+            dict | None: El `config_diff` aplicado.
+        """
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            return None
+        self._signature = signature
+        try:
+            new_cfg = load_config(self.cfg_path)
+            diff = config_diff(self.cfg, new_cfg)
+        except (OSError, ValueError) as e:
+            logger.error(f"{self.cfg_path} no es válido ({e}); se mantiene la configuración en marcha.")
+            return None
+        if diff["restart"]:
+            logger.warning(f"Cambios en {', '.join(diff['restart'])} de {self.cfg_path}: "
+                           f"se aplicarán al reiniciar el grabador.")
+        if not (diff["added"] or diff["removed"] or diff["changed"] or diff["api"]):
+            return None
+        self.cfg = live_config(self.cfg, new_cfg, diff["restart"])
+        self.reloads += 1
+        logger.info(f"Recarga de {self.cfg_path}: nuevas {diff['added'] or '-'}, eliminadas {diff['removed'] or '-'}, "
+                    f"modificadas {diff['changed'] or '-'}.")
+        self.on_change(self.cfg, diff)
+        return diff
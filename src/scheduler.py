@@ -0,0 +1,296 @@
+import os
+import time
+import logging
+import threading
+
+from profiles import FrameDecimator, reduced_decode_flag
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SCHEDULER_CFG = {
+    "enabled": False,
+    "interval_seconds": 2.0,
+    "cpu_high": 0.9,
+    "cpu_low": 0.6,
+    "lag_high": 1.0,
+    "lag_low": 0.25,
+    "disk_high_mbps": 0,
+    "recover_seconds": 10,
+    "decimate_factor": 0.5,
+    "min_fps": 2,
+    "decode_reduction": 2,
+}
+
+# Niveles de degradación, de menor a mayor
+FULL, DECIMATED, REDUCED, PAUSED = range(4)
+LEVEL_NAMES = ("calidad completa", "FPS reducidos", "FPS y resolución de decodificación reducidos", "en pausa")
+
+
+def camera_priority(cfg, camera_name):
+    """`priority` de la entrada de la cámara en `cameras` (mayor = más importante; 0 por defecto)."""
+    camera = next((c for c in cfg.get("cameras", []) if c.get("name") == camera_name), {})
+    return camera.get("priority", 0)
+
+
+class CpuSampler:
+    def __init__(self):
+        """Uso de CPU del host entre dos muestras (`/proc/stat`, o `loadavg` si no existe)."""
+        self._last = self._read()
+
+    @staticmethod
+    def _read():
+        try:
+            with open("/proc/stat") as f:
+                values = [int(v) for v in f.readline().split()[1:]]
+        except (OSError, ValueError):
+            return None
+        # idle + iowait
+        return sum(values), values[3] + (values[4] if len(values) > 4 else 0)
+
+    def sample(self):
+        current = self._read()
+        if current is None or self._last is None:
+            try:
+                return os.getloadavg()[0] / (os.cpu_count() or 1)
+            except OSError:
+                return None
+        total, idle = current[0] - self._last[0], current[1] - self._last[1]
+        self._last = current
+        return 1.0 - idle / total if total > 0 else 0.0
+
+
+class DiskSampler:
+    def __init__(self):
+        """Bytes/s escritos en los discos del host entre dos muestras (`/proc/diskstats`)."""
+        self._last = (time.monotonic(), self._read())
+
+    @staticmethod
+    def _read():
+        try:
+            disks = set(os.listdir("/sys/block"))
+            with open("/proc/diskstats") as f:
+                lines = [line.split() for line in f]
+        except OSError:
+            return None
+        # Solo discos completos (sin particiones ni dispositivos virtuales): sectores de 512 bytes
+        return sum(int(fields[9]) * 512 for fields in lines
+                   if len(fields) > 9 and fields[2] in disks
+                   and not fields[2].startswith(("loop", "ram", "zram", "dm-", "sr")))
+
+    def sample(self):
+        now, current = time.monotonic(), self._read()
+        last_time, last = self._last
+        self._last = (now, current)
+        if current is None or last is None or now <= last_time:
+            return None
+        return (current - last) / (now - last_time)
+
+
+class CameraLoad:
+    def __init__(self, camera_name, priority=0, fps=25):
+        """
+        Degradación actual de una cámara, compartida por todas sus conexiones.
+
+        `CameraPipeline` consulta `keep` en el extractor (antes de copiar o decodificar
+        el frame) y `decode_flag` en los decodificadores; `LoadScheduler` cambia el nivel.
+
+        Args:
+            camera_name (str): Nombre de la cámara.
+            priority (int, optional): Prioridad (mayor = más importante). Defaults to 0.
+            fps (float, optional): FPS de salida de la cámara. Defaults to 25.
+        """
+        self.camera_name = camera_name
+        self.priority = priority
+        self.fps = float(fps)
+        self.level = FULL
+        self.decimator = None
+        self.reduction = 1
+
+    def set_level(self, level, scheduler_cfg):
+        cfg = {**DEFAULT_SCHEDULER_CFG, **(scheduler_cfg or {})}
+        self.decimator = FrameDecimator(max(cfg["min_fps"], self.fps * cfg["decimate_factor"])) \
+            if level >= DECIMATED else None
+        self.reduction = int(cfg["decode_reduction"]) if level >= REDUCED else 1
+        self.level = level
+
+    def keep(self, timestamp):
+        if self.level >= PAUSED:
+            return False
+        decimator = self.decimator
+        return decimator is None or decimator.keep(timestamp)
+
+    def decode_flag(self, native_size, frame_size, default_flag):
+        """Flag de `imdecode` con la reducción actual; el pipeline re-escala al tamaño del encoder."""
+        if self.reduction <= 1:
+            return default_flag
+        return reduced_decode_flag(native_size, (frame_size[0] // self.reduction, frame_size[1] // self.reduction))
+
+
+class LoadScheduler:
+    def __init__(self, registry, scheduler_cfg=None, stop_event=None):
+        """
+        Reparte la degradación entre cámaras cuando el host no da abasto.
+
+        Cada `interval_seconds` mira el uso de CPU, los bytes/s escritos en disco y, por
+        cámara, el retraso (p90 desde la llegada del frame hasta el encoder) y los frames
+        descartados en las colas. Con presión sube un nivel a una sola cámara: primero se
+        reducen los FPS de todas, empezando por las de menor `priority`; después la
+        resolución de decodificación, y por último se pausan las de menor prioridad (las
+        de la prioridad más alta nunca se pausan); al reanudar, el encoder no rellena el
+        tiempo en pausa (`max_fill_seconds`). Tras `recover_seconds` sin presión se
+        deshace un paso, empezando por las de mayor prioridad. Cada decisión queda en el
+        log y en `decisions`.
+
+        Args:
+            registry (MetricsRegistry): Métricas de las cámaras.
+            scheduler_cfg (dict, optional): Sección `scheduler` de cfg.json.
+            stop_event (threading.Event, optional): Evento global de parada.
+        """
+        self.registry = registry
+        self.cfg = {**DEFAULT_SCHEDULER_CFG, **(scheduler_cfg or {})}
+        self.stop_event = stop_event or threading.Event()
+        self.cameras = {}
+        self.decisions = []
+        self._cpu = CpuSampler()
+        self._disk = DiskSampler()
+        self._windows = {}
+        self._calm_since = None
+        self._last_change = 0.0
+        self._saturated = False
+        self._thread = None
+        self._stop = threading.Event()
+
+    def camera(self, camera_name, priority=0, fps=25):
+        """`CameraLoad` de una cámara, o None si el planificador está desactivado."""
+        if not self.cfg["enabled"]:
+            return None
+        load = self.cameras.get(camera_name)
+        if load is None:
+            load = CameraLoad(camera_name, priority, fps)
+            # Copia en lugar de modificar: `tick` recorre el diccionario desde otro hilo
+            self.cameras = {**self.cameras, camera_name: load}
+        else:
+            # Reinicio con otra configuración: se conserva el nivel actual
+            load.priority = priority
+            load.fps = float(fps)
+        return load
+
+    def remove(self, camera_name):
+        """Deja de planificar una cámara eliminada de la configuración."""
+        self.cameras = {name: load for name, load in self.cameras.items() if name != camera_name}
+        self._windows.pop(camera_name, None)
+
+    def start(self):
+        if self.cfg["enabled"] and self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name="load-scheduler", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _loop(self):
+        while not self._stop.wait(self.cfg["interval_seconds"]) and not self.stop_event.is_set():
+            try:
+                self.tick()
+            except Exception as e:
+                logger.error(f"Error en el planificador de carga: {e}")
+
+    def _camera_lag(self, load):
+        """Retraso p90 y frames descartados de una cámara desde el tick anterior."""
+        metrics = self.registry.camera(load.camera_name)
+        counts = list(metrics.latency.counts)
+        dropped = sum(metrics.dropped().values())
+        last_counts, last_dropped = self._windows.get(load.camera_name, ([0] * len(counts), dropped))
+        self._windows[load.camera_name] = (counts, dropped)
+        window = [c - p for c, p in zip(counts, last_counts)]
+        total = sum(window)
+        lag = 0.0
+        if total:
+            accumulated = 0
+            buckets = metrics.latency.buckets
+            for bound, count in zip(buckets + (buckets[-1],), window):
+                accumulated += count
+                if accumulated >= 0.9 * total:
+                    lag = bound
+                    break
+        return lag, dropped - last_dropped
+
+    def tick(self, now=None):
+        """Evalúa la carga y aplica como mucho un cambio de nivel.
+
+        Returns:
+            dict | None: La decisión tomada, si la hay.
+        """
+        now = now or time.time()
+        cpu = self._cpu.sample()
+        disk = self._disk.sample()
+        cameras = self.cameras
+        lags = {name: self._camera_lag(load) for name, load in cameras.items()}
+        for name, load in cameras.items():
+            self.registry.camera(name).shed_level = load.level
+
+        reasons = []
+        if cpu is not None and cpu >= self.cfg["cpu_high"]:
+            reasons.append(f"CPU {cpu:.0%}")
+        if disk is not None and self.cfg["disk_high_mbps"] and disk >= self.cfg["disk_high_mbps"] * 1e6:
+            reasons.append(f"disco {disk / 1e6:.1f} MB/s")
+        lagging = [name for name, (lag, dropped) in lags.items() if lag >= self.cfg["lag_high"] or dropped]
+        if lagging:
+            reasons.append("retraso en " + ", ".join(
+                f"{name} ({lags[name][0]:.2f}s, {lags[name][1]} descartados)" for name in lagging))
+
+        if reasons:
+            self._calm_since = None
+            return self._degrade("; ".join(reasons), lags, now)
+        calm = (cpu is None or cpu <= self.cfg["cpu_low"]) and all(
+            lag <= self.cfg["lag_low"] for lag, _ in lags.values())
+        if not calm:
+            self._calm_since = None
+            return None
+        self._calm_since = self._calm_since or now
+        if now - self._calm_since >= self.cfg["recover_seconds"] and \
+                now - self._last_change >= self.cfg["recover_seconds"]:
+            self._calm_since = now
+            return self._recover(cpu, now)
+        return None
+
+    def _max_level(self, load):
+        top = max(camera.priority for camera in self.cameras.values())
+        return PAUSED if load.priority < top else REDUCED
+
+    def _degrade(self, reason, lags, now):
+        candidates = [load for load in self.cameras.values() if load.level < self._max_level(load)]
+        if not candidates:
+            if not self._saturated:
+                logger.warning(f"Carga alta ({reason}) y todas las cámaras ya están al mínimo permitido.")
+            self._saturated = True
+            return None
+        self._saturated = False
+        load = min(candidates, key=lambda c: (c.level, c.priority, -lags.get(c.camera_name, (0.0, 0))[0]))
+        return self._apply(load, load.level + 1, reason, now)
+
+    def _recover(self, cpu, now):
+        degraded = [load for load in self.cameras.values() if load.level > FULL]
+        if not degraded:
+            return None
+        load = max(degraded, key=lambda c: (c.level, c.priority))
+        reason = "carga normal" + (f" (CPU {cpu:.0%})" if cpu is not None else "")
+        return self._apply(load, load.level - 1, reason, now)
+
+    def _apply(self, load, level, reason, now):
+        previous = load.level
+        load.set_level(level, self.cfg)
+        self.registry.camera(load.camera_name).shed_level = level
+        self._last_change = now
+        decision = {"time": now, "camera": load.camera_name, "priority": load.priority,
+                    "from": previous, "to": level, "reason": reason}
+        self.decisions.append(decision)
+        log = logger.warning if level > previous else logger.info
+        log(f"{load.camera_name} (prioridad {load.priority}): {LEVEL_NAMES[previous]} -> {LEVEL_NAMES[level]} "
+            f"por {reason}.")
+        return decision
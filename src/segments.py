@@ -0,0 +1,204 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RECORDING_CFG = {
+    "mode": "segments",
+    "segment_max_mb": 0,
+    "align": True,
+}
+
+
+def segment_start(timestamp, interval, align=True):
+    """Inicio del segmento al que pertenece `timestamp`.
+
+    Con `align` los límites caen en múltiplos de `interval` del reloj local (p. ej. en
+    :00, :15, :30 y :45 con 15 minutos), así todas las cámaras comparten directorio.
+    """
+    if not align:
+        return timestamp
+    offset = datetime.fromtimestamp(timestamp).astimezone().utcoffset().total_seconds()
+    return (timestamp + offset) // interval * interval - offset
+
+
+def segment_dir(base_dir, start):
+    """Directorio `../files/<timestamp>/` de un segmento."""
+    path = Path(base_dir) / datetime.fromtimestamp(start).strftime("%Y%m%d_%H%M%S")
+    if not path.exists():
+        path.mkdir(parents=True, exist_ok=True)
+        try:
+            os.chmod(path, 0o777)
+        except Exception as e:
+            logger.error(f"Error al cambiar permisos del directorio {path}: {e}")
+    return path
+
+
+class SegmentRoller:
+    def __init__(self, camera_name, frame_size, base_dir, encoder_factory, extension, interval,
+                 max_bytes=0, align=True, on_segment_closed=None, on_boundary=None):
+        """
+        Encoder que reparte un stream continuo en segmentos consecutivos.
+
+        Tiene la misma interfaz que los encoders (`write`, `write_jpeg`, `release`), así
+        que `CameraPipeline` lo usa sin cambios y la conexión con api-yolo se mantiene
+        abierta indefinidamente. El cambio de segmento se decide con el timestamp de cada
+        frame: el primer frame a partir del límite abre el nuevo fichero, de modo que no
+        se pierde ni se duplica ningún frame. El segmento anterior se cierra en segundo
+        plano para no frenar la escritura.
+
+        Args:
+            camera_name (str): Nombre de la cámara.
+            frame_size (tuple): (ancho, alto) de los frames.
+            base_dir (Path): Directorio raíz de grabaciones (`../files`).
+            encoder_factory (callable): Recibe (output_path, frame_size) y devuelve un encoder.
+            extension (str): Extensión de los vídeos (".mp4", ".mkv"...).
+            interval (float): Duración máxima de cada segmento en segundos.
+            max_bytes (int, optional): Tamaño máximo de cada segmento (0 = sin límite).
+            align (bool, optional): Alinear los límites al reloj. Defaults to True.
+            on_segment_closed (callable, optional): Se llama con (camera_name, info) cuando
+                un segmento queda finalizado.
+            on_boundary (callable, optional): Se llama con (camera_name) al llegar al límite
+                de tiempo de un segmento; si devuelve True se cierra el segmento y no se
+                escribe nada más (la cámara se reinicia con otra configuración).
+        """
+        self.camera_name = camera_name
+        self.frame_size = frame_size
+        self.base_dir = base_dir
+        self.encoder_factory = encoder_factory
+        self.extension = extension
+        self.interval = float(interval)
+        self.max_bytes = int(max_bytes or 0)
+        self.align = align
+        self.on_segment_closed = on_segment_closed
+        self.on_boundary = on_boundary
+
+        self.encoder = None
+        self.segment = None
+        self.segments_closed = 0
+        self._finalizers = []
+        self._duplicated_closed = 0
+        self._dropped_closed = 0
+
+        # El pipeline crea el roller al recibir el primer frame: se abre ya el primer segmento
+        self._open(time.time())
+        self.decode_free = self.encoder.decode_free
+        # Cada segmento corrige sus FPS al cerrarse (ver `on_segment_closed`)
+        self.needs_fps_fix = False
+
+    @property
+    def frames_duplicated(self):
+        """Frames repetidos por la rejilla CFR en todos los segmentos."""
+        return self._duplicated_closed + getattr(self.encoder, "frames_duplicated", 0)
+
+    @property
+    def frames_dropped(self):
+        """Frames descartados por la rejilla CFR en todos los segmentos."""
+        return self._dropped_closed + getattr(self.encoder, "frames_dropped", 0)
+
+    def write(self, frame, timestamp=None):
+        timestamp = timestamp or time.time()
+        if not self._roll_if_needed(timestamp):
+            return
+        self.encoder.write(frame, timestamp)
+        self._count(timestamp)
+
+    def write_jpeg(self, data, timestamp=None):
+        timestamp = timestamp or time.time()
+        if not self._roll_if_needed(timestamp):
+            return
+        self.encoder.write_jpeg(data, timestamp)
+        self._count(timestamp, len(data))
+
+    def _count(self, timestamp, nbytes=0):
+        if not self.segment["frames"]:
+            # Con pre-roll el primer frame es anterior a la apertura del segmento
+            self.segment["start_ts"] = min(self.segment["start_ts"], timestamp)
+        self.segment["frames"] += 1
+        self.segment["last_ts"] = timestamp
+        self.segment["bytes_in"] += nbytes
+
+    def _roll_if_needed(self, timestamp):
+        """Abre el siguiente segmento si toca; False si el roller ya no escribe."""
+        if self.encoder is None:
+            return False
+        if timestamp >= self.segment["end"] and self.on_boundary is not None and self.on_boundary(self.camera_name):
+            self._close_async()
+            return False
+        if timestamp >= self.segment["end"] or self._size_exceeded():
+            self._close_async()
+            self._open(timestamp)
+        return True
+
+    def _size_exceeded(self):
+        if not self.max_bytes or self.segment["frames"] % 25:
+            return False
+        try:
+            return os.path.getsize(self.segment["path"]) >= self.max_bytes
+        except OSError:
+            return False
+
+    def _open(self, timestamp):
+        start = segment_start(timestamp, self.interval, self.align)
+        path = segment_dir(self.base_dir, start) / f"{self.camera_name}{self.extension}"
+        if path.exists():
+            # Segmento partido por tamaño o reinicio dentro del mismo intervalo
+            path = path.with_name(f"{self.camera_name}_{datetime.fromtimestamp(timestamp):%H%M%S}{self.extension}")
+        self.encoder = self.encoder_factory(path, self.frame_size)
+        self.segment = {
+            "path": path,
+            "start_ts": timestamp,
+            "end": start + self.interval,
+            "last_ts": timestamp,
+            "frames": 0,
+            "bytes_in": 0,
+        }
+        logger.info(f"{self.camera_name}: Nuevo segmento {path}")
+
+    def _close_async(self):
+        encoder, segment = self.encoder, self.segment
+        self._fold_counters(encoder)
+        self.encoder = self.segment = None
+        thread = threading.Thread(target=self._finalize, args=(encoder, segment),
+                                  name=f"{self.camera_name}-finalize", daemon=True)
+        thread.start()
+        self._finalizers = [t for t in self._finalizers if t.is_alive()] + [thread]
+
+    def _fold_counters(self, encoder):
+        self._duplicated_closed += getattr(encoder, "frames_duplicated", 0)
+        self._dropped_closed += getattr(encoder, "frames_dropped", 0)
+
+    def _finalize(self, encoder, segment):
+        try:
+            encoder.release()
+        except Exception as e:
+            logger.error(f"{self.camera_name}: Error cerrando el segmento {segment['path']}: {e}")
+            return
+        elapsed = max(segment["last_ts"] - segment["start_ts"], 1e-6)
+        info = {
+            **segment,
+            "fps": segment["frames"] / elapsed,
+            "needs_fps_fix": encoder.needs_fps_fix,
+        }
+        self.segments_closed += 1
+        logger.info(f"{self.camera_name}: Segmento finalizado {segment['path']} "
+                    f"({segment['frames']} frames, {info['fps']:.2f} FPS)")
+        if self.on_segment_closed is not None:
+            try:
+                self.on_segment_closed(self.camera_name, info)
+            except Exception as e:
+                logger.error(f"{self.camera_name}: Error procesando el segmento {segment['path']}: {e}")
+
+    def release(self):
+        """Cierra el segmento en curso y espera a los que se estaban finalizando."""
+        if self.encoder is not None:
+            encoder, segment = self.encoder, self.segment
+            self._fold_counters(encoder)
+            self.encoder = self.segment = None
+            self._finalize(encoder, segment)
+        for thread in self._finalizers:
+            thread.join()
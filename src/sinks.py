@@ -0,0 +1,324 @@
+import os
+import time
+import logging
+import threading
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from frame_extractor import jpeg_dimensions
+from pipeline import BoundedQueue, QueueClosed
+from profiles import ENCODER_KEYS, FrameDecimator, fit_resolution, reduced_decode_flag
+
+logger = logging.getLogger(__name__)
+
+SINK_TYPES = ("video", "snapshot")
+
+DEFAULT_SINK = {
+    "name": None,
+    "type": "video",
+    "suffix": None,
+    "resolution": None,
+    "max_fps": 0,
+    "fps": None,
+    "every_seconds": 10,
+    "quality": 85,
+    "path": "../files/snapshots",
+    "queue_size": 32,
+    "backend": None,
+    "codec": None,
+    "bitrate": None,
+    "crf": None,
+    "preset": None,
+}
+
+
+def camera_sinks(cfg, camera_name):
+    """Salidas de una cámara: `sinks` de su entrada en `cameras` o la sección `sinks`.
+
+    Una lista vacía (por defecto) mantiene la salida única de siempre.
+    """
+    camera = next((c for c in cfg.get("cameras", []) if c.get("name") == camera_name), {})
+    sinks = []
+    for i, sink in enumerate(camera.get("sinks", cfg.get("sinks")) or []):
+        sink = {**DEFAULT_SINK, **sink}
+        if sink["type"] not in SINK_TYPES:
+            raise ValueError(f"Tipo de salida no soportado: {sink['type']}")
+        sink["name"] = sink["name"] or f"{sink['type']}{i}"
+        if sink["suffix"] is None:
+            sink["suffix"] = f"_{sink['name']}"
+        if sink["type"] == "snapshot":
+            sink["max_fps"] = 1.0 / float(sink["every_seconds"])
+        sinks.append(sink)
+    return sinks
+
+
+def sink_settings(sink, encoder_cfg, pipeline_cfg, fps):
+    """Encoder, resolución, límite de FPS y FPS de salida de una salida de vídeo.
+
+    Lo que la salida no indica se hereda del perfil de la cámara.
+
+    Returns:
+        tuple: (encoder_cfg, resolution, max_fps, fps).
+    """
+    sink_encoder_cfg = {**encoder_cfg}
+    sink_encoder_cfg.update({key: sink[key] for key in ENCODER_KEYS if sink[key] is not None})
+    resolution = sink["resolution"] or pipeline_cfg.get("resolution")
+    max_fps = sink["max_fps"] or pipeline_cfg.get("max_fps") or 0
+    sink_fps = sink["fps"] or fps
+    if max_fps:
+        sink_fps = min(sink_fps, max_fps)
+    return sink_encoder_cfg, resolution, max_fps, sink_fps
+
+
+def sinks_pipeline_cfg(sinks, encoder_cfg, pipeline_cfg, fps):
+    """Configuración del pipeline compartido por todas las salidas de una cámara.
+
+    Se decodifica al tamaño de la salida de vídeo más grande que necesita píxeles y se
+    limitan los FPS a los de la salida más rápida; cada salida reduce después lo suyo.
+    """
+    pipeline_cfg = {**pipeline_cfg}
+    resolutions = []
+    rates = []
+    for sink in sinks:
+        if sink["type"] == "snapshot":
+            rates.append(sink["max_fps"])
+            continue
+        sink_encoder_cfg, resolution, max_fps, _ = sink_settings(sink, encoder_cfg, pipeline_cfg, fps)
+        rates.append(max_fps)
+        if sink_encoder_cfg.get("backend") != "passthrough":
+            resolutions.append(resolution)
+    if resolutions and all(resolutions):
+        pipeline_cfg["resolution"] = [max(r[0] for r in resolutions), max(r[1] for r in resolutions)]
+    else:
+        pipeline_cfg["resolution"] = None
+    pipeline_cfg["max_fps"] = max(rates) if rates and all(rates) else 0
+    return pipeline_cfg
+
+
+def video_outputs(fanouts, connected):
+    """Vídeos escritos por las salidas de `fanouts`.
+
+    Args:
+        fanouts (list): `SinkFanout` creados durante la grabación.
+        connected (float): Segundos con conexión, para los FPS reales de cada salida.
+
+    Returns:
+        list[tuple]: (ruta, FPS reales, needs_fps_fix) de cada salida de vídeo con frames.
+    """
+    return [
+        (sink.writer.output_path, sink.frames / connected if connected else 0.0, sink.writer.needs_fps_fix)
+        for fanout in fanouts for sink in fanout.sinks if sink.cfg["type"] == "video" and sink.frames
+    ]
+
+
+class SnapshotWriter:
+    def __init__(self, output_path, frame_size, quality=85):
+        """
+        Salida con la interfaz de encoder que guarda el último frame como JPEG.
+
+        El fichero se sustituye de forma atómica, así que un panel puede leerlo en
+        cualquier momento. Si el JPEG recibido ya tiene el tamaño pedido se guarda tal
+        cual, sin decodificar.
+
+        Args:
+            output_path (Path): Imagen de salida.
+            frame_size (tuple): (ancho, alto) de la imagen.
+            quality (int, optional): Calidad JPEG al re-codificar. Defaults to 85.
+        """
+        self.output_path = Path(output_path)
+        self.frame_size = tuple(frame_size)
+        self.quality = int(quality)
+        self.decode_free = True
+        self.needs_fps_fix = False
+        self.frames_written = 0
+        self.output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    def write(self, frame, timestamp=None):
+        if frame.shape[1::-1] != self.frame_size:
+            frame = cv2.resize(frame, self.frame_size, interpolation=cv2.INTER_AREA)
+        ok, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if ok:
+            self._save(encoded.tobytes())
+
+    def write_jpeg(self, data, timestamp=None):
+        native_size = jpeg_dimensions(data)
+        if native_size == self.frame_size:
+            self._save(bytes(data))
+            return
+        if native_size is None:
+            return
+        frame = cv2.imdecode(np.frombuffer(data, np.uint8), reduced_decode_flag(native_size, self.frame_size))
+        if frame is not None:
+            self.write(frame, timestamp)
+
+    def _save(self, data):
+        created = not self.output_path.exists()
+        tmp = self.output_path.with_name(f".{self.output_path.name}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, self.output_path)
+        self.frames_written += 1
+        if created:
+            try:
+                os.chmod(self.output_path, 0o777)
+            except Exception as e:
+                logger.error(f"Error al cambiar permisos de {self.output_path}: {e}")
+
+    def release(self):
+        pass
+
+
+class Sink:
+    def __init__(self, camera_name, cfg, writer, frame_size, max_fps, wants_jpeg):
+        """Salida de `SinkFanout`: su writer, su cola y su hilo de escritura."""
+        self.name = cfg["name"]
+        self.cfg = cfg
+        self.writer = writer
+        self.frame_size = tuple(frame_size)
+        self.decimator = FrameDecimator(max_fps) if max_fps else None
+        self.needs_image = not writer.decode_free
+        # Prefiere el JPEG original aunque haya frame decodificado
+        self.wants_jpeg = wants_jpeg
+        self.queue = BoundedQueue(cfg["queue_size"], "drop_oldest", f"{camera_name}:{self.name}")
+        self.frames = 0
+        self.error = None
+        self.thread = None
+
+
+class SinkFanout:
+    def __init__(self, camera_name, frame_size, sinks, encoder_cfg, pipeline_cfg, fps, video_factory):
+        """
+        Encoder que reparte una única ingesta entre varias salidas.
+
+        Cada frame llega decodificado como mucho una vez (del pipeline) y se escala una
+        sola vez por cada tamaño de salida distinto; el JPEG original se reutiliza para
+        las salidas que no necesitan píxeles (`passthrough`, snapshots a tamaño nativo).
+        Cada salida aplica su propio límite de FPS y tiene su cola y su hilo de
+        escritura, de modo que una salida lenta solo descarta sus propios frames.
+
+        Args:
+            camera_name (str): Nombre de la cámara.
+            frame_size (tuple): (ancho, alto) de los frames que entrega el pipeline.
+            sinks (list): Salidas de `camera_sinks`.
+            encoder_cfg (dict): Encoder del perfil de la cámara.
+            pipeline_cfg (dict): Pipeline del perfil de la cámara (resolución y FPS por defecto).
+            fps (float): FPS de salida del perfil de la cámara.
+            video_factory (callable): Recibe (nombre de salida, tamaño, encoder_cfg, fps) y
+                devuelve el encoder (o `SegmentRoller`) de una salida de vídeo.
+        """
+        self.camera_name = camera_name
+        self.frame_size = tuple(frame_size)
+        self.needs_fps_fix = False
+        self.sinks = []
+        try:
+            for sink in sinks:
+                self.sinks.append(self._create_sink(sink, encoder_cfg, pipeline_cfg, fps, video_factory))
+        except Exception:
+            self.release()
+            raise
+        # Solo hace falta decodificar si alguna salida de vídeo necesita píxeles
+        self.decode_free = not any(sink.needs_image for sink in self.sinks)
+        for sink in self.sinks:
+            sink.thread = threading.Thread(target=self._write_loop, args=(sink,),
+                                           name=f"{camera_name}-sink-{sink.name}", daemon=True)
+            sink.thread.start()
+        logger.info(f"{camera_name}: Salidas " + ", ".join(
+            f"{sink.name} {sink.frame_size[0]}x{sink.frame_size[1]}" for sink in self.sinks))
+
+    def _create_sink(self, sink, encoder_cfg, pipeline_cfg, fps, video_factory):
+        name = f"{self.camera_name}{sink['suffix']}"
+        if sink["type"] == "snapshot":
+            size = fit_resolution(self.frame_size, sink["resolution"]) if sink["resolution"] else self.frame_size
+            writer = SnapshotWriter(Path(sink["path"]) / f"{name}.jpg", size, sink["quality"])
+            return Sink(self.camera_name, sink, writer, size, sink["max_fps"], not sink["resolution"])
+        sink_encoder_cfg, resolution, max_fps, sink_fps = sink_settings(sink, encoder_cfg, pipeline_cfg, fps)
+        size = self.frame_size
+        if resolution and sink_encoder_cfg.get("backend") != "passthrough":
+            size = fit_resolution(self.frame_size, resolution)
+        writer = video_factory(name, size, sink_encoder_cfg, sink_fps)
+        return Sink(self.camera_name, sink, writer, size, max_fps, writer.decode_free)
+
+    @property
+    def queues(self):
+        return tuple(sink.queue for sink in self.sinks)
+
+    @property
+    def frames_duplicated(self):
+        return sum(getattr(sink.writer, "frames_duplicated", 0) for sink in self.sinks)
+
+    @property
+    def frames_dropped(self):
+        return sum(getattr(sink.writer, "frames_dropped", 0) for sink in self.sinks)
+
+    def write(self, frame, timestamp=None):
+        self.write_frame(frame, None, timestamp)
+
+    def write_jpeg(self, data, timestamp=None):
+        self.write_frame(None, data, timestamp)
+
+    def write_frame(self, image, data, timestamp=None):
+        """Reparte un frame entre las salidas.
+
+        Args:
+            image (np.ndarray): Frame decodificado, o None si el pipeline no decodifica.
+            data (bytes): JPEG original, o None si ya no corresponde a `image` (p. ej.
+                tras borrar las caras); en ese caso se re-codifica una vez si hace falta.
+            timestamp (float, optional): Hora de captura.
+        """
+        timestamp = timestamp or time.time()
+        scaled = {}
+        for sink in self.sinks:
+            if sink.error is not None or (sink.decimator is not None and not sink.decimator.keep(timestamp)):
+                continue
+            if image is not None and not sink.wants_jpeg:
+                if sink.frame_size not in scaled:
+                    scaled[sink.frame_size] = image if sink.frame_size == self.frame_size else cv2.resize(
+                        image, sink.frame_size, interpolation=cv2.INTER_AREA)
+                sink.queue.put((scaled[sink.frame_size], None, timestamp))
+                continue
+            if data is None and image is not None:
+                ok, encoded = cv2.imencode(".jpg", image)
+                if not ok:
+                    continue
+                data = encoded.tobytes()
+            if data is not None:
+                sink.queue.put((None, data, timestamp))
+
+    def _write_loop(self, sink):
+        while True:
+            try:
+                image, data, timestamp = sink.queue.get()
+            except QueueClosed:
+                return
+            if sink.error is not None:
+                continue
+            try:
+                if image is not None:
+                    sink.writer.write(image, timestamp)
+                else:
+                    sink.writer.write_jpeg(data, timestamp)
+                sink.frames += 1
+            except Exception as e:
+                # Una salida que falla no detiene al resto
+                sink.error = e
+                logger.error(f"{self.camera_name}: Error en la salida {sink.name}, se desactiva: {e}")
+
+    def release(self):
+        """Vacía las colas, espera a los hilos y cierra todas las salidas."""
+        self._close("release")
+
+    def discard(self):
+        """Cierra unas salidas que no llegaron a recibir frames y borra sus ficheros."""
+        self._close("discard")
+
+    def _close(self, method):
+        for sink in self.sinks:
+            sink.queue.close()
+        for sink in self.sinks:
+            if sink.thread is not None:
+                sink.thread.join()
+            try:
+                getattr(sink.writer, method, sink.writer.release)()
+            except Exception as e:
+                logger.error(f"{self.camera_name}: Error cerrando la salida {sink.name}: {e}")
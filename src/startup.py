@@ -0,0 +1,174 @@
+import time
+import logging
+import threading
+
+from profiles import fit_resolution
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STARTUP_CFG = {
+    "api_timeout": 120,
+    "ready_timeout": 5,
+    "poll_seconds": 0.1,
+}
+
+READY_STATES = ("running", "ready", "started", "ok", "true")
+NOT_READY_STATES = ("starting", "loading", "initializing", "stopped", "idle", "false")
+
+
+def status_ready(status):
+    """Interpreta la respuesta de `check_status`: `{"status": "running"}`, `{"ready": true}`...
+
+    Returns:
+        bool | None: Si el proceso está en marcha, o None si la respuesta no se reconoce.
+    """
+    if isinstance(status, bool):
+        return status
+    if isinstance(status, dict):
+        if "status" in status:
+            return status_ready(status["status"])
+        for key in ("ready", "running"):
+            if isinstance(status.get(key), bool):
+                return status[key]
+        return None
+    if isinstance(status, str):
+        state = status.strip().lower()
+        if state in READY_STATES:
+            return True
+        if state in NOT_READY_STATES:
+            return False
+    return None
+
+
+def properties_frame_size(properties):
+    """(ancho, alto) de la respuesta de `get_camera_properties`, o None si no lo indica."""
+    if not isinstance(properties, dict):
+        return None
+    for width_key, height_key in (("width", "height"), ("frame_width", "frame_height")):
+        if properties.get(width_key) and properties.get(height_key):
+            return (int(properties[width_key]), int(properties[height_key]))
+    resolution = properties.get("resolution")
+    if isinstance(resolution, (list, tuple)) and len(resolution) == 2 and all(resolution):
+        return (int(resolution[0]), int(resolution[1]))
+    return None
+
+
+def camera_frame_size(model, camera_name, pipeline_cfg=None):
+    """Tamaño de los frames que recibirá el encoder según `get_camera_properties`.
+
+    Aplica la `resolution` del perfil igual que `CameraPipeline`. Devuelve None si
+    api-yolo no informa del tamaño: el pipeline lo leerá de la cabecera del primer JPEG.
+    """
+    try:
+        frame_size = properties_frame_size(model.get_camera_properties(camera_name))
+    except Exception as e:
+        logger.debug(f"{camera_name}: Sin propiedades de la cámara ({e}).")
+        return None
+    resolution = (pipeline_cfg or {}).get("resolution")
+    if frame_size is not None and resolution:
+        frame_size = fit_resolution(frame_size, resolution)
+    return frame_size
+
+
+class StartupTimer:
+    def __init__(self, camera_names):
+        """
+        Tiempos de cada fase del arranque y del primer frame de cada cámara.
+
+        Args:
+            camera_names (list): Cámaras que se esperan para dar el arranque por completo.
+        """
+        self.start = time.monotonic()
+        self.phases = []
+        self.pending = set(camera_names)
+        self.first_frames = {}
+        self._lock = threading.Lock()
+
+    def phase(self, name, function, *args, **kwargs):
+        """Ejecuta una fase del arranque y anota lo que tarda."""
+        phase_start = time.monotonic()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.phases.append((name, time.monotonic() - phase_start))
+
+    def first_frame(self, camera_name):
+        """Anota el primer frame escrito de una cámara; al llegar el último se resume el arranque."""
+        with self._lock:
+            if camera_name in self.first_frames:
+                return
+            elapsed = time.monotonic() - self.start
+            self.first_frames[camera_name] = elapsed
+            # Las cámaras añadidas en caliente no vuelven a resumir el arranque
+            done = camera_name in self.pending and len(self.pending) == 1
+            self.pending.discard(camera_name)
+        logger.info(f"{camera_name}: Primer frame en disco a {elapsed:.3f}s del arranque.")
+        if done:
+            self.log()
+
+    def log(self):
+        phases = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in self.phases)
+        cameras = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in sorted(self.first_frames.items()))
+        logger.info(f"Arranque en {time.monotonic() - self.start:.3f}s. Fases: {phases}. "
+                    f"Primer frame por cámara: {cameras or 'ninguno'}.")
+
+
+def wait_until(condition, timeout, poll_seconds, stop_event=None):
+    """Consulta `condition` hasta que devuelva True; los errores cuentan como "todavía no".
+
+    Raises:
+        TimeoutError: Si vence `timeout`.
+    """
+    deadline = time.monotonic() + timeout
+    last_error = None
+    while True:
+        try:
+            if condition():
+                return
+        except Exception as e:
+            last_error = e
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"Sin respuesta tras {timeout}s" + (f": {last_error}" if last_error else ""))
+        if stop_event is not None and stop_event.wait(poll_seconds):
+            raise InterruptedError("Parada solicitada durante el arranque")
+        if stop_event is None:
+            time.sleep(poll_seconds)
+
+
+def start_api(model, camera_names, startup_cfg=None, stop_event=None):
+    """Arranca api-yolo y espera a que esté listo de verdad, sin esperas fijas.
+
+    Fases: `api` (la API responde a `check_status`), `load` (`load_cameras_and_models`),
+    `start` (`start_process`) y `ready` (`check_status` indica que el proceso corre).
+
+    Solo la fase `api` aborta el arranque (`TimeoutError`). La fase `ready` solo espera
+    si la respuesta de `check_status` se entiende (`status_ready`); si no, o si vence
+    `ready_timeout`, se avisa en el log y se empieza a grabar.
+
+    Returns:
+        StartupTimer: Tiempos del arranque; los grabadores anotan el primer frame de
+            cada cámara con `first_frame`.
+    """
+    cfg = {**DEFAULT_STARTUP_CFG, **(startup_cfg or {})}
+    timer = StartupTimer(camera_names)
+    timer.phase("api", wait_until, lambda: model.check_status() is not None, cfg["api_timeout"],
+                cfg["poll_seconds"], stop_event)
+    timer.phase("load", model.load_cameras_and_models)
+    timer.phase("start", model.start_process)
+
+    def ready():
+        status = model.check_status()
+        state = status_ready(status)
+        if state is None:
+            # La forma de la respuesta no está garantizada: basta con que `start_process` no
+            # fallara y la API responda; los supervisores reintentan las cámaras que no emitan
+            logger.info(f"Respuesta de check_status no reconocida ({status!r}); se da api-yolo por listo.")
+            return True
+        return state
+
+    try:
+        timer.phase("ready", wait_until, ready, cfg["ready_timeout"], cfg["poll_seconds"], stop_event)
+    except TimeoutError as e:
+        logger.warning(f"api-yolo no confirma que el proceso esté en marcha ({e}); se graba igualmente.")
+    logger.info("api-yolo listo: " + ", ".join(f"{name} {seconds:.3f}s" for name, seconds in timer.phases))
+    return timer
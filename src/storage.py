@@ -0,0 +1,309 @@
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STORAGE_CFG = {
+    "archive_dir": "../files",
+    "staging_dir": None,
+    "quota_gb": 0,
+    "min_free_gb": 1.0,
+    "resume_free_gb": 2.0,
+    "evict_on_low_space": True,
+    "grace_seconds": 300,
+    "buffer_mb": 8,
+    "check_seconds": 10,
+    "manifest": "manifest.json",
+}
+
+SEGMENT_DIR_FORMAT = "%Y%m%d_%H%M%S"
+GB = 1024 ** 3
+
+
+def _chmod(path):
+    try:
+        os.chmod(path, 0o777)
+    except Exception as e:
+        logger.error(f"Error al cambiar permisos de {path}: {e}")
+
+
+def _mkdir(path):
+    if not path.exists():
+        path.mkdir(parents=True, exist_ok=True)
+        _chmod(path)
+    return path
+
+
+def is_segment_dir(name):
+    try:
+        datetime.strptime(name, SEGMENT_DIR_FORMAT)
+        return True
+    except ValueError:
+        return False
+
+
+def segment_files(video_path):
+    """Vídeo y ficheros asociados (`.idx`, `.sha256`, miniatura `.jpg`) que existen."""
+    video_path = Path(video_path)
+    return [path for path in sorted(video_path.parent.glob(f"{video_path.stem}.*"))
+            if path == video_path or path.name.startswith(f"{video_path.name}.")
+            or path == video_path.with_suffix(".jpg")]
+
+
+class Storage:
+    def __init__(self, storage_cfg=None):
+        """
+        Almacenamiento de los segmentos: staging, cuota y espacio libre.
+
+        Los encoders escriben bajo `root`: `staging_dir` si se indica (un disco local
+        rápido) o directamente `archive_dir`. Al terminar el post-procesado de cada vídeo
+        (`commit`) el vídeo y sus ficheros asociados pasan al archivo con escrituras
+        secuenciales de `buffer_mb` y un `os.replace` atómico (un simple rename si están
+        en el mismo volumen), de uno en uno desde el hilo del post-procesado.
+
+        El manifiesto (`<archive_dir>/<manifest>`) guarda los directorios de segmento y
+        el tamaño de sus ficheros, así que al arrancar no se recorre el árbol. Con
+        `quota_gb` se borran los directorios más antiguos hasta volver a la cuota. Si el
+        espacio libre baja de `min_free_gb` se borran también (con `evict_on_low_space`)
+        y, si no basta, `paused` detiene la grabación hasta recuperar `resume_free_gb`.
+        Nunca se borra un directorio con ficheros modificados hace menos de `grace_seconds`.
+
+        Args:
+            storage_cfg (dict, optional): Sección `storage` de cfg.json.
+        """
+        self.cfg = {**DEFAULT_STORAGE_CFG, **(storage_cfg or {})}
+        self.archive = _mkdir(Path(self.cfg["archive_dir"]))
+        self.staging = _mkdir(Path(self.cfg["staging_dir"])) if self.cfg["staging_dir"] else None
+        self.root = self.staging or self.archive
+        self.manifest_path = self.archive / self.cfg["manifest"]
+        self.paused = False
+        self.evicted = 0
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.segments = self._load_manifest()
+
+    @property
+    def used_bytes(self):
+        with self._lock:
+            return sum(segment["bytes"] for segment in self.segments.values())
+
+    def segment_dir(self, name):
+        """Directorio de escritura de un segmento (en staging si está configurado)."""
+        return _mkdir(self.root / name)
+
+    def archive_dir(self, name):
+        """Directorio definitivo de un segmento, para ficheros pequeños como `gaps.jsonl`."""
+        return _mkdir(self.archive / name)
+
+    def archive_path(self, path):
+        """Ruta en el archivo de un fichero escrito bajo `root`."""
+        path = Path(path)
+        if self.staging is None:
+            return path
+        try:
+            return self.archive / path.relative_to(self.staging)
+        except ValueError:
+            return path
+
+    def _load_manifest(self):
+        try:
+            manifest = json.loads(self.manifest_path.read_text())
+            return manifest["segments"]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Manifiesto {self.manifest_path} ilegible ({e}); se reconstruye.")
+        # Solo la primera vez (o si se pierde el manifiesto) se recorre el archivo
+        segments = {}
+        for directory in self.archive.iterdir():
+            if directory.is_dir() and is_segment_dir(directory.name):
+                files = {path.name: path.stat().st_size for path in directory.iterdir() if path.is_file()}
+                segments[directory.name] = {"files": files, "bytes": sum(files.values())}
+        self.segments = segments
+        self._save_manifest()
+        logger.info(f"Manifiesto reconstruido: {len(segments)} segmentos, "
+                    f"{sum(s['bytes'] for s in segments.values()) / GB:.2f} GB.")
+        return segments
+
+    def _save_manifest(self):
+        """Guarda el manifiesto de forma atómica. Requiere `_lock`."""
+        try:
+            created = not self.manifest_path.exists()
+            tmp = self.manifest_path.with_name(f"{self.manifest_path.name}.tmp")
+            tmp.write_text(json.dumps({"segments": self.segments}))
+            os.replace(tmp, self.manifest_path)
+            if created:
+                _chmod(self.manifest_path)
+        except OSError as e:
+            logger.error(f"No se pudo guardar el manifiesto {self.manifest_path}: {e}")
+
+    def _move(self, source, target):
+        """Mueve un fichero al archivo: rename si es el mismo volumen, si no copia secuencial."""
+        tmp = target.with_name(f".{target.name}.tmp")
+        try:
+            os.replace(source, target)
+            return
+        except OSError:
+            pass
+        buffer_size = int(self.cfg["buffer_mb"] * 1048576)
+        with open(source, "rb") as src, open(tmp, "wb", buffering=buffer_size) as dst:
+            shutil.copyfileobj(src, dst, buffer_size)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp, target)
+        os.unlink(source)
+
+    def commit(self, video_path):
+        """Pasa un vídeo terminado (y sus ficheros asociados) al archivo y lo anota en el manifiesto.
+
+        Returns:
+            Path: Ruta final del vídeo.
+        """
+        video_path = Path(video_path)
+        target = self.archive_path(video_path)
+        if self.staging is not None and target != video_path:
+            _mkdir(target.parent)
+            if target.exists():
+                # Reinicio dentro del mismo intervalo: nunca se sobrescribe el archivo
+                target = target.with_name(f"{target.stem}_{datetime.now():%H%M%S}{target.suffix}")
+            for path in segment_files(video_path):
+                name = target.name + path.name[len(video_path.name):] if path.name.startswith(video_path.name) \
+                    else target.with_suffix(path.suffix).name
+                self._move(path, target.parent / name)
+                _chmod(target.parent / name)
+            self._remove_if_empty(video_path.parent)
+        self._record(target)
+        self.enforce_quota()
+        return target
+
+    def _record(self, video_path):
+        directory = video_path.parent
+        if not is_segment_dir(directory.name):
+            return
+        with self._lock:
+            segment = self.segments.setdefault(directory.name, {"files": {}, "bytes": 0})
+            for path in segment_files(video_path):
+                segment["files"][path.name] = path.stat().st_size
+            segment["bytes"] = sum(segment["files"].values())
+            self._save_manifest()
+
+    def _remove_if_empty(self, directory):
+        try:
+            directory.rmdir()
+        except OSError:
+            pass
+
+    def recover(self, exclude=()):
+        """Pasa al archivo lo que quedó en staging (tras una caída o al cerrar).
+
+        Args:
+            exclude (iterable): Vídeos con post-procesado pendiente; se moverán al terminarlo.
+        """
+        if self.staging is None:
+            return
+        pending = {path.resolve() for video_path in exclude for path in segment_files(video_path)}
+        for directory in sorted(self.staging.iterdir()):
+            if not directory.is_dir():
+                continue
+            for path in sorted(directory.iterdir()):
+                if not path.is_file() or path.resolve() in pending:
+                    continue
+                target = self.archive_path(path)
+                _mkdir(target.parent)
+                try:
+                    if path.suffix == ".jsonl" and target.exists():
+                        # Marcas de huecos escritas también en el archivo: se añaden
+                        with open(target, "a") as f:
+                            f.write(path.read_text())
+                        path.unlink()
+                    else:
+                        self._move(path, target)
+                        _chmod(target)
+                        self._record(target)
+                except OSError as e:
+                    logger.error(f"No se pudo pasar {path} al archivo: {e}")
+            self._remove_if_empty(directory)
+
+    def _evictable(self, name, now):
+        directory = self.archive / name
+        if self.staging is not None and (self.staging / name).exists():
+            return False
+        try:
+            return all(now - path.stat().st_mtime >= self.cfg["grace_seconds"] for path in directory.iterdir())
+        except FileNotFoundError:
+            return True
+
+    def _evict_oldest(self, reason):
+        now = time.time()
+        with self._lock:
+            name = next((name for name in sorted(self.segments) if self._evictable(name, now)), None)
+            if name is None:
+                return False
+            segment = self.segments.pop(name)
+            self._save_manifest()
+        shutil.rmtree(self.archive / name, ignore_errors=True)
+        self.evicted += 1
+        logger.warning(f"Borrado el segmento {name} ({segment['bytes'] / 1048576:.1f} MB) por {reason}.")
+        return True
+
+    def enforce_quota(self):
+        """Borra los segmentos más antiguos hasta quedar por debajo de `quota_gb`."""
+        quota = self.cfg["quota_gb"] * GB
+        while quota and self.used_bytes > quota:
+            if not self._evict_oldest(f"cuota ({self.used_bytes / GB:.2f} GB de {self.cfg['quota_gb']} GB)"):
+                logger.error("Cuota superada y ningún segmento se puede borrar todavía.")
+                return
+
+    def free_bytes(self):
+        """Espacio libre del volumen más lleno entre staging y archivo."""
+        return min(shutil.disk_usage(path).free for path in {self.root, self.archive})
+
+    def check_space(self):
+        """Libera espacio o pausa la grabación antes de que el disco se llene."""
+        self.enforce_quota()
+        free = self.free_bytes()
+        if free < self.cfg["min_free_gb"] * GB and self.cfg["evict_on_low_space"]:
+            while free < self.cfg["resume_free_gb"] * GB and self._evict_oldest(f"espacio libre ({free / GB:.2f} GB)"):
+                free = self.free_bytes()
+        if not self.paused and free < self.cfg["min_free_gb"] * GB:
+            self.paused = True
+            logger.error(f"Solo quedan {free / GB:.2f} GB libres: grabación en pausa.")
+        elif self.paused and free >= self.cfg["resume_free_gb"] * GB:
+            self.paused = False
+            logger.warning(f"Espacio libre recuperado ({free / GB:.2f} GB): se reanuda la grabación.")
+        return free
+
+    def start(self, exclude=()):
+        """Recupera lo que quedó en staging y vigila el espacio libre cada `check_seconds`.
+
+        Args:
+            exclude (iterable): Vídeos con post-procesado pendiente (ver `recover`).
+        """
+        if self._thread is None:
+            self.recover(exclude)
+            self.check_space()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._monitor_loop, name="storage-monitor", daemon=True)
+            self._thread.start()
+        return self
+
+    def _monitor_loop(self):
+        while not self._stop.wait(self.cfg["check_seconds"]):
+            try:
+                self.check_space()
+            except Exception as e:
+                logger.error(f"Error comprobando el espacio en disco: {e}")
+
+    def close(self, exclude=()):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.recover(exclude)
@@ -0,0 +1,315 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from metrics import CameraMetrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SUPERVISOR_CFG = {
+    "backoff_initial": 1.0,
+    "backoff_max": 60.0,
+    "backoff_factor": 2.0,
+    "jitter": 0.5,
+    "stable_seconds": 30,
+    "max_attempts": 0,
+}
+
+GAPS_FILENAME = "gaps.jsonl"
+
+
+def backoff_delay(attempt, supervisor_cfg=None, rng=random):
+    """Espera antes del reintento número `attempt` (empezando en 1).
+
+    Crece de forma exponencial hasta `backoff_max` y se recorta al azar hasta un
+    `jitter` (fracción) para que las cámaras caídas a la vez no reconecten a la vez.
+    """
+    cfg = {**DEFAULT_SUPERVISOR_CFG, **(supervisor_cfg or {})}
+    delay = min(cfg["backoff_max"], cfg["backoff_initial"] * cfg["backoff_factor"] ** max(0, attempt - 1))
+    return delay * (1.0 - cfg["jitter"] * rng.random())
+
+
+def write_gap_marker(directory, gap):
+    """Añade un hueco de grabación a `gaps.jsonl` del directorio de salida."""
+    path = Path(directory) / GAPS_FILENAME
+    created = not path.exists()
+    with open(path, "a") as f:
+        f.write(json.dumps(gap) + "\n")
+    if created:
+        try:
+            os.chmod(path, 0o777)
+        except Exception as e:
+            logger.error(f"Error al cambiar permisos de {path}: {e}")
+
+
+class HeldEncoder:
+    def __init__(self, factory, on_open=None):
+        """
+        Mantiene abierto el encoder de una cámara entre reconexiones.
+
+        Se pasa a `CameraPipeline` como `encoder_factory` (`open`). Cada sesión llama a
+        `open` con su primer frame y a `release` al terminar, pero el encoder real solo
+        se crea la primera vez y solo se cierra con `close`, así que un corte del stream
+        no parte el vídeo ni sobrescribe el fichero. Si la cámara vuelve con otra
+        resolución, los frames se re-escalan al tamaño con el que se abrió el vídeo. Un
+        corte de más de `max_fill_seconds` (sección `encoder`) no se rellena con frames
+        repetidos: el vídeo continúa tras el último frame y el hueco queda en `gaps.jsonl`.
+
+        Args:
+            factory (callable): Recibe (ancho, alto) y devuelve el encoder real.
+            on_open (callable, optional): Se llama al recibir el primer frame de cada sesión.
+        """
+        self.factory = factory
+        self.on_open = on_open
+        self.encoder = None
+        self.frame_size = None
+        self.decode_free = False
+        self.needs_fps_fix = False
+        self.last_timestamp = None
+        self.rescale = False
+
+    def open(self, frame_size):
+        frame_size = tuple(frame_size)
+        if self.encoder is not None and frame_size != self.frame_size and self.last_timestamp is None:
+            # Tamaño previsto con `prepare` distinto del real: todavía no hay nada escrito,
+            # así que se descarta sin finalizar el vídeo
+            encoder, self.encoder = self.encoder, None
+            getattr(encoder, "discard", encoder.release)()
+        if self.encoder is None:
+            self.prepare(frame_size)
+        rescale = frame_size != self.frame_size
+        if rescale and not self.rescale:
+            logger.warning(f"La resolución cambió de {self.frame_size} a {frame_size}; "
+                           f"se re-escala para no partir el vídeo.")
+        self.rescale = rescale
+        # Al re-escalar los JPEG recibidos ya no valen tal cual
+        self.decode_free = self.encoder.decode_free and not rescale
+        if self.on_open is not None:
+            self.on_open()
+        return self
+
+    def prepare(self, frame_size):
+        """Crea el encoder antes del primer frame si el tamaño se conoce de antemano.
+
+        ffmpeg arranca mientras se abre el stream; si el primer frame trae otro tamaño,
+        `open` lo sustituye.
+        """
+        if self.encoder is None:
+            self.encoder = self.factory(frame_size)
+            self.frame_size = tuple(frame_size)
+            self.decode_free = self.encoder.decode_free
+            self.needs_fps_fix = self.encoder.needs_fps_fix
+
+    @property
+    def frames_duplicated(self):
+        return getattr(self.encoder, "frames_duplicated", 0)
+
+    @property
+    def frames_dropped(self):
+        return getattr(self.encoder, "frames_dropped", 0)
+
+    def _fit(self, frame):
+        height, width = frame.shape[:2]
+        if (width, height) == self.frame_size:
+            return frame
+        return cv2.resize(frame, self.frame_size, interpolation=cv2.INTER_AREA)
+
+    def write(self, frame, timestamp=None):
+        self.last_timestamp = timestamp or time.time()
+        self.encoder.write(self._fit(frame) if self.rescale else frame, self.last_timestamp)
+
+    def write_jpeg(self, data, timestamp=None):
+        self.last_timestamp = timestamp or time.time()
+        if self.rescale:
+            frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+            if frame is not None:
+                self.encoder.write(self._fit(frame), self.last_timestamp)
+            return
+        self.encoder.write_jpeg(data, self.last_timestamp)
+
+    def write_frame(self, image, data, timestamp=None):
+        self.last_timestamp = timestamp or time.time()
+        if self.rescale:
+            image, data = self._fit(image), None
+        if hasattr(self.encoder, "write_frame"):
+            self.encoder.write_frame(image, data, self.last_timestamp)
+        else:
+            self.encoder.write(image, self.last_timestamp)
+
+    @property
+    def queues(self):
+        return getattr(self.encoder, "queues", ())
+
+    def release(self):
+        """Fin de una sesión: el encoder sigue abierto para la siguiente."""
+
+    def close(self):
+        if self.encoder is not None:
+            encoder, self.encoder = self.encoder, None
+            encoder.release()
+
+
+class CameraSupervisor:
+    def __init__(self, camera_name, stop_event=None, supervisor_cfg=None, metrics=None, on_gap=None,
+                 on_first_frame=None):
+        """
+        Ciclo de vida del stream de una cámara: conecta, graba y reconecta.
+
+        Cuando el stream se corta o falla se reintenta con espera exponencial con jitter
+        (`backoff_delay`) sin tocar al resto de cámaras ni a api-yolo. La espera vuelve
+        al mínimo tras una sesión de al menos `stable_seconds`. Cada hueco (desde el
+        último frame escrito hasta el primero de la nueva conexión) se registra en el
+        log y se entrega a `on_gap`.
+
+        Args:
+            camera_name (str): Nombre de la cámara.
+            stop_event (threading.Event, optional): Evento global de parada.
+            supervisor_cfg (dict, optional): Sección `supervisor` de cfg.json.
+            metrics (CameraMetrics, optional): Métricas de la cámara (`reconnects`).
+            on_gap (callable, optional): Se llama con (camera_name, gap) al cerrarse un hueco.
+            on_first_frame (callable, optional): Se llama con (camera_name) al recibir el
+                primer frame de la primera conexión.
+        """
+        self.camera_name = camera_name
+        self.stop_event = stop_event or threading.Event()
+        self.cfg = {**DEFAULT_SUPERVISOR_CFG, **(supervisor_cfg or {})}
+        self.metrics = metrics or CameraMetrics(camera_name)
+        self.on_gap = on_gap
+        self.on_first_frame = on_first_frame
+        self.sessions = 0
+        self.reconnects = 0
+        self.gaps = []
+        self._held = []
+        self._gap = None
+
+    def hold(self, factory):
+        """Envuelve `factory` en un `HeldEncoder` que el supervisor cierra al terminar."""
+        held = HeldEncoder(factory, on_open=self._on_open)
+        self._held.append(held)
+        return held
+
+    def run(self, session, duration=float("inf")):
+        """Ejecuta `session` hasta agotar `duration`, reconectando tras cada corte.
+
+        Args:
+            session (callable): Recibe los segundos restantes y graba una conexión
+                (normalmente `CameraPipeline.run`). Termina al cortarse el stream.
+            duration (float): Duración total de la grabación en segundos.
+
+        Returns:
+            dict: Estadísticas de todas las sesiones (frames, descartes, huecos...).
+        """
+        start = time.time()
+        deadline = start + duration
+        base = self._counters()
+        connected = 0.0
+        attempt = 0
+        try:
+            while not self.stop_event.is_set():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.sessions += 1
+                session_start = time.time()
+                written = self.metrics.frames_written
+                try:
+                    session(remaining)
+                    error = None
+                except Exception as e:
+                    error = e
+                elapsed = time.time() - session_start
+                connected += elapsed
+                if self.stop_event.is_set() or time.time() >= deadline:
+                    break
+
+                reason = f"{type(error).__name__}: {error}" if error is not None else "stream cerrado"
+                self._open_gap(session_start, reason)
+                if self.metrics.frames_written > written and elapsed >= self.cfg["stable_seconds"]:
+                    attempt = 0
+                attempt += 1
+                if self.cfg["max_attempts"] and attempt > self.cfg["max_attempts"]:
+                    logger.error(f"{self.camera_name}: Se abandona la cámara tras {attempt - 1} reintentos.")
+                    break
+                delay = min(backoff_delay(attempt, self.cfg), max(0.0, deadline - time.time()))
+                logger.warning(f"{self.camera_name}: Stream interrumpido ({reason}); "
+                               f"reintento {attempt} en {delay:.1f}s.")
+                if self.stop_event.wait(delay):
+                    break
+                self.reconnects += 1
+                self.metrics.reconnects += 1
+        finally:
+            for held in self._held:
+                try:
+                    held.close()
+                except Exception as e:
+                    logger.error(f"{self.camera_name}: Error cerrando el vídeo: {e}")
+            self._close_gap(recovered=False)
+        return self._summary(base, time.time() - start, connected)
+
+    def _on_open(self):
+        if self.on_first_frame is not None:
+            on_first_frame, self.on_first_frame = self.on_first_frame, None
+            on_first_frame(self.camera_name)
+        self._close_gap()
+
+    def _open_gap(self, session_start, reason):
+        if self._gap is not None:
+            # Sigue abierto desde un intento anterior que no llegó a recibir frames
+            self._gap["attempts"] += 1
+            return
+        last = max((h.last_timestamp or 0.0 for h in self._held), default=0.0)
+        self._gap = {
+            "camera": self.camera_name,
+            "start": last if last >= session_start else time.time(),
+            "end": None,
+            "attempts": 1,
+            "reason": reason,
+        }
+        logger.warning(f"{self.camera_name}: Inicio de hueco de grabación a las {time.ctime(self._gap['start'])}.")
+
+    def _close_gap(self, recovered=True):
+        gap, self._gap = self._gap, None
+        if gap is None:
+            return
+        gap["end"] = time.time()
+        gap["seconds"] = round(gap["end"] - gap["start"], 3)
+        gap["recovered"] = recovered
+        self.gaps.append(gap)
+        logger.warning(f"{self.camera_name}: Fin de hueco de grabación tras {gap['seconds']:.1f}s "
+                       f"({gap['attempts']} intentos).")
+        if self.on_gap is not None:
+            try:
+                self.on_gap(self.camera_name, gap)
+            except Exception as e:
+                logger.error(f"{self.camera_name}: Error registrando el hueco: {e}")
+
+    def _counters(self):
+        return (self.metrics.frames_in, self.metrics.frames_decimated, self.metrics.frames_written,
+                self.metrics.dropped(), self.metrics.stalls, self.metrics.stall_seconds)
+
+    def _summary(self, base, elapsed, connected):
+        frames_in, decimated, written, dropped, stalls, stall_seconds = self._counters()
+        return {
+            "camera": self.camera_name,
+            "elapsed": elapsed,
+            "connected": connected,
+            "frames_in": frames_in - base[0],
+            "decimated": decimated - base[1],
+            "frames_written": written - base[2],
+            # FPS reales mientras había conexión: los huecos no cuentan
+            "fps": (written - base[2]) / connected if connected > 0 else 0.0,
+            "dropped": {stage: count - base[3].get(stage, 0) for stage, count in dropped.items()},
+            "sessions": self.sessions,
+            "reconnects": self.reconnects,
+            "gaps": len(self.gaps),
+            "gap_seconds": round(sum(gap["seconds"] for gap in self.gaps), 3),
+            "stalls": stalls - base[4],
+            "stall_seconds": round(stall_seconds - base[5], 3),
+        }
@@ -0,0 +1,249 @@
+import time
+import logging
+import threading
+from collections import deque
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TRIGGER_CFG = {
+    "pre_roll_seconds": 5,
+    "post_roll_seconds": 10,
+    "max_buffer_mb": 64,
+    "poll_seconds": 0.5,
+    "min_confidence": 0.5,
+    "source": "results",
+    "classes": None,
+}
+
+CLASS_KEYS = ("class_name", "class", "label", "name")
+
+
+class JpegRingBuffer:
+    def __init__(self, max_seconds, max_bytes):
+        """
+        Últimos `max_seconds` de JPEG de una cámara con un tope estricto de memoria.
+
+        Al insertar se descartan los frames más antiguos hasta cumplir ambos límites,
+        así que la memoria nunca supera `max_bytes` (un frame mayor que el tope no se
+        guarda).
+        """
+        self.max_seconds = float(max_seconds)
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self.evicted_by_size = 0
+        self._frames = deque()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def push(self, timestamp, data):
+        if len(data) > self.max_bytes:
+            self.evicted_by_size += 1
+            return
+        self._frames.append((timestamp, data))
+        self.nbytes += len(data)
+        while self._frames and (self.nbytes > self.max_bytes or timestamp - self._frames[0][0] > self.max_seconds):
+            if self.nbytes > self.max_bytes:
+                self.evicted_by_size += 1
+            self.nbytes -= len(self._frames.popleft()[1])
+
+    def drain(self):
+        """Devuelve los frames guardados, del más antiguo al más reciente, y vacía el buffer."""
+        frames = list(self._frames)
+        self._frames.clear()
+        self.nbytes = 0
+        return frames
+
+
+def count_tracked(detections, classes, min_confidence=0.0):
+    """Número de detecciones de las clases `classes` con confianza suficiente."""
+    count = 0
+    for detection in detections or []:
+        if not isinstance(detection, dict):
+            continue
+        label = next((detection[key] for key in CLASS_KEYS if key in detection), None)
+        if classes and label not in classes:
+            continue
+        if float(detection.get("confidence", detection.get("conf", 1.0))) >= min_confidence:
+            count += 1
+    return count
+
+
+def detections_by_camera(results, camera_names):
+    """Reparte la respuesta de `get_results` por cámara.
+
+    Acepta {camera: [detecciones]}, {"results": {...}} o una lista de detecciones
+    con el campo `camera_name`/`camera`.
+    """
+    if isinstance(results, dict) and isinstance(results.get("results"), (dict, list)):
+        results = results["results"]
+    if isinstance(results, dict):
+        return {name: results.get(name) or [] for name in camera_names}
+    grouped = {name: [] for name in camera_names}
+    for detection in results or []:
+        if isinstance(detection, dict):
+            camera_name = detection.get("camera_name", detection.get("camera"))
+            if camera_name in grouped:
+                grouped[camera_name].append(detection)
+    return grouped
+
+
+class ActivityMonitor:
+    def __init__(self, model, camera_names, classes, trigger_cfg=None, stop_event=None):
+        """
+        Consulta periódicamente a api-yolo si hay actividad en cada cámara.
+
+        Con `source: "results"` una sola llamada a `get_results` por ciclo cubre todas
+        las cámaras; con `"detections"` se usa `get_image_n_detections` por cámara.
+
+        Args:
+            model (Model): Cliente de api-yolo.
+            camera_names (list): Cámaras a vigilar.
+            classes (list): Clases que cuentan como actividad (`tracked_classes`).
+            trigger_cfg (dict, optional): Sección `trigger` de cfg.json.
+            stop_event (threading.Event, optional): Evento de parada del grabador.
+        """
+        self.model = model
+        self.camera_names = list(camera_names)
+        self.cfg = {**DEFAULT_TRIGGER_CFG, **(trigger_cfg or {})}
+        self.classes = set(self.cfg["classes"] or classes or [])
+        self.stop_event = stop_event or threading.Event()
+        self.last_activity = {}
+        self.errors = 0
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._poll_loop, name="activity-monitor", daemon=True)
+        self._thread.start()
+        return self
+
+    def _poll_loop(self):
+        while not self.stop_event.wait(self.cfg["poll_seconds"]):
+            try:
+                self.poll()
+            except Exception as e:
+                self.errors += 1
+                if self.errors == 1 or self.errors % 100 == 0:
+                    logger.error(f"Error consultando la actividad ({self.errors}): {e}")
+
+    def poll(self):
+        now = time.time()
+        if self.cfg["source"] == "detections":
+            detections = {}
+            for camera_name in self.camera_names:
+                payload = self.model.get_image_n_detections(camera_name, processed=False)
+                detections[camera_name] = payload.get("detections", []) if isinstance(payload, dict) else payload
+        else:
+            detections = detections_by_camera(self.model.get_results(), self.camera_names)
+        for camera_name, camera_detections in detections.items():
+            if count_tracked(camera_detections, self.classes, self.cfg["min_confidence"]):
+                self.last_activity[camera_name] = now
+
+    def active(self, camera_name, timestamp):
+        """Hay actividad si la última detección cae dentro del post-roll."""
+        last = self.last_activity.get(camera_name)
+        return last is not None and timestamp - last <= self.cfg["post_roll_seconds"]
+
+    def stop(self):
+        self.stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+class TriggeredRecorder:
+    def __init__(self, camera_name, monitor, roller_factory, trigger_cfg=None):
+        """
+        Encoder que solo escribe a disco mientras hay actividad en la cámara.
+
+        Recibe siempre JPEG (`decode_free`) y los guarda en un `JpegRingBuffer`. Al
+        detectarse actividad abre una grabación con `roller_factory`, vuelca el pre-roll
+        y escribe los frames en directo hasta que pasan `post_roll_seconds` sin
+        detecciones. Fuera de los eventos no se decodifica nada.
+
+        Args:
+            camera_name (str): Nombre de la cámara.
+            monitor (ActivityMonitor): Fuente de actividad.
+            roller_factory (callable): Sin argumentos; devuelve el `SegmentRoller` del evento.
+            trigger_cfg (dict, optional): Sección `trigger` de cfg.json.
+        """
+        self.camera_name = camera_name
+        self.monitor = monitor
+        self.roller_factory = roller_factory
+        self.cfg = {**DEFAULT_TRIGGER_CFG, **(trigger_cfg or {})}
+        self.buffer = JpegRingBuffer(self.cfg["pre_roll_seconds"], self.cfg["max_buffer_mb"] * 1048576)
+        self.roller = None
+        self.events = 0
+        self.decode_free = True
+        self.needs_fps_fix = False
+        self._closers = []
+        self._duplicated_closed = 0
+        self._dropped_closed = 0
+
+    @property
+    def frames_duplicated(self):
+        return self._duplicated_closed + getattr(self.roller, "frames_duplicated", 0)
+
+    @property
+    def frames_dropped(self):
+        return self._dropped_closed + getattr(self.roller, "frames_dropped", 0)
+
+    def write(self, frame, timestamp=None):
+        timestamp = timestamp or time.time()
+        ok, encoded = cv2.imencode(".jpg", frame)
+        if ok:
+            self.write_jpeg(encoded.tobytes(), timestamp)
+
+    def write_jpeg(self, data, timestamp=None):
+        timestamp = timestamp or time.time()
+        if self.monitor.active(self.camera_name, timestamp):
+            if self.roller is None:
+                self._start_event(timestamp)
+            self._write(bytes(data), timestamp)
+        else:
+            if self.roller is not None:
+                self._end_event()
+            self.buffer.push(timestamp, bytes(data))
+
+    def _start_event(self, timestamp):
+        self.events += 1
+        pre_roll = self.buffer.drain()
+        logger.info(f"{self.camera_name}: Actividad detectada, grabando evento {self.events} "
+                    f"con {len(pre_roll)} frames de pre-roll.")
+        if self.buffer.evicted_by_size:
+            logger.warning(f"{self.camera_name}: El pre-roll se recortó por el límite de "
+                           f"{self.cfg['max_buffer_mb']} MB ({self.buffer.evicted_by_size} frames).")
+            self.buffer.evicted_by_size = 0
+        self.roller = self.roller_factory()
+        for frame_timestamp, data in pre_roll:
+            self._write(data, frame_timestamp)
+
+    def _write(self, data, timestamp):
+        if self.roller.decode_free:
+            self.roller.write_jpeg(data, timestamp)
+            return
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if image is not None:
+            self.roller.write(image, timestamp)
+
+    def _end_event(self):
+        logger.info(f"{self.camera_name}: Sin actividad durante {self.cfg['post_roll_seconds']}s, "
+                    f"cerrando evento {self.events}.")
+        roller, self.roller = self.roller, None
+        self._duplicated_closed += roller.frames_duplicated
+        self._dropped_closed += roller.frames_dropped
+        # Cerrar el vídeo (esperar a ffmpeg) no debe frenar la escritura
+        thread = threading.Thread(target=roller.release, name=f"{self.camera_name}-event-close", daemon=True)
+        thread.start()
+        self._closers = [t for t in self._closers if t.is_alive()] + [thread]
+
+    def release(self):
+        """Cierra el evento en curso (si lo hay) y espera a los que se estaban cerrando."""
+        if self.roller is not None:
+            roller, self.roller = self.roller, None
+            roller.release()
+        for thread in self._closers:
+            thread.join()
+        self.buffer.drain()